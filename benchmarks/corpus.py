@@ -0,0 +1,113 @@
+import datetime
+import os
+import random
+import shutil
+
+import yaml
+
+from tests.models import Article, Author, Comment, Tag
+
+
+# Proportions of each model in a corpus.  Articles have an FK to Author and an
+# M2M to Tag, Authors have an FK to themselves, and Comments have an FK to
+# Article which is part of their key.
+PROPORTIONS = [
+    (Tag, 0.02),
+    (Author, 0.05),
+    (Article, 0.6),
+    (Comment, 0.33),
+]
+
+LANGUAGES = ['en', 'fr', 'de', 'es']
+
+WORDS = (
+    'amber static site django model view template query page content key '
+    'file load dump build serve crawl render cache index path author tag'
+).split()
+
+
+def clear_corpus():
+    for model, _ in PROPORTIONS:
+        shutil.rmtree(model.get_dump_dir_path(), ignore_errors=True)
+
+
+def generate_corpus(num_files, seed=0):
+    # Writes num_files data files to the dump directories of the models in
+    # tests.models, replacing whatever is there already.  The same num_files
+    # and seed always give the same corpus.
+    rng = random.Random(seed)
+
+    clear_corpus()
+
+    counts = {model: max(1, int(num_files * proportion)) for model, proportion in PROPORTIONS}
+    counts[Comment] = num_files - sum(counts[model] for model in [Tag, Author, Article])
+
+    # Keys only use characters that are matched by \w, as in tests.urls.
+    tag_keys = ['tag_{}'.format(ix) for ix in range(counts[Tag])]
+    for key in tag_keys:
+        write_file(Tag, key, {'name': key.title()})
+
+    author_keys = ['author_{}'.format(ix) for ix in range(counts[Author])]
+    for ix, key in enumerate(author_keys):
+        fields = {
+            'name': 'Author {}'.format(ix),
+            'tags': rng.sample(tag_keys, min(len(tag_keys), 2)),
+        }
+        if ix > 0:
+            fields['editor'] = author_keys[rng.randrange(ix)]
+        write_file(Author, key, fields)
+
+    article_keys = []
+    for ix in range(counts[Article]):
+        language = LANGUAGES[ix % len(LANGUAGES)]
+        slug = 'article_{}'.format(ix)
+        key = '{}/{}'.format(language, slug)
+        article_keys.append(key)
+        fields = {
+            'title': 'Article {}'.format(ix),
+            'author': rng.choice(author_keys),
+            'tags': rng.sample(tag_keys, min(len(tag_keys), rng.randint(1, 3))),
+        }
+        write_file(Article, key, fields, generate_content(rng, ix))
+
+    start_date = datetime.date(2016, 1, 1)
+    for ix in range(counts[Comment]):
+        # Each comment needs a distinct (article, date) pair.
+        article_key = article_keys[ix % len(article_keys)]
+        date = start_date + datetime.timedelta(days=ix // len(article_keys))
+        key = '{}/{}'.format(article_key, date)
+        # Comments have no other fields, so their files have no YAML header,
+        # and their content must not look like YAML markup.
+        write_file(Comment, key, {}, generate_content(rng))
+
+    return counts
+
+
+def generate_content(rng, ix=None):
+    # Content sizes are spread over several orders of magnitude, from a one-line
+    # comment up to a long article.
+    num_paragraphs = int(rng.lognormvariate(1, 1.2)) + 1
+    paragraphs = []
+    for _ in range(num_paragraphs):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(10, 120))]
+        if ix is not None:
+            words[rng.randrange(len(words))] = '*{}*'.format(ix)
+        paragraphs.append(' '.join(words))
+    return '\n\n'.join(paragraphs) + '\n'
+
+
+def write_file(model, key, fields, content=None):
+    if content is None:
+        path = os.path.join(model.get_dump_dir_path(), *key.split('/')) + '.yml'
+    else:
+        path = os.path.join(model.get_dump_dir_path(), *key.split('/')) + '.md'
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w') as f:
+        if fields:
+            yaml.safe_dump(fields, f, default_flow_style=False)
+        if content is not None:
+            if fields:
+                f.write('---\n')
+            f.write(content)
@@ -0,0 +1,266 @@
+"""
+Benchmarks for loadpages, dumppages, buildsite and serve's change detection,
+run against a synthetic corpus modelled on tests.models.
+
+Run from the root of the repository with, for instance:
+
+    python -m benchmarks.run --size 10000 --output results.json
+
+Each benchmark runs in a child process, so that its peak RSS can be measured
+separately.  Results are written as JSON, and can be compared against an
+earlier run with --compare.
+
+The corpus is written to the dump directories of the test models (that is,
+tests/data), replacing anything already there.  The benchmarks use a fresh
+test database, so the database named in the settings is left untouched.
+"""
+
+import argparse
+import datetime
+import json
+from multiprocessing import Pipe, Process
+import os
+import platform
+import resource
+import subprocess
+import sys
+from time import sleep, time
+
+
+def setup_django():
+    sys.path.append('src')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+    import django
+    django.setup()
+
+
+def run_in_child(fn):
+    # Runs fn in a child process, and returns its duration, the number of
+    # queries it made, and the child's peak RSS, along with any extra
+    # measurements that fn returns.
+    #
+    # Only queries made on the calling thread are captured.  If fn makes
+    # queries on other threads (as buildsite's server does, when rendering
+    # pages), it should count them itself and return the count as
+    # other_thread_queries, which is added to the total.
+    from django.db import connection, connections
+    from django.test.utils import CaptureQueriesContext
+
+    def target(conn):
+        try:
+            with CaptureQueriesContext(connection) as ctx:
+                start = time()
+                extra = fn()
+                duration = time() - start
+            extra = dict(extra or {})
+            result = {
+                'seconds': duration,
+                'queries': len(ctx.captured_queries) + extra.pop('other_thread_queries', 0),
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+            result.update(extra)
+            conn.send(result)
+        except Exception as e:
+            conn.send({'error': '{}: {}'.format(type(e).__name__, e)})
+            raise
+
+    # The child mustn't share the parent's database connections.
+    connections.close_all()
+
+    parent_conn, child_conn = Pipe()
+    p = Process(target=target, args=(child_conn,))
+    p.start()
+    result = parent_conn.recv()
+    p.join()
+    return result
+
+
+def benchmark_loadpages():
+    from django.core.management import call_command
+    call_command('loadpages', verbosity=0)
+
+
+def benchmark_dumppages():
+    from django.core.management import call_command
+    call_command('dumppages', verbosity=0)
+
+
+def benchmark_buildsite():
+    import tempfile
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test import override_settings
+
+    # External links (eg to CDNs in the templates) aren't fetched, so that
+    # the timings don't depend on the network.
+    crawl_options = dict(getattr(settings, 'DJANGO_AMBER_CRAWL_OPTIONS', {}), follow_external_links=False)
+
+    report_path = tempfile.mkdtemp()
+    with override_settings(DJANGO_AMBER_CRAWL_OPTIONS=crawl_options):
+        call_command('buildsite', verbosity=0, report=report_path)
+
+    with open(os.path.join(report_path, 'build-report.json')) as f:
+        summary = json.load(f)['summary']
+
+    # Pages are rendered on the server's threads, whose queries are counted
+    # by the report.
+    return {
+        'time_to_first_page_seconds': summary['time_to_first_page_seconds'],
+        'render_queries': summary['total_query_count'],
+        'other_thread_queries': summary['total_query_count'],
+    }
+
+
+def benchmark_get_mtimes():
+    from django_amber.watchers import get_mtimes
+    get_mtimes()
+
+
+def benchmark_polling_rescan():
+    # A rescan by the polling watcher, when nothing has changed.
+    from django_amber.watchers import DirectoryScanner
+    scanner = DirectoryScanner()
+    scanner.racy_window = -1
+    scanner.scan()
+
+    start = time()
+    scanner.scan()
+    return {'rescan_seconds': time() - start}
+
+
+def make_change_detection_benchmark(backend):
+    def benchmark():
+        # The time between a file being modified and the watcher noticing.
+        from django_amber.watchers import InotifyWatcher, PollingWatcher
+        from tests.models import Tag
+
+        if backend == 'inotify':
+            watcher = InotifyWatcher()
+        else:
+            watcher = PollingWatcher()
+
+        path = os.path.join(Tag.get_dump_dir_path(), 'tag_0.yml')
+
+        try:
+            sleep(0.5)
+            start = time()
+            os.utime(path)
+            changed_paths, _ = watcher.wait(timeout=10)
+            latency = time() - start
+            assert changed_paths == [path], changed_paths
+            return {'latency_seconds': latency}
+        finally:
+            watcher.close()
+
+    return benchmark
+
+
+def get_benchmarks(names=None):
+    from django_amber.watchers import load_libc
+
+    benchmarks = [
+        ('loadpages', benchmark_loadpages),
+        ('dumppages', benchmark_dumppages),
+        ('buildsite', benchmark_buildsite),
+        ('get_mtimes', benchmark_get_mtimes),
+        ('polling_rescan', benchmark_polling_rescan),
+        ('polling_change_detection', make_change_detection_benchmark('polling')),
+    ]
+
+    if load_libc() is not None:
+        benchmarks.append(('inotify_change_detection', make_change_detection_benchmark('inotify')))
+
+    if names:
+        benchmarks = [(name, fn) for name, fn in benchmarks if name in names]
+
+    return benchmarks
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(size, seed, names):
+    from django.db import connection
+
+    from .corpus import clear_corpus, generate_corpus
+
+    start = time()
+    counts = generate_corpus(size, seed)
+    generate_seconds = time() - start
+
+    results = {
+        'meta': {
+            'size': size,
+            'seed': seed,
+            'counts': {model._meta.label_lower: count for model, count in counts.items()},
+            'timestamp': datetime.datetime.utcnow().isoformat(),
+            'git_revision': get_git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': connection.vendor,
+        },
+        'results': {
+            'generate_corpus': {'seconds': generate_seconds},
+        },
+    }
+
+    test_settings = connection.settings_dict['TEST']
+    if connection.vendor == 'sqlite' and not test_settings['NAME']:
+        # The default in-memory test database can't be shared with the child
+        # processes that run the benchmarks.
+        test_settings['NAME'] = os.path.abspath('benchmark.sqlite3')
+
+    connection.creation.create_test_db(verbosity=0)
+
+    try:
+        for name, fn in get_benchmarks(names):
+            print('Running {}...'.format(name))
+            results['results'][name] = run_in_child(fn)
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict['NAME'], verbosity=0)
+        clear_corpus()
+
+    return results
+
+
+def compare(old_results, new_results):
+    for name, new in sorted(new_results['results'].items()):
+        old = old_results['results'].get(name)
+        if old is None or 'seconds' not in old or 'seconds' not in new:
+            continue
+
+        ratio = new['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        print('{:30} {:10.3f}s {:10.3f}s {:8.2f}x'.format(name, old['seconds'], new['seconds'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=1000, help='Number of data files to generate (eg 1000, 10000, 100000)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the corpus generator')
+    parser.add_argument('--output', help='Path to write results to, as JSON')
+    parser.add_argument('--compare', help='Path to results of an earlier run to compare against')
+    parser.add_argument('benchmarks', nargs='*', help='Names of benchmarks to run (by default, all of them)')
+    args = parser.parse_args()
+
+    setup_django()
+
+    results = run(args.size, args.seed, args.benchmarks)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
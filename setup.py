@@ -23,7 +23,7 @@ if __name__ == '__main__':
         long_description=read('README.md'),
         packages=find_packages(where='src'),
         package_dir={'': 'src'},
-        install_requires=['Django', 'http-crawler', 'requests', 'PyYAML'],
+        install_requires=['Django', 'requests', 'PyYAML'],
         url='http://github.com/inglesp/django-amber',
         author='Peter Inglesby',
         author_email='peter.inglesby@gmail.com',
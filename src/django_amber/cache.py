@@ -0,0 +1,20 @@
+import os
+
+from django.conf import settings
+
+
+# The subdirectories of DJANGO_AMBER_CACHE_DIR, which clearcache removes.
+CACHE_NAMES = ['compressed', 'rendered']
+
+
+def get_cache_dir(name):
+    # Things that are expensive to compute are cached in subdirectories of
+    # DJANGO_AMBER_CACHE_DIR, so that they are kept between builds.  Setting
+    # this to None disables caching on disk.
+    default = os.path.join(settings.BASE_DIR, '.amber-cache')
+    cache_dir = getattr(settings, 'DJANGO_AMBER_CACHE_DIR', default)
+
+    if cache_dir is None:
+        return None
+
+    return os.path.join(cache_dir, name)
@@ -0,0 +1,162 @@
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+DEFAULT_CONTENT_TYPES = [
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+]
+
+DEFAULT_MIN_SIZE = 1024
+
+# Maps each encoding to the suffix of the files it produces.
+SUFFIXES = {
+    'gzip': '.gz',
+    'br': '.br',
+    'zstd': '.zst',
+}
+
+
+def compress_gzip(content):
+    # gzip.compress() includes the current time in its output, which would
+    # make builds irreproducible.
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def compress_br(content):
+    import brotli
+    return brotli.compress(content)
+
+
+def compress_zstd(content):
+    import zstandard
+    return zstandard.ZstdCompressor(level=19).compress(content)
+
+
+compressors = {
+    'gzip': compress_gzip,
+    'br': compress_br,
+    'zstd': compress_zstd,
+}
+
+
+def check_encodings(encodings):
+    for encoding in encodings:
+        if encoding not in compressors:
+            raise ImproperlyConfigured('Unknown compression encoding {!r}'.format(encoding))
+
+        try:
+            compressors[encoding](b'')
+        except ImportError as e:
+            raise ImproperlyConfigured('Compressing with {} requires {}'.format(encoding, e.name))
+
+
+def compress(content, encoding, cache_dir=None):
+    # Returns the content compressed with the given encoding.  The result is
+    # cached in cache_dir, keyed by a hash of the content, so that unchanged
+    # files are not recompressed in later builds.  This runs in a worker
+    # process.
+    if cache_dir is None:
+        return compressors[encoding](content)
+
+    key = hashlib.sha256(content).hexdigest()
+    path = os.path.join(cache_dir, key[:2], key[2:] + SUFFIXES[encoding])
+
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    compressed = compressors[encoding](content)
+
+    dir_path = os.path.dirname(path)
+    os.makedirs(dir_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path)
+    with open(fd, 'wb') as f:
+        f.write(compressed)
+    os.replace(tmp_path, path)
+
+    return compressed
+
+
+class Compressor:
+    # Compresses files on a pool of processes, and passes the results to a
+    # sink (see django_amber.output), to be written alongside the original
+    # files.
+    def __init__(self, sink, encodings, content_types=None, min_size=DEFAULT_MIN_SIZE,
+                 cache_dir=None, max_workers=None, max_pending=64):
+        check_encodings(encodings)
+
+        self.sink = sink
+        self.encodings = encodings
+        self.content_types = DEFAULT_CONTENT_TYPES if content_types is None else content_types
+        self.min_size = min_size
+        self.cache_dir = cache_dir
+        self.executor = ProcessPoolExecutor(max_workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def should_compress(self, content, content_type):
+        if len(content) < self.min_size:
+            return False
+
+        return content_type.split(';')[0].strip() in self.content_types
+
+    def compress(self, rel_path, content, content_type):
+        if not self.should_compress(content, content_type):
+            return
+
+        for encoding in self.encodings:
+            # The compressed file's place is reserved now, so that archives
+            # list it straight after the original file.
+            slot = self.sink.reserve(rel_path + SUFFIXES[encoding])
+            self.semaphore.acquire()
+
+            try:
+                future = self.executor.submit(compress, content, encoding, self.cache_dir)
+            except BaseException as e:
+                self.semaphore.release()
+                slot.set_exception(e)
+                raise
+
+            future.add_done_callback(self.make_callback(slot))
+
+    def make_callback(self, slot):
+        def callback(future):
+            self.semaphore.release()
+
+            error = future.exception()
+            if error is None:
+                slot.set_result(future.result())
+            else:
+                slot.set_exception(error)
+
+        return callback
+
+    def close(self):
+        # Waits for all pending compression to finish.  Errors are raised when
+        # the sink is closed, which must happen after this.
+        self.executor.shutdown(wait=True)
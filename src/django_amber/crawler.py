@@ -0,0 +1,444 @@
+import asyncio
+import cgi
+from collections import deque
+from functools import partial
+from urllib.parse import urljoin, urlparse
+
+from django.utils.module_loading import import_string
+
+from .frontier import Frontier, normalize_url
+from .links import extract_links
+
+
+REDIRECT_STATUS_CODES = {301, 302, 303, 307, 308}
+
+# The longest line (eg a header) that we'll read from a response.  buildsite
+# --watch can send long headers listing each page's dependencies.
+MAX_LINE_LENGTH = 2 ** 24
+MAX_ATTEMPTS = 3
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Headers(dict):
+    # A dict of response headers, with case-insensitive keys.
+    def __setitem__(self, key, value):
+        super().__setitem__(key.lower(), value)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super().__contains__(key.lower())
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+
+class Response:
+    # Has the parts of the interface of requests.Response that buildsite uses.
+    def __init__(self, url, status_code, reason, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        _, params = cgi.parse_header(self.headers.get('Content-Type', ''))
+        return self.content.decode(params.get('charset', 'utf-8'), errors='replace')
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 500:
+            kind = 'Client'
+        elif 500 <= self.status_code < 600:
+            kind = 'Server'
+        else:
+            return
+
+        raise HTTPError('{} {} Error: {} for url: {}'.format(self.status_code, kind, self.reason, self.url))
+
+
+class Request:
+    def __init__(self, path, host):
+        self.path = path
+        self.data = 'GET {} HTTP/1.1\r\nHost: {}\r\nAccept-Encoding: identity\r\n\r\n'.format(path, host).encode('latin-1')
+        self.future = asyncio.Future()
+        self.attempts = 0
+
+
+async def read_response(reader):
+    # Returns (status_code, reason, headers, content, keep_alive) for the next
+    # response on the connection.
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('Connection closed before response')
+
+    version, status_code, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    status_code = int(status_code)
+
+    headers = Headers()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        name = name.strip()
+        if name in headers:
+            headers[name] += ', ' + value.strip()
+        else:
+            headers[name] = value.strip()
+
+    connection = headers.get('Connection', '').lower()
+    if version == 'HTTP/1.0':
+        keep_alive = connection == 'keep-alive'
+    else:
+        keep_alive = connection != 'close'
+
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Skip any trailers.
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        content = b''.join(chunks)
+    elif 'Content-Length' in headers:
+        content = await reader.readexactly(int(headers['Content-Length']))
+    elif status_code in (204, 304) or 100 <= status_code < 200:
+        content = b''
+    else:
+        content = await reader.read()
+        keep_alive = False
+
+    return status_code, reason, headers, content, keep_alive
+
+
+class Connection:
+    # A keep-alive connection, which may have several requests in flight at
+    # once.  Responses are read in the order that requests were sent.
+    def __init__(self, pool):
+        self.pool = pool
+        self.reader = None
+        self.writer = None
+        self.pending = deque()
+        self.reader_task = None
+        self.closed = False
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.pool.host, self.pool.port, limit=MAX_LINE_LENGTH)
+
+    def send(self, request):
+        self.pending.append(request)
+        self.writer.write(request.data)
+
+        if self.reader_task is None:
+            self.reader_task = asyncio.ensure_future(self.read_responses())
+
+    async def read_responses(self):
+        keep_alive = True
+
+        try:
+            while self.pending:
+                status_code, reason, headers, content, keep_alive = await read_response(self.reader)
+                request = self.pending.popleft()
+                if not request.future.done():
+                    request.future.set_result((status_code, reason, headers, content))
+
+                if not keep_alive:
+                    self.pool.keep_alive_refused()
+                    break
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            keep_alive = False
+        finally:
+            # There's no await between the last check of pending and here, so
+            # the next call to send will start a new reader.
+            self.reader_task = None
+
+            if not keep_alive:
+                self.close()
+
+            # Taking the pool's lock here would let dispatch send a request
+            # while this reader is waiting to finish, so the pool is notified
+            # from a separate task.
+            asyncio.ensure_future(self.pool.notify())
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.writer.close()
+
+        # Requests that were sent but not answered are sent again.
+        pending, self.pending = self.pending, deque()
+        for request in pending:
+            self.pool.retry(request)
+
+
+class ConnectionPool:
+    # Sends GET requests to a single host, over up to max_connections
+    # keep-alive connections, with up to pipeline_depth requests in flight on
+    # each.  Pipelining is turned off if the server turns out not to support
+    # keep-alive connections.
+    def __init__(self, host, port, max_connections=4, pipeline_depth=4):
+        self.host = host
+        self.port = port
+        self.netloc = '{}:{}'.format(host, port)
+        self.max_connections = max_connections
+        self.pipeline_depth = pipeline_depth
+        self.keep_alive = True
+        self.connections = []
+        self.condition = asyncio.Condition()
+
+    async def get(self, path):
+        request = Request(path, self.netloc)
+        await self.dispatch(request)
+        return await request.future
+
+    async def dispatch(self, request):
+        request.attempts += 1
+
+        async with self.condition:
+            while True:
+                connection = self.choose_connection()
+                if connection is not None:
+                    break
+
+                if len(self.connections) < self.max_connections:
+                    connection = Connection(self)
+                    try:
+                        await connection.open()
+                    except OSError as e:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                        return
+                    self.connections.append(connection)
+                    break
+
+                await self.condition.wait()
+
+            connection.send(request)
+
+    def choose_connection(self):
+        self.connections = [connection for connection in self.connections if not connection.closed]
+        depth = self.pipeline_depth if self.keep_alive else 1
+        candidates = [connection for connection in self.connections if len(connection.pending) < depth]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda connection: len(connection.pending))
+
+    def keep_alive_refused(self):
+        # Any requests pipelined after a response that closes the connection
+        # have to be sent again, so once the server has closed a connection we
+        # stop pipelining.
+        self.keep_alive = False
+
+    def retry(self, request):
+        if request.future.done():
+            return
+
+        if request.attempts >= MAX_ATTEMPTS:
+            request.future.set_exception(ConnectionResetError('Connection closed before response'))
+        else:
+            asyncio.ensure_future(self.dispatch(request))
+
+    async def notify(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+
+class Crawler:
+    # Crawls a site from base_url, with up to `concurrency` requests in flight
+    # at once.  Responses are returned in the order that URLs leave the
+    # frontier, so that the order of a crawl doesn't depend on how quickly the
+    # server responds.
+    #
+    # Redirects from the site are treated as links to their targets, so that
+    # a page that is both linked to and redirected to is only fetched once.
+    #
+    # If paths is given, the crawl starts from those paths instead of from
+    # base_url, and they are fetched even if the frontier has already seen
+    # them.  If follow_links is False, only the starting pages (and the
+    # targets of any redirects) are fetched.
+    def __init__(self, base_url, follow_external_links=True, verify=True, concurrency=8,
+                 connections=4, pipeline_depth=4, frontier=None, skip_paths=(), paths=None,
+                 follow_links=True):
+        if frontier is None:
+            frontier = Frontier()
+
+        self.frontier = frontier
+        base_url = frontier.normalize(base_url)
+        parsed_url = urlparse(base_url)
+
+        self.base_netloc = parsed_url.netloc
+        self.follow_external_links = follow_external_links
+        self.verify = verify
+        self.concurrency = concurrency
+        self.skip_paths = tuple(skip_paths)
+        self.follow_links = follow_links
+        self.pool = ConnectionPool(parsed_url.hostname, parsed_url.port or 80, connections, pipeline_depth)
+        self.session = None
+        self.in_flight = deque()
+
+        if paths is None:
+            frontier.add(base_url)
+        else:
+            for path in paths:
+                self.add_link(urljoin(base_url, path), force=True)
+
+    async def next_response(self):
+        while True:
+            self.fill()
+
+            if not self.in_flight:
+                return None
+
+            url, task = self.in_flight.popleft()
+            rsp = await task
+
+            if self.is_local(url) and rsp.status_code in REDIRECT_STATUS_CODES and 'Location' in rsp.headers:
+                self.add_link(urljoin(url, rsp.headers['Location']))
+                continue
+
+            self.add_links(url, rsp)
+            self.fill()
+            return rsp
+
+    def fill(self):
+        while self.frontier and len(self.in_flight) < self.concurrency:
+            url = self.frontier.pop()
+            self.in_flight.append((url, asyncio.ensure_future(self.fetch(url))))
+
+    def is_local(self, url):
+        parsed_url = urlparse(url)
+        return parsed_url.scheme == 'http' and parsed_url.netloc == self.base_netloc
+
+    async def fetch(self, url):
+        if not self.is_local(url):
+            return await self.fetch_external(url)
+
+        parsed_url = urlparse(url)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+
+        status_code, reason, headers, content = await self.pool.get(path)
+        return Response(url, status_code, reason, headers, content)
+
+    async def fetch_external(self, url):
+        # External links are only checked, so there's no need for them to be
+        # fast.
+        import requests
+
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.verify = self.verify
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.session.get, url)
+
+    def add_links(self, url, rsp):
+        if not self.follow_links or urlparse(url).netloc != self.base_netloc:
+            return
+
+        for url1 in extract_links(rsp.content, rsp.headers.get('Content-Type', '')):
+            self.add_link(urljoin(url, url1))
+
+    def add_link(self, url, force=False):
+        parsed_url = urlparse(url)
+
+        if parsed_url.scheme not in ('http', 'https'):
+            return
+
+        if parsed_url.netloc == self.base_netloc:
+            if self.skip_paths and parsed_url.path.startswith(self.skip_paths):
+                return
+        elif not self.follow_external_links:
+            return
+
+        self.frontier.add(url, force)
+
+    async def close(self):
+        self.pool.close()
+
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        tasks = [task for task in all_tasks() if task is not current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.session is not None:
+            self.session.close()
+
+
+def current_task():
+    fn = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+    return fn()
+
+
+def crawl(base_url, follow_external_links=True, ignore_fragments=True, verify=True,
+          concurrency=8, connections=4, pipeline_depth=4, ignore_query_params=(),
+          sort_query_params=False, trailing_slash=None, priority=None, skip_paths=(),
+          paths=None, follow_links=True, seen=None):
+    # Yields a response for every page reachable from base_url.  Pages on
+    # base_url's host are fetched over a pool of keep-alive connections, with
+    # requests pipelined on each connection.  External links are fetched (so
+    # that broken links can be found) but not followed.
+    #
+    # URLs are normalized (see django_amber.frontier.normalize_url) before
+    # being crawled.  priority may be a function, or the dotted path to a
+    # function, that returns a URL's priority; URLs with lower priorities are
+    # crawled first.  Local URLs whose paths start with any of skip_paths are
+    # not crawled.  See Crawler for paths and follow_links, and Frontier for
+    # seen.
+    if isinstance(priority, str):
+        priority = import_string(priority)
+
+    normalize = partial(
+        normalize_url,
+        ignore_fragments=ignore_fragments,
+        ignore_query_params=ignore_query_params,
+        sort_query_params=sort_query_params,
+        trailing_slash=trailing_slash,
+    )
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        crawler = Crawler(
+            base_url,
+            follow_external_links=follow_external_links,
+            verify=verify,
+            concurrency=concurrency,
+            connections=connections,
+            pipeline_depth=pipeline_depth,
+            frontier=Frontier(normalize, priority, seen),
+            skip_paths=skip_paths,
+            paths=paths,
+            follow_links=follow_links,
+        )
+
+        try:
+            while True:
+                rsp = loop.run_until_complete(crawler.next_response())
+                if rsp is None:
+                    break
+                yield rsp
+        finally:
+            loop.run_until_complete(crawler.close())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
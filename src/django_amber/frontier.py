@@ -0,0 +1,104 @@
+from fnmatch import fnmatchcase
+import hashlib
+import heapq
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+}
+
+
+def normalize_url(url, ignore_fragments=True, ignore_query_params=(), sort_query_params=False,
+                  trailing_slash=None):
+    # Returns url in a canonical form, so that URLs that refer to the same page
+    # are only crawled once.
+    #
+    # Query parameters whose names match any of the glob patterns in
+    # ignore_query_params are removed.  If trailing_slash is 'add', a slash is
+    # added to paths whose last segment doesn't look like a filename, and if
+    # it is 'remove', trailing slashes are removed.
+    parts = urlsplit(url)
+
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':{}'.format(parts.port)
+
+    path = parts.path or '/'
+
+    if trailing_slash == 'add':
+        if not path.endswith('/') and '.' not in path.rsplit('/', 1)[-1]:
+            path += '/'
+    elif trailing_slash == 'remove':
+        if path != '/':
+            path = path.rstrip('/') or '/'
+    else:
+        assert trailing_slash is None, trailing_slash
+
+    query = parts.query
+    if query and (ignore_query_params or sort_query_params):
+        params = parse_qsl(query, keep_blank_values=True)
+        params = [
+            (name, value) for name, value in params
+            if not any(fnmatchcase(name, pattern) for pattern in ignore_query_params)
+        ]
+        if sort_query_params:
+            params.sort()
+        query = urlencode(params)
+
+    fragment = '' if ignore_fragments else parts.fragment
+
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def fingerprint(url):
+    # 64 bits is enough to make a collision between two of a few million URLs
+    # vanishingly unlikely.  An int takes less memory than the equivalent
+    # bytes object.
+    return int.from_bytes(hashlib.blake2b(url.encode('utf8'), digest_size=8).digest(), 'big')
+
+
+class Frontier:
+    # The URLs waiting to be crawled, and fingerprints of every URL that has
+    # been seen, so that each URL is only crawled once.  Each URL's full text
+    # is only kept until it is crawled.
+    #
+    # URLs are returned in order of priority(url) (lowest first), and then in
+    # the order they were added.  By default, every URL has the same priority,
+    # so the crawl is breadth first.
+    #
+    # seen, if given, is a set of fingerprints of URLs that should not be
+    # crawled again, and is updated as URLs are added.
+    def __init__(self, normalize=normalize_url, priority=None, seen=None):
+        self.normalize = normalize
+        self.priority = priority
+        self.seen = set() if seen is None else seen
+        self.heap = []
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, url):
+        return fingerprint(self.normalize(url)) in self.seen
+
+    def add(self, url, force=False):
+        # Returns whether url had not been seen before.  If force is True, url
+        # is added even if it has been seen.
+        url = self.normalize(url)
+        key = fingerprint(url)
+
+        if key in self.seen and not force:
+            return False
+
+        self.seen.add(key)
+
+        priority = 0 if self.priority is None else self.priority(url)
+        heapq.heappush(self.heap, (priority, self.counter, url))
+        self.counter += 1
+        return True
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
@@ -0,0 +1,112 @@
+import os
+import subprocess
+
+from .watchers import get_dump_dir_paths
+
+
+class GitError(Exception):
+    pass
+
+
+def run_git(args, cwd):
+    try:
+        return subprocess.check_output(
+            ['git'] + args,
+            cwd=cwd,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as e:
+        raise GitError('Could not run git: {}'.format(e))
+    except subprocess.CalledProcessError as e:
+        raise GitError('git {} failed: {}'.format(args[0], e.stderr.decode('utf8', 'replace').strip()))
+
+
+def get_toplevel(path):
+    # Returns the root of the working tree that path is in.  path need not
+    # exist, so long as one of its ancestors does.
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+
+    return os.fsdecode(run_git(['rev-parse', '--show-toplevel'], path).rstrip(b'\n'))
+
+
+def split_z(output):
+    # Splits the output of a git command run with -z.
+    return [os.fsdecode(item) for item in output.split(b'\0') if item]
+
+
+def parse_name_status(output):
+    # Parses the output of `git diff --name-status -z`, returning the paths of
+    # files that were changed or added, and of files that were removed.  A
+    # renamed file counts as removed from its old path and added at its new
+    # one.
+    changed_paths = []
+    missing_paths = []
+
+    items = split_z(output)
+
+    while items:
+        status = items.pop(0)
+
+        if status[0] in 'RC':
+            old_path, new_path = items.pop(0), items.pop(0)
+            if status[0] == 'R':
+                missing_paths.append(old_path)
+            changed_paths.append(new_path)
+        elif status[0] == 'D':
+            missing_paths.append(items.pop(0))
+        else:
+            # A (added), M (modified), T (type changed) or U (unmerged).
+            changed_paths.append(items.pop(0))
+
+    return changed_paths, missing_paths
+
+
+def get_changes_since(rev, dir_paths=None):
+    # Returns the paths of data files that have been changed or added, and of
+    # those that have been removed, since rev, according to git.  Changes
+    # that haven't been committed are included, as are files that git doesn't
+    # yet know about (unless they're ignored).
+    #
+    # As with find_file_paths_in_dir, files whose names begin with a dot are
+    # skipped.
+    if dir_paths is None:
+        dir_paths = get_dump_dir_paths()
+
+    dir_paths_by_toplevel = {}
+    for dir_path in dir_paths:
+        dir_paths_by_toplevel.setdefault(get_toplevel(dir_path), []).append(dir_path)
+
+    changed_paths = []
+    missing_paths = []
+
+    for toplevel, dir_paths in sorted(dir_paths_by_toplevel.items()):
+        # Paths in git's output are relative to the top of the working tree,
+        # which may have been reached through a symlink.
+        rel_dir_paths = {}
+        for dir_path in dir_paths:
+            rel_dir_path = os.path.relpath(os.path.realpath(dir_path), os.path.realpath(toplevel))
+            rel_dir_paths[rel_dir_path] = dir_path
+
+        pathspecs = ['--'] + sorted(rel_dir_paths)
+
+        commit = run_git(['rev-parse', '--verify', '--end-of-options', rev + '^{commit}'], toplevel).decode('ascii').strip()
+        diff_output = run_git(['diff', '--name-status', '-M', '-z', commit] + pathspecs, toplevel)
+        untracked_output = run_git(['ls-files', '--others', '--exclude-standard', '-z'] + pathspecs, toplevel)
+
+        changed, missing = parse_name_status(diff_output)
+        changed.extend(split_z(untracked_output))
+
+        for rel_paths, paths in [(changed, changed_paths), (missing, missing_paths)]:
+            for rel_path in rel_paths:
+                rel_path = rel_path.replace('/', os.sep)
+
+                if os.path.basename(rel_path)[0] == '.':
+                    continue
+
+                for rel_dir_path, dir_path in rel_dir_paths.items():
+                    if rel_dir_path == os.curdir or os.path.commonpath([rel_path, rel_dir_path]) == rel_dir_path:
+                        paths.append(os.path.join(dir_path, os.path.relpath(rel_path, rel_dir_path)))
+                        break
+
+    return changed_paths, missing_paths
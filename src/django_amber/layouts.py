@@ -0,0 +1,84 @@
+import hashlib
+import re
+
+
+class FlatLayout:
+    # Each file's path, relative to its model's dump directory and without
+    # its extension, is its key.  Paths always use forward slashes.
+    name = 'flat'
+
+    def key_to_rel_path(self, key):
+        return key
+
+    def rel_path_to_key(self, rel_path):
+        return rel_path
+
+
+class HashedLayout(FlatLayout):
+    # Files are spread over nested directories named after a hash of the key,
+    # eg 3f/a2/some-key, so that no directory holds more than a few files,
+    # however many instances a model has.  Each level has 256 directories.
+    name = 'hashed'
+
+    def __init__(self, levels=2):
+        self.levels = levels
+
+    def key_to_rel_path(self, key):
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=8).hexdigest()
+        buckets = [digest[ix:ix + 2] for ix in range(0, self.levels * 2, 2)]
+        return '/'.join(buckets + [key])
+
+    def rel_path_to_key(self, rel_path):
+        parts = rel_path.split('/', self.levels)
+
+        if len(parts) > self.levels and self.key_to_rel_path(parts[-1]) == rel_path:
+            return parts[-1]
+
+        raise ValueError('{} is not where the hashed layout puts any key'.format(rel_path))
+
+
+class DateLayout(FlatLayout):
+    # Files are grouped into directories by year and month, taken from the
+    # first date in the key, eg 2016/12/en/django/2016-12-31.  Every key must
+    # contain a date in the form YYYY-MM-DD.
+    name = 'date'
+
+    DATE_RE = re.compile(r'(\d{4})-(\d{2})-\d{2}')
+
+    def key_to_rel_path(self, key):
+        match = self.DATE_RE.search(key)
+
+        if match is None:
+            raise ValueError('{} does not contain a date, so cannot be used with the date layout'.format(key))
+
+        return '{}/{}/{}'.format(match.group(1), match.group(2), key)
+
+    def rel_path_to_key(self, rel_path):
+        parts = rel_path.split('/', 2)
+
+        if len(parts) == 3:
+            try:
+                if self.key_to_rel_path(parts[2]) == rel_path:
+                    return parts[2]
+            except ValueError:
+                pass
+
+        raise ValueError('{} is not where the date layout puts any key'.format(rel_path))
+
+
+LAYOUTS = {layout.name: layout for layout in [FlatLayout(), HashedLayout(), DateLayout()]}
+
+
+def get_layout(layout):
+    # layout may be None (for the flat layout), the name of a layout, or an
+    # instance of a layout class, eg HashedLayout(levels=1).
+    if layout is None:
+        return LAYOUTS['flat']
+
+    if isinstance(layout, str):
+        try:
+            return LAYOUTS[layout]
+        except KeyError:
+            raise ValueError('Unknown dump layout {!r} (expected one of {})'.format(layout, ', '.join(sorted(LAYOUTS))))
+
+    return layout
@@ -0,0 +1,107 @@
+import cgi
+import codecs
+import html
+import re
+
+
+# Matches, in order of precedence, a comment, a script or style element (whose
+# content is not HTML), or any other start tag.
+HTML_TOKEN_RE = re.compile(
+    rb'<!--.*?-->'
+    rb'|<(script|style)\b([^>]*)>(.*?)</\1\s*>'
+    rb'|<[a-zA-Z][^>]*>',
+    re.DOTALL | re.IGNORECASE
+)
+
+# Matches a link attribute inside a start tag.  The attribute name must follow
+# whitespace, so that eg data-src is not matched.
+HTML_ATTR_RE = re.compile(
+    rb'[\s/](href|src|srcset)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))',
+    re.IGNORECASE
+)
+
+# Matches a comment, a url() or an @import with a string.
+CSS_TOKEN_RE = re.compile(
+    rb'/\*.*?\*/'
+    rb'|\burl\(\s*(?:"([^"]*)"|\'([^\']*)\'|([^)\s]*))\s*\)'
+    rb'|@import\s+(?:"([^"]*)"|\'([^\']*)\')',
+    re.DOTALL | re.IGNORECASE
+)
+
+HTML_CONTENT_TYPES = {'text/html', 'application/xhtml+xml'}
+CSS_CONTENT_TYPES = {'text/css'}
+
+
+def extract_links(content, content_type):
+    # Returns the URLs linked to from content, which are not resolved against
+    # the URL of the page they came from.  Content is scanned as bytes, without
+    # being parsed, and content types that can't contain links (eg images and
+    # JSON) are not scanned at all.
+    mime_type, params = cgi.parse_header(content_type)
+    mime_type = mime_type.lower()
+
+    if mime_type in HTML_CONTENT_TYPES:
+        extract = extract_links_from_html
+    elif mime_type in CSS_CONTENT_TYPES:
+        extract = extract_links_from_css
+    else:
+        return []
+
+    encoding = params.get('charset', 'utf-8')
+
+    try:
+        encoding = codecs.lookup(encoding).name
+    except LookupError:
+        encoding = 'utf-8'
+
+    if encoding.startswith(('utf-16', 'utf-32')):
+        # The patterns only match encodings that are supersets of ASCII.
+        content = content.decode(encoding, errors='replace').encode('utf-8')
+        encoding = 'utf-8'
+
+    return extract(content, encoding)
+
+
+def extract_links_from_html(content, encoding='utf-8'):
+    urls = []
+
+    for match in HTML_TOKEN_RE.finditer(content):
+        tag_name, attrs, element_content = match.groups()
+
+        if tag_name is None:
+            if match.group().startswith(b'<!--'):
+                continue
+            attrs = match.group()
+        elif tag_name.lower() == b'style':
+            urls.extend(extract_links_from_css(element_content, encoding))
+
+        for attr_match in HTML_ATTR_RE.finditer(attrs):
+            name = attr_match.group(1).lower()
+            value = next(group for group in attr_match.groups()[1:] if group is not None)
+            value = value.decode(encoding, errors='replace')
+
+            if '&' in value:
+                value = html.unescape(value)
+
+            if name == b'srcset':
+                for candidate in value.split(','):
+                    candidate = candidate.split()
+                    if candidate:
+                        urls.append(candidate[0])
+            elif value.strip():
+                urls.append(value.strip())
+
+    return urls
+
+
+def extract_links_from_css(content, encoding='utf-8'):
+    urls = []
+
+    for match in CSS_TOKEN_RE.finditer(content):
+        for group in match.groups():
+            if group is not None:
+                if group.strip():
+                    urls.append(group.strip().decode(encoding, errors='replace'))
+                break
+
+    return urls
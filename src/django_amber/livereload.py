@@ -0,0 +1,291 @@
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import socket
+from socketserver import ThreadingMixIn
+import threading
+
+from django.db.models.signals import post_init
+from django.utils.deprecation import MiddlewareMixin
+
+from .models import DjangoPagesModel, get_existing_keys, parse_dump_paths
+from .references import index as reference_index, object_label
+from .server import DEFAULT_ADDR
+
+
+# serve sets this in its environment, so that LiveReloadMiddleware (which runs
+# on the server's threads, in the same process) knows where to tell the
+# browser to listen for events.
+URL_ENV_VAR = 'DJANGO_AMBER_LIVERELOAD_URL'
+
+DEPENDENCIES_HEADER = 'X-Amber-Dependencies'
+
+SCRIPT = '''<script>
+(function () {
+    var dependencies = %(dependencies)s;
+    var source = new EventSource(%(url)s);
+    function intersects(xs, ys) {
+        for (var i = 0; i < xs.length; i++) {
+            if (ys.indexOf(xs[i]) !== -1) {
+                return true;
+            }
+        }
+        return false;
+    }
+    source.addEventListener('reload', function (e) {
+        var data = JSON.parse(e.data);
+        if (intersects(data.objects, dependencies.objects) || intersects(data.models, dependencies.models)) {
+            source.close();
+            window.location.reload();
+        }
+    });
+})();
+</script>
+'''
+
+
+def get_reload_event(changed_paths, missing_paths):
+    # Describes a batch of changes, in terms of the objects that have been
+    # changed or removed, and the models which have had objects added or
+    # removed.  Objects that refer to a removed object are also counted as
+    # changed, since their references to it are removed from the database,
+    # and objects that would be deleted along with it are counted as removed.
+    # This needs to be called before the changes are applied.
+    reference_index.ensure_built()
+
+    objects = set()
+    models = set()
+    keys_by_model = {}
+
+    for model, key, _ in parse_dump_paths(changed_paths):
+        objects.add(object_label(model, key))
+        keys_by_model.setdefault(model, set()).add(key)
+
+    for model, keys in keys_by_model.items():
+        existing_keys = get_existing_keys(model, keys)
+        if keys - existing_keys:
+            models.add(model._meta.label_lower)
+
+    removed = []
+
+    for model, key, _ in parse_dump_paths(missing_paths):
+        removed.append((model, key))
+        objects.add(object_label(model, key))
+        models.add(model._meta.label_lower)
+
+        for referrer_model, referrer_key, _ in reference_index.get_referrers(model, key):
+            objects.add(object_label(referrer_model, referrer_key))
+
+    for model, key in reference_index.find_cascades(removed):
+        objects.add(object_label(model, key))
+        models.add(model._meta.label_lower)
+
+    return {'objects': sorted(objects), 'models': sorted(models)}
+
+
+def json_for_script(value):
+    return json.dumps(value).replace('<', '\\u003c')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingHTTPServerV6(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+class LiveReloadServer:
+    # Serves a stream of Server-Sent Events at /events, with one event for
+    # each batch of changes that serve applies.  addr should be the address
+    # that the site is served on, so that the stream is reachable from
+    # wherever the site is, and from nowhere else.
+    keepalive_interval = 15
+
+    def __init__(self, port, addr=DEFAULT_ADDR):
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=100)
+        self.last_event_id = 0
+        self.running = True
+        server_class = ThreadingHTTPServerV6 if ':' in addr else ThreadingHTTPServer
+        self.httpd = server_class((addr, int(port)), self.make_handler_class())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+
+        if host in ('0.0.0.0', '::'):
+            # Listening on every interface, which includes the loopback one.
+            host = 'localhost'
+        elif ':' in host:
+            host = '[{}]'.format(host)
+
+        return 'http://{}:{}/events'.format(host, port)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def publish(self, data):
+        with self.condition:
+            self.last_event_id += 1
+            self.events.append((self.last_event_id, json.dumps(data)))
+            self.condition.notify_all()
+
+    def wait_for_events(self, last_seen_id):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: not self.running or self.last_event_id > last_seen_id,
+                timeout=self.keepalive_interval,
+            )
+            return [(id, data) for id, data in self.events if id > last_seen_id]
+
+    def make_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/events':
+                    self.send_error(404)
+                    return
+
+                last_seen_id = server.last_event_id
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+
+                try:
+                    while server.running:
+                        events = server.wait_for_events(last_seen_id)
+
+                        if events:
+                            for id, data in events:
+                                self.wfile.write('id: {}\nevent: reload\ndata: {}\n\n'.format(id, data).encode('utf8'))
+                            last_seen_id = events[-1][0]
+                        else:
+                            self.wfile.write(b': keepalive\n\n')
+
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class DependencyTracker:
+    # Records which objects are instantiated while rendering a page.
+    local = threading.local()
+
+    @classmethod
+    def start(cls):
+        cls.local.objects = set()
+        cls.local.models = set()
+
+    @classmethod
+    def stop(cls):
+        dependencies = {
+            'objects': sorted(getattr(cls.local, 'objects', None) or []),
+            'models': sorted(getattr(cls.local, 'models', None) or []),
+        }
+        cls.local.objects = None
+        cls.local.models = None
+        return dependencies
+
+    @classmethod
+    def record(cls, sender, instance, **kwargs):
+        if getattr(cls.local, 'objects', None) is None:
+            return
+
+        if isinstance(instance, DjangoPagesModel):
+            cls.local.models.add(sender._meta.label_lower)
+
+            # Don't trigger a query if the key has been deferred.
+            key = instance.__dict__.get('key')
+            if key is not None:
+                cls.local.objects.add(object_label(sender, key))
+
+
+post_init.connect(DependencyTracker.record)
+
+
+def is_affected(dependencies, event):
+    # Returns whether a page with the given dependencies (as returned by
+    # DependencyTracker.stop) is affected by the changes described by event
+    # (as returned by get_reload_event).  This matches the check made by the
+    # script that LiveReloadMiddleware injects.
+    return bool(
+        set(dependencies['objects']) & set(event['objects']) or
+        set(dependencies['models']) & set(event['models'])
+    )
+
+
+class DependencyHandler:
+    # Wraps a WSGI handler, and adds a header to each response listing the
+    # objects and models it was rendered from.  buildsite --watch uses this to
+    # work out which pages to rebuild when data changes.
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __call__(self, environ, start_response):
+        DependencyTracker.start()
+
+        def start_response_with_dependencies(status, headers, exc_info=None):
+            # Django calls start_response once the response has been rendered.
+            dependencies = DependencyTracker.stop()
+            headers = list(headers) + [(DEPENDENCIES_HEADER, json.dumps(dependencies, separators=(',', ':')))]
+            return start_response(status, headers, exc_info)
+
+        return self.handler(environ, start_response_with_dependencies)
+
+
+class LiveReloadMiddleware(MiddlewareMixin):
+    # Injects a script into HTML pages, which reloads the page when serve
+    # reloads any of the data the page was rendered from.  Does nothing unless
+    # the server was started by `serve --livereload`.
+    def process_request(self, request):
+        if os.environ.get(URL_ENV_VAR):
+            DependencyTracker.start()
+
+    def process_response(self, request, response):
+        url = os.environ.get(URL_ENV_VAR)
+        if not url:
+            return response
+
+        dependencies = DependencyTracker.stop()
+
+        if response.streaming or not response.get('Content-Type', '').startswith('text/html'):
+            return response
+
+        script = SCRIPT % {
+            'dependencies': json_for_script(dependencies),
+            'url': json_for_script(url),
+        }
+
+        content = response.content.decode(response.charset)
+        ix = content.rfind('</body>')
+        if ix == -1:
+            content += script
+        else:
+            content = content[:ix] + script + content[ix:]
+
+        response.content = content.encode(response.charset)
+
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = len(response.content)
+
+        return response
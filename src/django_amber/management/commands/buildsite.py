@@ -1,63 +1,455 @@
+from contextlib import ExitStack
+import json
 import os
-import shutil
-
-import http_crawler
+from time import perf_counter, time
+from urllib.parse import urlparse
 
 from django.conf import settings
 from django.core.management import call_command
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+
+from django_amber import query_cache
+from django_amber.cache import get_cache_dir
+from django_amber.compression import DEFAULT_CONTENT_TYPES, DEFAULT_MIN_SIZE, SUFFIXES, Compressor
+from django_amber.crawler import crawl
+from django_amber.livereload import DEPENDENCIES_HEADER, DependencyHandler, get_reload_event, is_affected
+from django_amber.management.commands.serve import try_apply_changes
+from django_amber.metrics import BuildReport, RenderMetricsHandler
+from django_amber.output import ARCHIVE_SUFFIXES, OutputPathError, get_output_path, open_sink, prepare_output_dir
+from django_amber.profiling import ProfileMixin, span
+from django_amber.server import Server
+from django_amber.sharding import Manifest, RecordingSink, get_manifest_path, get_shard, parse_shard
+from django_amber.static import export_static_files, get_static_url_path
+from django_amber.watchers import ChangeBatch, get_watcher, wait_for_batch
 
-from django_amber.utils import get_free_port, run_runserver_in_process
 
+class Command(ProfileMixin, BaseCommand):
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--output',
+            metavar='PATH',
+            help='Write the site to PATH, which may be a directory, or an archive ending .tar, .tar.gz, .tgz, .tar.zst or .zip (default: output)'
+        )
+        parser.add_argument(
+            '--report',
+            metavar='DIR',
+            help='Write a report of how long each page took to render, and how many queries it made, to DIR'
+        )
+        parser.add_argument(
+            '--cache-queries',
+            action='store_true',
+            help='Cache the results of database queries for the rest of the build'
+        )
+        parser.add_argument(
+            '--dedupe',
+            action='store_true',
+            help='Write files that are identical to an earlier file as hard links'
+        )
+        parser.add_argument(
+            '--export-static',
+            action='store_true',
+            help='Copy all static files to the output directly, instead of crawling them'
+        )
+        parser.add_argument(
+            '--link-static',
+            action='store_true',
+            help='With --export-static, hard link static files into the output instead of copying them'
+        )
+        parser.add_argument(
+            '--compress',
+            metavar='ENCODINGS',
+            help='Also write compressed copies of pages, with each of the given encodings (eg gzip,br,zstd)'
+        )
+        parser.add_argument(
+            '--shard',
+            metavar='INDEX/COUNT',
+            help='Only write the pages that belong to shard INDEX of COUNT (eg 0/4), and write a manifest'
+        )
+        parser.add_argument(
+            '--from-manifest',
+            metavar='PATH',
+            help='Fetch only the pages listed in the manifest at PATH, instead of crawling the site'
+        )
+        parser.add_argument(
+            '--watch',
+            action='store_true',
+            help='After building the site, watch for changes to the data, and rebuild the pages they affect'
+        )
+        parser.add_argument(
+            '--since',
+            metavar='REV',
+            help='Pass --since REV to loadpages, to only load the data files that have changed since REV'
+        )
 
-class Command(BaseCommand):
     def handle(self, *args, **kwargs):
-        port = get_free_port()
+        self.start_time = perf_counter()
+
+        if kwargs.get('shard'):
+            try:
+                shard = parse_shard(kwargs['shard'])
+            except ValueError as e:
+                raise CommandError(e)
+            default_output_path = os.path.join(settings.BASE_DIR, 'output-{}-of-{}'.format(*shard))
+        else:
+            shard = None
+            default_output_path = os.path.join(settings.BASE_DIR, 'output')
+
+        if kwargs.get('from_manifest'):
+            try:
+                manifest_pages = Manifest.read(kwargs['from_manifest']).pages
+            except (OSError, ValueError) as e:
+                raise CommandError('Could not read manifest: {}'.format(e))
+        else:
+            manifest_pages = None
+
+        output_path = kwargs.get('output') or default_output_path
+        report_path = kwargs.get('report')
+        cache_queries = kwargs.get('cache_queries') or getattr(settings, 'DJANGO_AMBER_CACHE_QUERIES', False)
+        watch = kwargs.get('watch', False)
+        self.verbosity = kwargs.get('verbosity', 1)
+
+        if watch:
+            if shard is not None or manifest_pages is not None:
+                raise CommandError('--watch cannot be used with --shard or --from-manifest')
+
+            if output_path.endswith(ARCHIVE_SUFFIXES):
+                raise CommandError('--watch needs the output to be a directory, not an archive')
+
+            # The server can't tell when we write to the database, so cached
+            # results would go stale.
+            cache_queries = False
+
+        if kwargs.get('compress'):
+            encodings = kwargs['compress'].split(',')
+        else:
+            encodings = getattr(settings, 'DJANGO_AMBER_COMPRESS', [])
+
+        dedupe = kwargs.get('dedupe') or getattr(settings, 'DJANGO_AMBER_DEDUPE', False)
+        export_static = kwargs.get('export_static') or getattr(settings, 'DJANGO_AMBER_EXPORT_STATIC', False)
+        link_static = kwargs.get('link_static') or getattr(settings, 'DJANGO_AMBER_LINK_STATIC', False)
+
+        if report_path:
+            report = BuildReport()
+        else:
+            report = None
 
-        p = run_runserver_in_process(port)
+        # The data must be loaded before the server starts, since the server
+        # may cache the results of its queries.
+        if kwargs.get('since'):
+            call_command('loadpages', since=kwargs['since'])
+        else:
+            call_command('loadpages')
+
+        if cache_queries:
+            # Nothing writes to the database once the data has been loaded.
+            query_cache.enable()
 
         try:
-            self.buildsite(port)
+            with span('start server'):
+                server = Server(0, make_handler_wrapper(report is not None, watch))
+                server.start()
+
+            try:
+                self.buildsite(server.port, output_path, report, encodings, dedupe, export_static, shard, manifest_pages,
+                               link_static)
+
+                if watch:
+                    if report is not None:
+                        report.write(report_path)
+                        report = None
+
+                    self.watch(server.port, output_path, encodings, export_static)
+            finally:
+                server.stop()
         finally:
-            p.terminate()
+            if cache_queries:
+                query_cache.disable()
+
+        if report is not None:
+            report.write(report_path)
+
+    def buildsite(self, port, output_path, report=None, encodings=None, dedupe=False, export_static=False,
+                  shard=None, manifest_pages=None, link_static=False):
+        # If shard is given, it is a pair (index, count), and only files that
+        # belong to that shard are written.  If manifest_pages is given, it
+        # maps output paths to URL paths, and only those pages are fetched.
+        try:
+            prepare_output_dir(output_path, settings.BASE_DIR)
+        except OutputPathError as e:
+            raise CommandError(e)
+
+        crawl_options = get_crawl_options(export_static)
+
+        # Fingerprints of every URL that has been crawled, and the
+        # dependencies of every page (if the server reports them), which
+        # --watch uses to rebuild pages.
+        self.seen = crawl_options['seen'] = set()
+        self.dependencies = {}
+        self.time_to_first_page = None
+
+        if shard is None:
+            def in_shard(rel_path):
+                return True
+        else:
+            def in_shard(rel_path):
+                return get_shard(rel_path, shard[1]) == shard[0]
+
+        if manifest_pages is not None:
+            crawl_options['paths'] = [
+                url_path for rel_path, url_path in sorted(manifest_pages.items()) if in_shard(rel_path)
+            ]
+            crawl_options['follow_links'] = False
+
+        if shard is None and manifest_pages is None:
+            manifest = None
+        else:
+            manifest = Manifest(*(shard or (None, None)), pages=dict(manifest_pages or {}))
+
+        rsps = crawl('http://localhost:{}/'.format(port), **crawl_options)
+
+        with ExitStack() as stack:
+            sink, compressor = open_output(stack, output_path, encodings, dedupe, manifest is not None, link_static)
+
+            if export_static:
+                with span('export static'):
+                    export_static_files(sink, compressor, in_shard)
+
+            while True:
+                with span('crawl'):
+                    rsp = next(rsps, None)
+
+                if rsp is None:
+                    break
+
+                rsp.raise_for_status()
+
+                parsed_url = urlparse(rsp.url)
+
+                if parsed_url.netloc != 'localhost:{}'.format(port):
+                    # This is an external request, which we don't care about
+                    continue
+
+                path = parsed_url.path
+                rel_path = get_output_path(path)
+
+                if manifest is not None:
+                    manifest.pages[rel_path] = path
+
+                if DEPENDENCIES_HEADER in rsp.headers:
+                    self.dependencies[path] = json.loads(rsp.headers[DEPENDENCIES_HEADER])
+
+                if not in_shard(rel_path):
+                    # Another shard writes this page, but we still need to
+                    # crawl it to find its links.
+                    continue
+
+                with span('write'):
+                    sink.write(rel_path, rsp.content)
+
+                if self.time_to_first_page is None:
+                    self.record_time_to_first_page(report)
+
+                if compressor is not None:
+                    with span('compress'):
+                        compressor.compress(rel_path, rsp.content, rsp.headers.get('Content-Type', ''))
+
+                if report is not None:
+                    report.add_page(path, rel_path, rsp)
+
+            cname = getattr(settings, 'DJANGO_AMBER_CNAME', None)
+
+            if cname and in_shard('CNAME'):
+                sink.write('CNAME', cname.encode('utf8'))
 
-    def buildsite(self, port):
-        call_command('loadpages')
+        if report is not None and dedupe:
+            report.dedupe_stats = sink.dedupe_stats
 
-        output_path = os.path.join(settings.BASE_DIR, 'output')
-        shutil.rmtree(output_path, ignore_errors=True)
+        if manifest is not None:
+            manifest.files = sink.rel_paths
+            manifest.write(get_manifest_path(output_path))
 
-        crawl_options = getattr(settings, 'DJANGO_AMBER_CRAWL_OPTIONS', {})
+    def record_time_to_first_page(self, report=None):
+        # This measures how long it takes for the command to get going, which
+        # is most of the wait for a small site.
+        self.time_to_first_page = perf_counter() - self.start_time
 
-        for rsp in http_crawler.crawl('http://localhost:{}/'.format(port), **crawl_options):
-            rsp.raise_for_status()
+        if report is not None:
+            report.time_to_first_page = self.time_to_first_page
 
-            parsed_url = http_crawler.urlparse(rsp.url)
+        if self.verbosity > 1:
+            self.stdout.write('Wrote first page after {:.3f}s'.format(self.time_to_first_page))
+
+    def watch(self, port, output_path, encodings=None, export_static=False):
+        watcher = get_watcher()
+        quiet_period = getattr(settings, 'DJANGO_AMBER_RELOAD_DEBOUNCE', 0.05)
+        batch = ChangeBatch()
+
+        if self.verbosity > 0:
+            self.stdout.write('Watching for changes')
+
+        try:
+            while True:
+                try:
+                    wait_for_batch(watcher, batch, quiet_period)
+                except KeyboardInterrupt:
+                    break
+
+                if batch and self.rebuild_batch(batch, port, output_path, encodings, export_static):
+                    batch = ChangeBatch()
+        finally:
+            watcher.close()
+
+    def rebuild_batch(self, batch, port, output_path, encodings=None, export_static=False):
+        # Applies a batch of changes to the database, as serve does, and then
+        # rebuilds the pages that depend on any of the changed objects.
+        start = time()
+        event = get_reload_event(batch.changed_paths, batch.missing_paths)
+
+        with span('reload'):
+            _, error = try_apply_changes(batch)
+
+        if error is not None:
+            self.stderr.write(error)
+            return False
+
+        paths = sorted(path for path, dependencies in self.dependencies.items() if is_affected(dependencies, event))
+
+        crawl_options = get_crawl_options(export_static)
+        crawl_options['paths'] = paths
+        crawl_options['seen'] = self.seen
+        rsps = crawl('http://localhost:{}/'.format(port), **crawl_options)
+
+        num_written = num_removed = 0
+
+        with ExitStack() as stack:
+            sink, compressor = open_output(stack, output_path, encodings)
+
+            for rsp in rsps:
+                parsed_url = urlparse(rsp.url)
+                path = parsed_url.path
+
+                if parsed_url.netloc == 'localhost:{}'.format(port):
+                    rel_path = get_output_path(path)
+
+                    if rsp.status_code == 404 and path in self.dependencies:
+                        # The page's object has been removed.
+                        remove_page(output_path, rel_path)
+                        del self.dependencies[path]
+                        num_removed += 1
+                        continue
+
+                if rsp.status_code >= 400:
+                    # Unlike a full build, we carry on, so that fixing the
+                    # data fixes the output.
+                    self.stderr.write('{} {} for url: {}'.format(rsp.status_code, rsp.reason, rsp.url))
+                    continue
+
+                if parsed_url.netloc != 'localhost:{}'.format(port):
+                    continue
+
+                if DEPENDENCIES_HEADER in rsp.headers:
+                    self.dependencies[path] = json.loads(rsp.headers[DEPENDENCIES_HEADER])
+
+                # Any compressed copies of the old page would be stale.
+                remove_page(output_path, rel_path, compressed_only=True)
+
+                sink.write(rel_path, rsp.content)
+                num_written += 1
+
+                if compressor is not None:
+                    compressor.compress(rel_path, rsp.content, rsp.headers.get('Content-Type', ''))
+
+        if self.verbosity > 0:
+            self.stdout.write('Rebuilt {} and removed {} pages for {} changed and {} removed files in {:.3f}s'.format(
+                num_written,
+                num_removed,
+                len(batch.changed_paths),
+                len(batch.missing_paths),
+                time() - start,
+            ))
+
+        return True
+
+
+def get_crawl_options(export_static):
+    crawl_options = dict(getattr(settings, 'DJANGO_AMBER_CRAWL_OPTIONS', {}))
+
+    if export_static:
+        # Static files are exported directly, so there's no need to crawl
+        # them.
+        static_url_path = get_static_url_path()
+        crawl_options['skip_paths'] = tuple(crawl_options.get('skip_paths', ())) + (static_url_path,)
+
+    return crawl_options
+
+
+def open_output(stack, output_path, encodings=None, dedupe=False, record=False, link_files=False):
+    # Returns a sink for output_path, and a compressor (or None, if encodings
+    # is empty), both of which are closed when stack is.
+    sink = stack.enter_context(open_sink(
+        output_path,
+        max_workers=getattr(settings, 'DJANGO_AMBER_OUTPUT_THREADS', 4),
+        max_pending=getattr(settings, 'DJANGO_AMBER_OUTPUT_MAX_PENDING', 64),
+        dedupe=dedupe,
+        link_files=link_files,
+    ))
+
+    if record:
+        sink = RecordingSink(sink)
+
+    if encodings:
+        # This is closed before the sink, so that the sink can finish
+        # writing the compressed files.
+        compressor = stack.enter_context(Compressor(
+            sink,
+            encodings,
+            content_types=getattr(settings, 'DJANGO_AMBER_COMPRESS_CONTENT_TYPES', DEFAULT_CONTENT_TYPES),
+            min_size=getattr(settings, 'DJANGO_AMBER_COMPRESS_MIN_SIZE', DEFAULT_MIN_SIZE),
+            cache_dir=get_cache_dir('compressed'),
+        ))
+    else:
+        compressor = None
+
+    return sink, compressor
+
+
+def remove_page(output_path, rel_path, compressed_only=False):
+    # Removes a page, and any compressed copies of it, from the output
+    # directory, along with any directories that this leaves empty.
+    rel_paths = [rel_path + suffix for suffix in SUFFIXES.values()]
+    if not compressed_only:
+        rel_paths.append(rel_path)
+
+    for path in rel_paths:
+        try:
+            os.remove(os.path.join(output_path, path))
+        except FileNotFoundError:
+            pass
+
+    if compressed_only:
+        return
+
+    dir_path = os.path.dirname(os.path.join(output_path, rel_path))
+    while os.path.abspath(dir_path) != os.path.abspath(output_path):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            # The directory isn't empty.
+            break
+        dir_path = os.path.dirname(dir_path)
 
-            if parsed_url.netloc != 'localhost:{}'.format(port):
-                # This is an external request, which we don't care about
-                continue
 
-            path = parsed_url.path
-            segments = path.split('/')
-            assert segments[0] == ''
-            if segments[-1] == '':
-                rel_dir_path = os.path.join(*segments[:-1])
-                filename = 'index.html'
-            elif '.' in segments[-1]:
-                rel_dir_path = os.path.join(*segments[:-1])
-                filename = segments[-1]
-            else:
-                rel_dir_path = os.path.join(*segments)
-                filename = 'index.html'
+def make_handler_wrapper(render_metrics, track_dependencies=False):
+    # Returns a function that is called with the server's WSGI handler, and
+    # returns the handler to use instead.
+    def wrap_handler(handler):
+        if render_metrics:
+            handler = RenderMetricsHandler(handler)
 
-            dir_path = os.path.join(output_path, rel_dir_path)
-            os.makedirs(dir_path, exist_ok=True)
-            with open(os.path.join(dir_path, filename), 'wb') as f:
-                f.write(rsp.content)
+        if track_dependencies:
+            handler = DependencyHandler(handler)
 
-        cname = getattr(settings, 'DJANGO_AMBER_CNAME', None)
+        return handler
 
-        if cname:
-            with open(os.path.join(output_path, 'CNAME'), 'w') as f:
-                f.write(cname)
+    return wrap_handler
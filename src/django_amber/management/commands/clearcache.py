@@ -0,0 +1,37 @@
+import os
+import shutil
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...cache import CACHE_NAMES, get_cache_dir
+
+
+class Command(BaseCommand):
+    help = 'Remove rendered content and compressed files cached by earlier builds'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names',
+            metavar='NAME',
+            nargs='*',
+            help='Only clear these caches: {} (default: all)'.format(' or '.join(CACHE_NAMES))
+        )
+
+    def handle(self, *args, **kwargs):
+        verbosity = kwargs.get('verbosity', 1)
+        names = kwargs.get('names') or CACHE_NAMES
+
+        unknown_names = set(names) - set(CACHE_NAMES)
+        if unknown_names:
+            raise CommandError('Unknown caches: {}'.format(', '.join(sorted(unknown_names))))
+
+        for name in names:
+            cache_dir = get_cache_dir(name)
+
+            if cache_dir is None or not os.path.isdir(cache_dir):
+                continue
+
+            shutil.rmtree(cache_dir)
+
+            if verbosity > 1:
+                self.stdout.write('Removed {}'.format(cache_dir))
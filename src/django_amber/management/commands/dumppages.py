@@ -3,12 +3,19 @@ import shutil
 from django.core.management.base import BaseCommand
 
 from ...models import DjangoPagesModel
+from ...profiling import ProfileMixin, span
 from ...serialization_helpers import dump_to_file
 
 
-class Command(BaseCommand):
+class Command(ProfileMixin, BaseCommand):
     def handle(self, *args, **kwargs):
         for model in DjangoPagesModel.subclasses():
-            shutil.rmtree(model.get_dump_dir_path(), ignore_errors=True)
-            for obj in model.objects.all():
-                dump_to_file(obj)
+            with span('remove files'):
+                shutil.rmtree(model.get_dump_dir_path(), ignore_errors=True)
+
+            # Objects are fetched as they are dumped, rather than all being
+            # loaded into memory first, so this includes the time spent
+            # querying.
+            with span('dump'):
+                for obj in model.objects.iterator():
+                    dump_to_file(obj)
@@ -1,20 +1,63 @@
 from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
 
+from ...git import GitError, get_changes_since
 from ...models import DjangoPagesModel
+from ...profiling import ProfileMixin, span
+from ...references import CascadingDeleteError, index as reference_index
 from ...serialization_helpers import find_file_paths_in_dir, load_from_file, LoadFromFileError
+from .serve import apply_changes
 
 
-class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
-        call_command('migrate')
+class Command(ProfileMixin, BaseCommand):
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--since',
+            metavar='REV',
+            help='Only load the files that git says have changed since REV, into a database that already holds the data as of REV'
+        )
 
-        paths = []
+    def handle(self, *args, **kwargs):
+        since = kwargs.get('since')
+        verbosity = kwargs.get('verbosity', 1)
 
-        for model in DjangoPagesModel.subclasses():
-            paths.extend(find_file_paths_in_dir(model.get_dump_dir_path()))
+        with span('migrate'):
+            call_command('migrate')
 
         try:
-            load_from_file(paths)
+            if since:
+                with span('find changes'):
+                    try:
+                        changed_paths, missing_paths = get_changes_since(since)
+                    except GitError as e:
+                        raise CommandError(e)
+
+                with span('load'):
+                    try:
+                        apply_changes(changed_paths, missing_paths)
+                    except CascadingDeleteError as e:
+                        raise CommandError(e)
+
+                if verbosity > 1:
+                    self.stdout.write('Loaded {} changed and removed {} files since {}'.format(
+                        len(changed_paths),
+                        len(missing_paths),
+                        since,
+                    ))
+            else:
+                paths = []
+
+                with span('find files'):
+                    for model in DjangoPagesModel.subclasses():
+                        paths.extend(find_file_paths_in_dir(model.get_dump_dir_path()))
+
+                # The index is filled as the files are loaded.
+                reference_index.clear()
+
+                with span('load'):
+                    load_from_file(paths)
+
+                reference_index.built = True
         except LoadFromFileError as e:
             raise CommandError('Hit error ({}: {}) when loading data from {}'.format(type(e.original_exception), e.original_exception, e.path))
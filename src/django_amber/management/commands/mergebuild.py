@@ -0,0 +1,88 @@
+from contextlib import ExitStack
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...output import OutputPathError, open_sink, prepare_output_dir
+from ...profiling import ProfileMixin, span
+from ...sharding import Manifest, check_manifests, get_manifest_path, open_shard
+
+
+class Command(ProfileMixin, BaseCommand):
+    help = 'Combine the outputs of a build that was sharded with `buildsite --shard`'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            'shard_paths',
+            metavar='SHARD',
+            nargs='+',
+            help='The output of a shard, as given to `buildsite --output`'
+        )
+        parser.add_argument(
+            '--output',
+            metavar='PATH',
+            help='Write the combined site to PATH, which may be a directory or an archive (default: output)'
+        )
+
+    def handle(self, *args, **kwargs):
+        output_path = kwargs.get('output') or os.path.join(settings.BASE_DIR, 'output')
+
+        with span('check manifests'):
+            manifests = []
+            for shard_path in kwargs['shard_paths']:
+                try:
+                    manifests.append(Manifest.read(get_manifest_path(shard_path)))
+                except (OSError, ValueError) as e:
+                    raise CommandError('Could not read manifest for {}: {}'.format(shard_path, e))
+
+            problems = check_manifests(manifests)
+            if problems:
+                raise CommandError('Shards cannot be merged:\n' + '\n'.join(problems))
+
+        shards = sorted(zip(manifests, kwargs['shard_paths']), key=lambda pair: pair[0].shard)
+
+        real_output_path = os.path.realpath(output_path)
+        for manifest, shard_path in shards:
+            real_shard_path = os.path.realpath(shard_path)
+            if os.path.commonpath([real_output_path, real_shard_path]) in (real_output_path, real_shard_path):
+                raise CommandError('Cannot write to {}, since it overlaps with the shard {}'.format(output_path, shard_path))
+
+        with ExitStack() as stack:
+            # Every shard is checked before anything is written, so that a
+            # problem with any shard leaves the output as it was.
+            with span('check shards'):
+                opened = []
+                problems = []
+
+                for manifest, shard_path in shards:
+                    shard = stack.enter_context(open_shard(shard_path))
+                    opened.append((manifest, shard))
+
+                    expected = set(manifest.files)
+                    found = shard.list_files()
+
+                    problems.extend('{} is missing from {}'.format(rel_path, shard_path) for rel_path in sorted(expected - found))
+                    problems.extend('{} in {} is not in its manifest'.format(rel_path, shard_path) for rel_path in sorted(found - expected))
+
+                if problems:
+                    raise CommandError('Shards cannot be merged:\n' + '\n'.join(problems))
+
+            try:
+                prepare_output_dir(output_path, settings.BASE_DIR)
+            except OutputPathError as e:
+                raise CommandError(e)
+
+            merged = Manifest()
+
+            with open_sink(output_path, max_workers=getattr(settings, 'DJANGO_AMBER_OUTPUT_THREADS', 4)) as sink:
+                for manifest, shard in opened:
+                    with span('merge shard'):
+                        for rel_path in manifest.files:
+                            shard.copy_file(rel_path, sink)
+
+                    merged.pages.update(manifest.pages)
+                    merged.files.extend(manifest.files)
+
+        merged.write(get_manifest_path(output_path))
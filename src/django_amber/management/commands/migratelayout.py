@@ -0,0 +1,117 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...layouts import FlatLayout, get_layout
+from ...models import DjangoPagesModel
+from ...profiling import ProfileMixin, span
+from ...serialization_helpers import find_file_paths_in_dir
+
+
+class Command(ProfileMixin, BaseCommand):
+    help = "Move each model's data files to where its dump_layout puts them"
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            'models',
+            metavar='APP_LABEL.MODEL_NAME',
+            nargs='*',
+            help='Only move the files of these models (default: all models)'
+        )
+        parser.add_argument(
+            '--from',
+            dest='from_layout',
+            metavar='LAYOUT',
+            default='flat',
+            help='The layout the files are in now: flat, hashed or date (default: flat)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='List the files that would be moved, without moving them'
+        )
+
+    def handle(self, *args, **kwargs):
+        verbosity = kwargs.get('verbosity', 1)
+        labels = set(kwargs.get('models') or [])
+
+        try:
+            from_layout = get_layout(kwargs.get('from_layout'))
+        except ValueError as e:
+            raise CommandError(e)
+
+        models = [
+            model for model in DjangoPagesModel.subclasses()
+            if not labels or model._meta.label_lower in labels
+        ]
+
+        unknown_labels = labels - {model._meta.label_lower for model in models}
+        if unknown_labels:
+            raise CommandError('Unknown models: {}'.format(', '.join(sorted(unknown_labels))))
+
+        # Every move is worked out before anything is moved, so that a problem
+        # with any file leaves the tree as it was.
+        with span('plan'):
+            moves = []
+            for model in models:
+                moves.extend(self.get_moves(model, from_layout))
+
+        if kwargs.get('dry_run'):
+            for old_path, new_path in moves:
+                self.stdout.write('{} -> {}'.format(old_path, new_path))
+            return
+
+        with span('move'):
+            for old_path, new_path in moves:
+                # This creates the new path's directories, and removes any of
+                # the old path's that are left empty.
+                os.renames(old_path, new_path)
+
+        if verbosity > 0:
+            self.stdout.write('Moved {} files'.format(len(moves)))
+
+    def get_moves(self, model, from_layout):
+        dir_path = model.get_dump_dir_path()
+        to_layout = model.get_dump_layout()
+        moves = []
+        new_paths = set()
+
+        for path in find_file_paths_in_dir(dir_path):
+            rel_path, content_format_with_dot = os.path.splitext(os.path.relpath(path, dir_path))
+            rel_path = rel_path.replace(os.sep, '/')
+
+            # Files that are already where the new layout puts them are left
+            # alone, so that an interrupted migration can be run again.  Any
+            # path fits the flat layout, so that is tried last.
+            candidates = [(to_layout, False), (from_layout, True)]
+            if type(to_layout) is FlatLayout:
+                candidates.reverse()
+
+            for layout, needs_move in candidates:
+                try:
+                    key = layout.rel_path_to_key(rel_path)
+                    break
+                except ValueError:
+                    pass
+            else:
+                raise CommandError('{} is not in the {} layout or the {} layout'.format(path, from_layout.name, to_layout.name))
+
+            if not needs_move:
+                continue
+
+            try:
+                new_path = model.get_dump_path(key, content_format_with_dot[1:])
+            except ValueError as e:
+                raise CommandError('Cannot move {}: {}'.format(path, e))
+
+            if new_path == path:
+                continue
+
+            if os.path.exists(new_path) or new_path in new_paths:
+                raise CommandError('Cannot move {} to {}, since there is already a file there'.format(path, new_path))
+
+            new_paths.add(new_path)
+            moves.append((path, new_path))
+
+        return moves
@@ -1,103 +1,206 @@
 import os
-from time import sleep
+from time import time
 
+from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from django.core.management.commands.runserver import Command as RunserverCommand
-
-from ...serialization_helpers import find_file_paths_in_dir, load_from_file
-from ...models import DjangoPagesModel, parse_dump_path
-from ...utils import run_runserver_in_process
-
-
-def load_changed(changed_paths):
-    load_from_file(changed_paths)
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, transaction
+
+from ...livereload import get_reload_event, LiveReloadServer, URL_ENV_VAR
+from ...models import get_existing_keys, parse_dump_paths
+from ...profiling import ProfileMixin, span
+from ...references import CascadingDeleteError, index as reference_index, object_label
+from ...serialization_helpers import delete_for_paths, load_from_file, LoadFromFileError
+from ...server import DEFAULT_PORT, Server, parse_addrport
+from ...shadow import shadow_database, shadow_supported
+from ...watchers import ChangeBatch, compare_mtimes, get_mtimes, get_watcher, wait_for_batch  # noqa
+
+
+def load_changed(changed_paths, using=DEFAULT_DB_ALIAS):
+    load_from_file(changed_paths, using=using)
+
+
+def remove_missing(missing_paths, using=DEFAULT_DB_ALIAS):
+    # Deleting an object also deletes any objects that refer to it through a
+    # foreign key whose on_delete is CASCADE, even though their files still
+    # exist.  Returns those objects, as (model, key) pairs.  If
+    # DJANGO_AMBER_ALLOW_CASCADING_DELETES is False, nothing is deleted, and
+    # serve retries the changes with the next batch (which might update or
+    # remove those files too).
+    reference_index.ensure_built(using)
+
+    cascaded = reference_index.find_cascades((model, key) for model, key, _ in parse_dump_paths(missing_paths))
+    if cascaded and not getattr(settings, 'DJANGO_AMBER_ALLOW_CASCADING_DELETES', True):
+        raise CascadingDeleteError(cascaded)
+
+    delete_for_paths(missing_paths, using=using)
+    return cascaded
+
+
+def get_referrer_paths(changed_paths, missing_paths, using=DEFAULT_DB_ALIAS):
+    # Returns the paths of files that refer to objects that changed_paths will
+    # add.  If such an object was removed earlier, the references to it were
+    # removed from the database too, so these files need to be loaded again.
+    keys_by_model = {}
+    for model, key, _ in parse_dump_paths(changed_paths):
+        keys_by_model.setdefault(model, set()).add(key)
+
+    seen_paths = set(changed_paths) | set(missing_paths)
+    paths = []
+
+    for model, keys in keys_by_model.items():
+        existing_keys = get_existing_keys(model, keys, using)
+
+        for key in keys - existing_keys:
+            for referrer_model, referrer_key, _ in reference_index.get_referrers(model, key):
+                path = reference_index.get_path(referrer_model, referrer_key)
+                if path not in seen_paths:
+                    seen_paths.add(path)
+                    paths.append(path)
+
+    return paths
+
+
+def apply_changes(changed_paths, missing_paths, using=DEFAULT_DB_ALIAS):
+    reference_index.ensure_built(using)
+
+    with transaction.atomic(using=using), reference_index.atomic():
+        referrer_paths = get_referrer_paths(changed_paths, missing_paths, using=using)
+        load_changed(list(changed_paths) + referrer_paths, using=using)
+        return remove_missing(missing_paths, using=using)
+
+
+def try_apply_changes(batch, shadow=False):
+    # Applies a batch of changes, as apply_changes does, in a shadow database
+    # if shadow is True.  Returns a pair (cascaded, error), where error is a
+    # message saying why the batch couldn't be applied, or None.  If there is
+    # an error, the whole batch has been rolled back, and the caller should
+    # keep hold of it and try again once the next change comes in.
+    try:
+        if shadow:
+            with shadow_database() as using:
+                return apply_changes(batch.changed_paths, batch.missing_paths, using=using), None
+        else:
+            return apply_changes(batch.changed_paths, batch.missing_paths), None
+    except LoadFromFileError as e:
+        return [], 'Hit error ({}: {}) when loading data from {}'.format(type(e.original_exception), e.original_exception, e.path)
+    except CascadingDeleteError as e:
+        return [], str(e)
+    except DatabaseError as e:
+        # Eg deleting an object that another object refers to through a
+        # foreign key whose on_delete is PROTECT.
+        return [], 'Hit error ({}: {}) when applying changes'.format(type(e), e)
+
+
+class Command(ProfileMixin, BaseCommand):
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            'port',
+            nargs='?',
+            default=DEFAULT_PORT,
+            help='Optional port number, or ipaddr:port'
+        )
+        parser.add_argument(
+            '--livereload',
+            action='store_true',
+            help='Tell open pages to reload when the data they show changes'
+        )
+        parser.add_argument(
+            '--livereload-port',
+            help='Port for the live reload event stream (by default, any free port)'
+        )
 
-    # TODO  Decide what to do if loading data raises DeserializationError.
+    def handle(self, *args, **kwargs):
+        port = kwargs.get('port')
+        self.verbosity = kwargs.get('verbosity', 1)
 
+        call_command('loadpages')
 
-def remove_missing(missing_paths):
-    for path in missing_paths:
-        model, key, _ = parse_dump_path(path)
+        addr, port = parse_addrport(port)
 
-        instance = model.objects.get_by_natural_key(key)
-        instance.delete()
+        self.livereload_server = None
+        if kwargs.get('livereload'):
+            self.livereload_server = LiveReloadServer(kwargs.get('livereload_port') or 0, addr)
+            self.livereload_server.start()
+            # The server runs in this process, and LiveReloadMiddleware reads
+            # the URL from the environment.
+            os.environ[URL_ENV_VAR] = self.livereload_server.url
 
-    # TODO  Decide what to do if deleting the object causes cascading
-    # deletes.  Options:
-    #  * do nothing, leaving data on filesystem in inconsistent state;
-    #  * roll back and raise exception;
-    #  * remove related files from filesystem.
+        with span('start server'):
+            server = Server(port, addr=addr)
+            server.start()
 
+        if self.verbosity > 0:
+            self.stdout.write('Serving at http://{}:{}/\nQuit the server with CONTROL-C.'.format(
+                '[{}]'.format(server.addr) if ':' in server.addr else server.addr,
+                server.port,
+            ))
 
-def get_mtimes():
-    mtimes = {}
+        try:
+            self.serve()
+        finally:
+            server.stop()
 
-    for model in DjangoPagesModel.subclasses():
-        for path in find_file_paths_in_dir(model.get_dump_dir_path()):
-            try:
-                stat = os.stat(path)
-                mtimes[path] = stat.st_mtime
-            except FileNotFoundError:
-                # Race condition: the file has disappeared in the time between
-                # the glob and the stat.
-                pass
+            if self.livereload_server is not None:
+                self.livereload_server.stop()
+                del os.environ[URL_ENV_VAR]
 
-    return mtimes
+        print()
 
+    def serve(self):
+        watcher = get_watcher()
+        quiet_period = getattr(settings, 'DJANGO_AMBER_RELOAD_DEBOUNCE', 0.05)
+        self.shadow_threshold = getattr(settings, 'DJANGO_AMBER_SHADOW_RELOAD_THRESHOLD', 100)
+        batch = ChangeBatch()
 
-def compare_mtimes(old_mtimes, new_mtimes):
-    changed_paths = []
-    missing_paths = []
+        try:
+            while True:
+                try:
+                    wait_for_batch(watcher, batch, quiet_period)
+                except KeyboardInterrupt:
+                    break
+
+                if batch and self.apply_batch(batch):
+                    batch = ChangeBatch()
+        finally:
+            watcher.close()
 
-    for path, old_mtime in old_mtimes.items():
-        new_mtime = new_mtimes.get(path)
-        if new_mtime is None:
-            missing_paths.append(path)
-        elif new_mtime != old_mtime:
-            changed_paths.append(path)
+    def apply_batch(self, batch):
+        changed_paths = batch.changed_paths
+        missing_paths = batch.missing_paths
 
-    for path in new_mtimes:
-        if path not in old_mtimes:
-            changed_paths.append(path)
+        start = time()
 
-    return changed_paths, missing_paths
+        if self.livereload_server is not None:
+            event = get_reload_event(changed_paths, missing_paths)
 
+        with span('reload'):
+            cascaded, error = try_apply_changes(batch, self.use_shadow_database(batch))
 
-class Command(BaseCommand):
-    def add_arguments(self, parser):
-        parser.add_argument(
-            'port',
-            nargs='?',
-            default=RunserverCommand.default_port,
-            help='Optional port number'
-        )
+        if error is not None:
+            self.stderr.write(error)
+            return False
 
-    def handle(self, *args, **kwargs):
-        port = kwargs.get('port')
+        if self.livereload_server is not None:
+            self.livereload_server.publish(event)
 
-        call_command('loadpages')
+        if self.verbosity > 0:
+            self.stdout.write('Reloaded {} changed and {} removed files in {:.3f}s'.format(
+                len(changed_paths),
+                len(missing_paths),
+                time() - start,
+            ))
 
-        p = run_runserver_in_process(port)
+            if cascaded:
+                self.stdout.write('Also deleted {}, whose files still exist'.format(
+                    ', '.join(object_label(model, key) for model, key in cascaded)
+                ))
 
-        try:
-            self.serve()
-        finally:
-            p.terminate()
+        return True
 
-        print()
+    def use_shadow_database(self, batch):
+        if self.shadow_threshold is None or len(batch) < self.shadow_threshold:
+            return False
 
-    def serve(self):
-        mtimes = get_mtimes()
-
-        while True:
-            try:
-                sleep(0.1)
-            except KeyboardInterrupt:
-                break
-
-            new_mtimes = get_mtimes()
-            changed_paths, missing_paths = compare_mtimes(mtimes, new_mtimes)
-            load_changed(changed_paths)
-            remove_missing(missing_paths)
-            mtimes = new_mtimes
+        return shadow_supported()
@@ -0,0 +1,102 @@
+import csv
+import json
+import os
+from time import perf_counter
+
+from django.db import connections
+
+
+RENDER_TIME_HEADER = 'X-Amber-Render-Time'
+QUERY_COUNT_HEADER = 'X-Amber-Query-Count'
+QUERY_TIME_HEADER = 'X-Amber-Query-Time'
+
+
+class RenderMetricsHandler:
+    # Wraps a WSGI handler, and adds headers to each response saying how long
+    # the response took to render, and how many queries were made.
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __call__(self, environ, start_response):
+        for connection in connections.all():
+            connection.force_debug_cursor = True
+            connection.queries_log.clear()
+
+        start = perf_counter()
+
+        def start_response_with_metrics(status, headers, exc_info=None):
+            # Django calls start_response once the response has been rendered.
+            render_time = perf_counter() - start
+            queries = [query for connection in connections.all() for query in connection.queries_log]
+            query_time = sum(float(query['time']) for query in queries)
+
+            headers = list(headers) + [
+                (RENDER_TIME_HEADER, '{:.6f}'.format(render_time)),
+                (QUERY_COUNT_HEADER, str(len(queries))),
+                (QUERY_TIME_HEADER, '{:.6f}'.format(query_time)),
+            ]
+
+            return start_response(status, headers, exc_info)
+
+        return self.handler(environ, start_response_with_metrics)
+
+
+class BuildReport:
+    fields = ['url', 'output_path', 'status', 'size', 'render_seconds', 'query_count', 'query_seconds']
+    num_worst_pages = 20
+
+    def __init__(self):
+        self.pages = []
+        self.dedupe_stats = None
+        self.time_to_first_page = None
+
+    def add_page(self, url, output_path, rsp):
+        headers = rsp.headers
+
+        self.pages.append({
+            'url': url,
+            'output_path': output_path,
+            'status': rsp.status_code,
+            'size': len(rsp.content),
+            'render_seconds': float(headers.get(RENDER_TIME_HEADER, 0)),
+            'query_count': int(headers.get(QUERY_COUNT_HEADER, 0)),
+            'query_seconds': float(headers.get(QUERY_TIME_HEADER, 0)),
+        })
+
+    def summary(self):
+        return {
+            'num_pages': len(self.pages),
+            'total_size': sum(page['size'] for page in self.pages),
+            'total_render_seconds': sum(page['render_seconds'] for page in self.pages),
+            'total_query_count': sum(page['query_count'] for page in self.pages),
+            'total_query_seconds': sum(page['query_seconds'] for page in self.pages),
+            'time_to_first_page_seconds': self.time_to_first_page,
+        }
+
+    def worst_pages(self, field):
+        pages = sorted(self.pages, key=lambda page: page[field], reverse=True)
+        return [page['url'] for page in pages[:self.num_worst_pages]]
+
+    def as_dict(self):
+        report = {
+            'summary': self.summary(),
+            'slowest_pages': self.worst_pages('render_seconds'),
+            'most_queries_pages': self.worst_pages('query_count'),
+            'pages': self.pages,
+        }
+
+        if self.dedupe_stats is not None:
+            report['dedupe'] = self.dedupe_stats
+
+        return report
+
+    def write(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+
+        with open(os.path.join(dir_path, 'build-report.json'), 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+        with open(os.path.join(dir_path, 'build-report.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, self.fields)
+            writer.writeheader()
+            writer.writerows(self.pages)
@@ -3,7 +3,20 @@ import re
 
 from django.apps import apps
 from django.conf import settings
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, models
+
+from .layouts import get_layout
+from .rendering import render_content
+
+
+KEY_FIELD_RE = re.compile(r'\[(\w*)\]')
+
+
+def key_structure_index(key_structure):
+    # Returns an index on the fields that make up keys with the given
+    # structure, for a model's Meta.indexes.  Models with a key_structure are
+    # often queried by these fields (eg an article's language and slug).
+    return models.Index(fields=KEY_FIELD_RE.findall(key_structure))
 
 
 class PagesManager(models.Manager):
@@ -19,6 +32,7 @@ class DjangoPagesModel(models.Model):
 
     dump_dir_path = None
     key_structure = None
+    dump_layout = None
 
     @classmethod
     def get_dump_dir_path(cls):
@@ -28,6 +42,15 @@ class DjangoPagesModel(models.Model):
         else:
             return os.path.join(settings.BASE_DIR, *cls.dump_dir_path.split('/'))
 
+    @classmethod
+    def get_dump_layout(cls):
+        return get_layout(cls.dump_layout)
+
+    @classmethod
+    def get_dump_path(cls, key, content_format):
+        rel_path = cls.get_dump_layout().key_to_rel_path(key)
+        return os.path.join(cls.get_dump_dir_path(), *rel_path.split('/')) + '.' + content_format
+
     @classmethod
     def subclasses(cls):
         for app_config in apps.get_app_configs():
@@ -49,13 +72,13 @@ class DjangoPagesModel(models.Model):
 
     @classmethod
     def field_names_from_key_structure(cls):
-        return re.findall('\[(\w*)\]', cls.key_structure)
+        return KEY_FIELD_RE.findall(cls.key_structure)
 
     def dump_path(self):
         if not self.key:
             self.set_key()
 
-        return os.path.join(self.get_dump_dir_path(), *self.key.split('/')) + '.' + self.content_format
+        return self.get_dump_path(self.key, self.content_format)
 
     def natural_key(self):
         return (self.key,)
@@ -79,7 +102,7 @@ class DjangoPagesModel(models.Model):
 
 
 class ModelWithoutContent(DjangoPagesModel):
-    key = models.CharField(max_length=255)
+    key = models.CharField(max_length=255, unique=True)
 
     content_format = 'yml'
 
@@ -90,7 +113,7 @@ class ModelWithoutContent(DjangoPagesModel):
 
 
 class ModelWithContent(DjangoPagesModel):
-    key = models.CharField(max_length=255)
+    key = models.CharField(max_length=255, unique=True)
     content = models.TextField()
     content_format = models.CharField(max_length=255)
 
@@ -99,13 +122,51 @@ class ModelWithContent(DjangoPagesModel):
     class Meta:
         abstract = True
 
+    @property
+    def rendered_content(self):
+        return render_content(self.content, self.content_format)
+
 
 def parse_dump_path(path):
     for model in DjangoPagesModel.subclasses():
         if os.path.commonpath([path, model.get_dump_dir_path()]) == model.get_dump_dir_path():
             remainder = os.path.relpath(path, model.get_dump_dir_path())
-            key, content_format_with_dot = os.path.splitext(remainder)
+            rel_path, content_format_with_dot = os.path.splitext(remainder)
+            key = model.get_dump_layout().rel_path_to_key(rel_path.replace(os.sep, '/'))
             content_format = content_format_with_dot[1:]
             return model, key, content_format
 
     assert False
+
+
+# The most keys that are looked up in one query.  SQLite limits the number of
+# parameters in a query (to 999, before version 3.32), so a batch with more
+# keys than this is split up.
+MAX_KEYS_PER_QUERY = 500
+
+
+def chunk_keys(keys):
+    keys = list(keys)
+    for ix in range(0, len(keys), MAX_KEYS_PER_QUERY):
+        yield keys[ix:ix + MAX_KEYS_PER_QUERY]
+
+
+def get_existing_keys(model, keys, using=DEFAULT_DB_ALIAS):
+    # Returns the set of keys for which an instance of model exists.
+    existing_keys = set()
+    for chunk in chunk_keys(keys):
+        existing_keys.update(model._default_manager.using(using).filter(key__in=chunk).values_list('key', flat=True))
+    return existing_keys
+
+
+def parse_dump_paths(paths):
+    # Like parse_dump_path, but yields (model, key, content_format) for each
+    # path, skipping any that aren't where their model's dump_layout would put
+    # a file.  Such files can't have been loaded, and loading them raises
+    # LoadFromFileError, so they can be ignored when working out what a batch
+    # of changes affects.
+    for path in paths:
+        try:
+            yield parse_dump_path(path)
+        except ValueError:
+            continue
@@ -0,0 +1,487 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+# Every file in an archive is given this modification time (the earliest that
+# a zip file can represent), so that building the same site twice produces
+# identical archives.
+ARCHIVE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ARCHIVE_MTIME = 315532800
+
+# Files with these suffixes are already compressed.
+COMPRESSED_SUFFIXES = ('.gz', '.br', '.zst')
+
+# Outputs with these suffixes are written to archives, rather than to
+# directories.
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.zst')
+
+# Every output directory is given a file with this name, so that a later build
+# can tell that it is safe to remove the directory.
+OUTPUT_MARKER = '.django-amber-output'
+
+
+class OutputPathError(Exception):
+    pass
+
+
+def get_output_path(url_path):
+    # Returns the path, relative to the output directory, that the page at
+    # url_path should be written to.
+    segments = url_path.split('/')
+    assert segments[0] == ''
+    if segments[-1] == '':
+        rel_dir_path = os.path.join(*segments[:-1])
+        filename = 'index.html'
+    elif '.' in segments[-1]:
+        rel_dir_path = os.path.join(*segments[:-1])
+        filename = segments[-1]
+    else:
+        rel_dir_path = os.path.join(*segments)
+        filename = 'index.html'
+
+    return os.path.join(rel_dir_path, filename)
+
+
+def prepare_output_dir(output_path, base_dir):
+    # Removes the output of an earlier build from output_path, if it is a
+    # directory, and leaves an empty directory marked as a build's output.
+    # Archives are overwritten when they are opened, so are left alone.
+    #
+    # A directory is only removed if it is empty or is marked as a build's
+    # output, and never if it contains base_dir, since it could then be
+    # something other than a build's output that happens to have been named
+    # with --output.
+    if output_path.endswith(ARCHIVE_SUFFIXES):
+        return
+
+    if os.path.isdir(output_path):
+        real_output_path = os.path.realpath(output_path)
+
+        if os.path.commonpath([real_output_path, os.path.realpath(base_dir)]) == real_output_path:
+            raise OutputPathError('Refusing to remove {}, since it contains the project'.format(output_path))
+
+        if os.listdir(output_path) and not os.path.isfile(os.path.join(output_path, OUTPUT_MARKER)):
+            raise OutputPathError(
+                'Refusing to remove {}, since it is not the output of an earlier build; '
+                'remove it yourself, or choose another --output'.format(output_path)
+            )
+
+        shutil.rmtree(output_path)
+
+    os.makedirs(output_path)
+
+    with open(os.path.join(output_path, OUTPUT_MARKER), 'w'):
+        pass
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+class Sink(ABC):
+    # Receives the files that make up the build, and writes them on a pool of
+    # threads, so that writing one page can overlap with rendering the next.
+    # At most max_pending writes can be waiting at once, after which write()
+    # blocks until one of them has finished.
+    #
+    # If dedupe is True, a file whose content is identical to that of an
+    # earlier file is written as a link to the earlier file, where the sink
+    # supports links.
+    def __init__(self, max_workers=4, max_pending=64, dedupe=False):
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.error = None
+        self.pending = {}
+        self.dedupe = dedupe
+        self.originals = {}
+        self.dedupe_stats = {'linked_files': 0, 'linked_bytes': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, rel_path, content):
+        slot = Future()
+        slot.set_result(content)
+        self.submit(rel_path, slot)
+
+    def reserve(self, rel_path):
+        # Returns a future, whose result should be set to the content of the
+        # file at rel_path once it is known.  This lets sinks that care about
+        # the order of files (ie archives) put the file in the position it was
+        # reserved in.
+        slot = Future()
+        self.submit(rel_path, slot)
+        return slot
+
+    def copy_file(self, rel_path, source_path):
+        # Adds the file at source_path to the output.
+        with open(source_path, 'rb') as f:
+            self.write(rel_path, f.read())
+
+    def submit(self, rel_path, slot):
+        self.submit_task(self.write_slot, rel_path, slot)
+
+    def submit_task(self, fn, rel_path, *args):
+        # Calls fn(rel_path, *args) on the pool.  Tasks for the same rel_path
+        # (eg for URLs that differ only in their query string) run one after
+        # another, in the order they were submitted, so the last one wins.
+        self.raise_error()
+        self.semaphore.acquire()
+
+        try:
+            with self.lock:
+                future = self.executor.submit(self.run_task, self.pending.get(rel_path), fn, rel_path, *args)
+                self.pending[rel_path] = future
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+        future.add_done_callback(lambda future: self.write_done(rel_path, future))
+
+    def run_task(self, previous, fn, rel_path, *args):
+        if previous is not None:
+            # The pool runs tasks in the order they were submitted, so another
+            # thread has already started this one.
+            wait([previous])
+
+        fn(rel_path, *args)
+
+    def write_slot(self, rel_path, slot):
+        content = slot.result()
+
+        if not self.dedupe:
+            self.write_file(rel_path, content)
+            return
+
+        digest = hashlib.sha256(content).digest()
+
+        with self.lock:
+            original = self.originals.get(digest)
+            if original is None:
+                written = threading.Event()
+                self.originals[digest] = (rel_path, written)
+
+        if original is None:
+            try:
+                self.write_file(rel_path, content)
+            finally:
+                written.set()
+            return
+
+        # The original was submitted before this file, so it will already be
+        # being written by another thread.
+        original_rel_path, original_written = original
+        original_written.wait()
+
+        if self.write_link(rel_path, original_rel_path):
+            with self.lock:
+                self.dedupe_stats['linked_files'] += 1
+                self.dedupe_stats['linked_bytes'] += len(content)
+        else:
+            self.write_file(rel_path, content)
+
+    def write_done(self, rel_path, future):
+        with self.lock:
+            if self.pending.get(rel_path) is future:
+                del self.pending[rel_path]
+
+        self.semaphore.release()
+        self.record_error(future.exception())
+
+    @abstractmethod
+    def write_file(self, rel_path, content):
+        pass
+
+    def write_link(self, rel_path, original_rel_path):
+        # Returns whether a link was written.
+        return False
+
+    def record_error(self, error):
+        if error is not None:
+            with self.lock:
+                if self.error is None:
+                    self.error = error
+
+    def raise_error(self):
+        with self.lock:
+            error = self.error
+
+        if error is not None:
+            raise error
+
+    def close(self):
+        # Waits for all pending writes to finish.
+        self.executor.shutdown(wait=True)
+        self.raise_error()
+
+
+class OutputWriter(Sink):
+    # Writes files to a directory.  Duplicate files are hard links.
+    #
+    # If link_files is True, files added with copy_file are hard linked to
+    # their source where possible, rather than copied.  This is faster, but
+    # anything that later modifies a file in place in the output (or the
+    # source) modifies the other too.
+    def __init__(self, output_path, max_workers=4, max_pending=64, dedupe=False, link_files=False):
+        super().__init__(max_workers, max_pending, dedupe)
+        self.output_path = output_path
+        self.link_files = link_files
+        self.created_dir_paths = set()
+        self.reservations = {}
+
+        # mkstemp creates files that only the owner can read, so we set the
+        # mode that open() would have used.
+        self.file_mode = 0o666 & ~get_umask()
+
+    def reserve(self, rel_path):
+        # The order of files in a directory doesn't matter, so there's no need
+        # to tie up a thread until the content is known.  But files reserved
+        # for the same rel_path are still written in the order they were
+        # reserved, whatever order their content arrives in.
+        slot = Future()
+        written = Future()
+
+        with self.lock:
+            previous = self.reservations.get(rel_path)
+            self.reservations[rel_path] = written
+
+        def content_ready(slot):
+            if previous is None:
+                self.write_reserved(rel_path, slot, written)
+            else:
+                previous.add_done_callback(lambda _: self.write_reserved(rel_path, slot, written))
+
+        slot.add_done_callback(content_ready)
+        return slot
+
+    def write_reserved(self, rel_path, slot, written):
+        try:
+            self.write(rel_path, slot.result())
+        except BaseException as e:
+            self.record_error(e)
+        finally:
+            with self.lock:
+                if self.reservations.get(rel_path) is written:
+                    del self.reservations[rel_path]
+            written.set_result(None)
+
+    def write_file(self, rel_path, content):
+        path = os.path.join(self.output_path, rel_path)
+        dir_path = os.path.dirname(path)
+        self.make_dir(dir_path)
+
+        # Write to a temporary file first, so that a partially written file is
+        # never visible at path.
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-')
+
+        try:
+            with open(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp_path, self.file_mode)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def copy_file(self, rel_path, source_path):
+        self.submit_task(self.copy_file_task, rel_path, source_path)
+
+    def copy_file_task(self, rel_path, source_path):
+        path = os.path.join(self.output_path, rel_path)
+        self.make_dir(os.path.dirname(path))
+
+        if self.link_files:
+            # A hard link isn't possible across filesystems.
+            try:
+                os.link(source_path, path)
+                return
+            except OSError:
+                pass
+
+        shutil.copyfile(source_path, path)
+
+    def write_link(self, rel_path, original_rel_path):
+        path = os.path.join(self.output_path, rel_path)
+        self.make_dir(os.path.dirname(path))
+
+        try:
+            os.link(os.path.join(self.output_path, original_rel_path), path)
+        except OSError:
+            # Eg the filesystem doesn't support hard links.
+            return False
+
+        return True
+
+    def make_dir(self, dir_path):
+        with self.lock:
+            if dir_path in self.created_dir_paths:
+                return
+            os.makedirs(dir_path, exist_ok=True)
+            self.created_dir_paths.add(dir_path)
+
+
+class ArchiveSink(Sink):
+    # Streams files into an archive, in the order in which they were written
+    # or reserved, with fixed modification times and owners.  Files are
+    # written by a single thread, which waits for the content of reserved
+    # files to arrive.
+    def __init__(self, path, max_pending=64, dedupe=False):
+        super().__init__(1, max_pending, dedupe)
+        self.path = path
+        self.dir_names = set()
+        self.f = open(path, 'wb')
+
+    def archive_name(self, rel_path):
+        return rel_path.replace(os.sep, '/')
+
+    def new_dir_names(self, name):
+        # Returns the names of directories containing name that have not yet
+        # been added to the archive.
+        dir_names = []
+        parts = name.split('/')[:-1]
+
+        for ix in range(1, len(parts) + 1):
+            dir_name = '/'.join(parts[:ix])
+            if dir_name not in self.dir_names:
+                self.dir_names.add(dir_name)
+                dir_names.append(dir_name)
+
+        return dir_names
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.close_archive()
+            self.f.close()
+
+    @abstractmethod
+    def close_archive(self):
+        pass
+
+
+class TarSink(ArchiveSink):
+    # Duplicate files are hard link entries.
+    def __init__(self, path, compression=None, max_pending=64, dedupe=False):
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ImproperlyConfigured('Writing .tar.zst archives requires zstandard')
+
+        super().__init__(path, max_pending, dedupe)
+
+        if compression is None:
+            self.stream = None
+            fileobj = self.f
+        elif compression == 'gzip':
+            # tarfile would record the current time in the gzip header.
+            self.stream = gzip.GzipFile(filename='', mode='wb', fileobj=self.f, mtime=0)
+            fileobj = self.stream
+        elif compression == 'zstd':
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.f)
+            fileobj = self.stream
+        else:
+            assert False, compression
+
+        self.tar = tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def make_info(self, name, type, mode, size=0):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mode = mode
+        info.size = size
+        info.mtime = ARCHIVE_MTIME
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        return info
+
+    def write_file(self, rel_path, content):
+        name = self.archive_name(rel_path)
+
+        for dir_name in self.new_dir_names(name):
+            self.tar.addfile(self.make_info(dir_name, tarfile.DIRTYPE, 0o755))
+
+        self.tar.addfile(self.make_info(name, tarfile.REGTYPE, 0o644, len(content)), io.BytesIO(content))
+
+    def write_link(self, rel_path, original_rel_path):
+        name = self.archive_name(rel_path)
+
+        for dir_name in self.new_dir_names(name):
+            self.tar.addfile(self.make_info(dir_name, tarfile.DIRTYPE, 0o755))
+
+        info = self.make_info(name, tarfile.LNKTYPE, 0o644)
+        info.linkname = self.archive_name(original_rel_path)
+        self.tar.addfile(info)
+        return True
+
+    def close_archive(self):
+        self.tar.close()
+
+        if self.stream is not None:
+            self.stream.close()
+
+
+class ZipSink(ArchiveSink):
+    # Zip files can't contain links, so duplicate files are always written in
+    # full.
+    def __init__(self, path, max_pending=64, dedupe=False):
+        super().__init__(path, max_pending, dedupe)
+        self.zip = zipfile.ZipFile(self.f, 'w')
+
+    def make_info(self, name, mode):
+        info = zipfile.ZipInfo(name, date_time=ARCHIVE_DATE_TIME)
+        info.external_attr = mode << 16
+        info.create_system = 3  # Unix, so that the mode is honoured
+        return info
+
+    def write_file(self, rel_path, content):
+        name = self.archive_name(rel_path)
+
+        for dir_name in self.new_dir_names(name):
+            self.zip.writestr(self.make_info(dir_name + '/', 0o40755), b'')
+
+        info = self.make_info(name, 0o100644)
+
+        if name.endswith(COMPRESSED_SUFFIXES):
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+
+        self.zip.writestr(info, content)
+
+    def close_archive(self):
+        self.zip.close()
+
+
+def open_sink(path, max_workers=4, max_pending=64, dedupe=False, link_files=False):
+    # Returns a sink for path, based on its suffix.  Anything that doesn't
+    # look like an archive is treated as a directory.  link_files only
+    # applies to directories.
+    if path.endswith('.zip'):
+        return ZipSink(path, max_pending, dedupe)
+    elif path.endswith('.tar'):
+        return TarSink(path, None, max_pending, dedupe)
+    elif path.endswith(('.tar.gz', '.tgz')):
+        return TarSink(path, 'gzip', max_pending, dedupe)
+    elif path.endswith('.tar.zst'):
+        return TarSink(path, 'zstd', max_pending, dedupe)
+    else:
+        return OutputWriter(path, max_workers, max_pending, dedupe, link_files)
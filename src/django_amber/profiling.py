@@ -0,0 +1,179 @@
+from collections import OrderedDict
+import cProfile
+from contextlib import contextmanager
+import json
+import os
+import threading
+from time import perf_counter
+
+
+class Profiler:
+    # Records the time spent in each phase (or "span") of a command.  Spans
+    # can be nested, and each span is identified by its path, eg
+    # "buildsite/loadpages/parse".  Time spent in a span is accumulated across
+    # all the times that the span is entered.
+    def __init__(self, name, stats_dir=None):
+        self.name = name
+        self.stats_dir = stats_dir
+        self.spans = OrderedDict()
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread = threading.current_thread()
+        self.start_time = perf_counter()
+        self.end_time = None
+
+        if self.stats_dir is not None:
+            # This profiles time spent outside of any span.
+            self.profiles[name] = cProfile.Profile()
+            self.profiles[name].enable()
+
+    def get_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = [self.name]
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name):
+        stack = self.get_stack()
+        parent_path = '/'.join(stack)
+        stack.append(name)
+        path = '/'.join(stack)
+
+        # cProfile only profiles the thread it is enabled in, and only one
+        # profile can be active at a time, so the parent span's profile is
+        # paused while this span runs.
+        use_cprofile = self.stats_dir is not None and threading.current_thread() is self.thread
+        if use_cprofile:
+            self.pause_profile(parent_path)
+            profile = self.profiles.setdefault(path, cProfile.Profile())
+            profile.enable()
+
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            duration = perf_counter() - start
+
+            if use_cprofile:
+                profile.disable()
+                self.resume_profile(parent_path)
+
+            stack.pop()
+            self.record(path, duration)
+
+    def pause_profile(self, path):
+        profile = self.profiles.get(path)
+        if profile is not None:
+            profile.disable()
+
+    def resume_profile(self, path):
+        profile = self.profiles.get(path)
+        if profile is not None:
+            profile.enable()
+
+    def record(self, path, duration):
+        with self.lock:
+            span = self.spans.get(path)
+            if span is None:
+                span = self.spans[path] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+
+            span['count'] += 1
+            span['seconds'] += duration
+            span['max_seconds'] = max(span['max_seconds'], duration)
+
+    def stop(self):
+        self.end_time = perf_counter()
+
+        if self.stats_dir is not None:
+            self.profiles[self.name].disable()
+            os.makedirs(self.stats_dir, exist_ok=True)
+            for path, profile in self.profiles.items():
+                filename = path.replace('/', '.').replace(' ', '_') + '.pstats'
+                profile.dump_stats(os.path.join(self.stats_dir, filename))
+
+    def report(self):
+        end_time = self.end_time or perf_counter()
+
+        return {
+            'command': self.name,
+            'seconds': end_time - self.start_time,
+            'spans': [dict(span, name=path) for path, span in self.spans.items()],
+        }
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+active_profilers = []
+
+
+def get_active_profiler():
+    if active_profilers:
+        return active_profilers[-1]
+
+
+@contextmanager
+def span(name):
+    # Records the time spent in the block against the currently active
+    # profiler, if there is one.  Projects can use this to add their own spans
+    # to the report, eg:
+    #
+    #     from django_amber import profiling
+    #
+    #     with profiling.span('build search index'):
+    #         ...
+    profiler = get_active_profiler()
+
+    if profiler is None:
+        yield
+    else:
+        with profiler.span(name):
+            yield
+
+
+@contextmanager
+def profile(name, report_path=None, stats_dir=None):
+    profiler = Profiler(name, stats_dir)
+    active_profilers.append(profiler)
+
+    try:
+        yield profiler
+    finally:
+        active_profilers.remove(profiler)
+        profiler.stop()
+
+        if report_path is not None:
+            profiler.write_report(report_path)
+
+
+class ProfileMixin:
+    # Adds --profile and --profile-stats options to a management command.  When
+    # the command is run by another command that is being profiled, its spans
+    # are recorded as part of that command's profile.
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--profile',
+            metavar='REPORT_PATH',
+            help='Record how long each phase of the command takes, and write a JSON report to REPORT_PATH'
+        )
+        parser.add_argument(
+            '--profile-stats',
+            metavar='DIR',
+            help='Also write cProfile stats for each phase to DIR'
+        )
+
+    def execute(self, *args, **options):
+        name = self.__module__.rsplit('.', 1)[-1]
+        report_path = options.get('profile')
+        stats_dir = options.get('profile_stats')
+
+        if report_path or stats_dir:
+            with profile(name, report_path, stats_dir):
+                return super().execute(*args, **options)
+        else:
+            with span(name):
+                return super().execute(*args, **options)
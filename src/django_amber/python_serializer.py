@@ -288,4 +288,4 @@ class DeserializedObject(object):
             else:
                 assert False
 
-        self.save()
+        self.save(using=using)
@@ -0,0 +1,204 @@
+from collections import OrderedDict
+import re
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+READ_RE = re.compile(r'\s*SELECT\b', re.IGNORECASE)
+
+
+class QueryCache:
+    # Maps (alias, sql, params) to the description and rows returned by a
+    # query.  This is shared between all threads in the process.  Only the
+    # max_size most recently used results are kept.
+    max_size = 1000
+
+    def __init__(self):
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.results.move_to_end(key)
+            return result
+
+    def set(self, key, result):
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+
+class CachingCursorWrapper:
+    # Wraps one of Django's cursor wrappers.  The results of SELECT queries are
+    # served from the cache where possible, and any other query clears the
+    # cache, since it might have written to the database.
+    def __init__(self, cursor, cache, alias):
+        self.cursor = cursor
+        self.cache = cache
+        self.alias = alias
+        self.rows = None
+        self.position = 0
+        self.cached_description = None
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    @property
+    def description(self):
+        if self.rows is None:
+            return self.cursor.description
+        return self.cached_description
+
+    def get_key(self, sql, params):
+        if params is None:
+            params = ()
+        elif isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        else:
+            params = tuple(params)
+
+        key = (self.alias, sql, params)
+
+        try:
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
+
+    def execute(self, sql, params=None):
+        self.rows = None
+
+        if not READ_RE.match(sql):
+            self.cache.clear()
+            return self.cursor.execute(sql, params)
+
+        key = self.get_key(sql, params)
+        if key is None:
+            return self.cursor.execute(sql, params)
+
+        result = self.cache.get(key)
+
+        if result is None:
+            self.cursor.execute(sql, params)
+            result = (self.cursor.description, list(self.cursor.fetchall()))
+            self.cache.set(key, result)
+
+        self.cached_description, self.rows = result
+        self.position = 0
+
+    def executemany(self, sql, param_list):
+        self.rows = None
+        self.cache.clear()
+        return self.cursor.executemany(sql, param_list)
+
+    def callproc(self, procname, params=None):
+        self.rows = None
+        self.cache.clear()
+        return self.cursor.callproc(procname, params)
+
+    def fetchone(self):
+        if self.rows is None:
+            return self.cursor.fetchone()
+        if self.position >= len(self.rows):
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchmany(self, size=None):
+        if self.rows is None:
+            if size is None:
+                return self.cursor.fetchmany()
+            return self.cursor.fetchmany(size)
+        if size is None:
+            size = 1
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchall(self):
+        if self.rows is None:
+            return self.cursor.fetchall()
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+
+cache = QueryCache()
+
+
+def install(connection):
+    if getattr(connection, 'query_cache_installed', False):
+        return
+
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+
+    connection.make_cursor = lambda cursor: CachingCursorWrapper(make_cursor(cursor), cache, connection.alias)
+    connection.make_debug_cursor = lambda cursor: CachingCursorWrapper(make_debug_cursor(cursor), cache, connection.alias)
+    connection.query_cache_installed = True
+
+
+def uninstall(connection):
+    if not getattr(connection, 'query_cache_installed', False):
+        return
+
+    del connection.make_cursor
+    del connection.make_debug_cursor
+    del connection.query_cache_installed
+
+
+def install_on_connection_created(sender, connection, **kwargs):
+    install(connection)
+
+
+def enable():
+    # Caches the results of queries made by any connection in this process,
+    # until something writes to the database.  This is only safe when nothing
+    # outside this process writes to the database, eg while buildsite crawls
+    # the site.
+    cache.clear()
+    cache.max_size = getattr(settings, 'DJANGO_AMBER_QUERY_CACHE_SIZE', QueryCache.max_size)
+    connection_created.connect(install_on_connection_created)
+
+    for connection in connections.all():
+        install(connection)
+
+
+def disable():
+    connection_created.disconnect(install_on_connection_created)
+
+    for connection in connections.all():
+        uninstall(connection)
+
+    cache.clear()
@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, models
+
+from .models import DjangoPagesModel
+
+
+class CascadingDeleteError(Exception):
+    def __init__(self, cascaded):
+        self.cascaded = cascaded
+
+    def __str__(self):
+        return 'Removing these files would also delete {}, whose files still exist'.format(
+            ', '.join(object_label(model, key) for model, key in self.cascaded)
+        )
+
+
+def object_label(model, key):
+    return '{}:{}'.format(model._meta.label_lower, key)
+
+
+def get_reference_fields(model):
+    # Returns the foreign key and many-to-many fields declared on model that
+    # refer to other DjangoPagesModels, and so are serialized as keys.
+    return [
+        field for field in model._meta.get_fields()
+        if (field.many_to_one and field.concrete or field.many_to_many and not field.auto_created)
+        and issubclass(field.related_model, DjangoPagesModel)
+    ]
+
+
+class ReferenceIndex:
+    # Maps each object, as a (model, key) pair, to the objects whose files
+    # refer to it through a foreign key or many-to-many field, so that the
+    # objects affected by a change can be found without querying every model
+    # that might refer to it.
+    #
+    # loadpages fills the index as it loads each file.  Otherwise, the index
+    # is built from the database the first time it is needed, and is then kept
+    # up to date by load_from_file and delete_for_paths.
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.references = {}
+        self.referrers = {}
+        self.paths = {}
+        self.built = False
+        self.undo_log = None
+
+    def ensure_built(self, using=DEFAULT_DB_ALIAS):
+        if not self.built:
+            self.build(using)
+
+    def build(self, using=DEFAULT_DB_ALIAS):
+        self.clear()
+
+        for model in DjangoPagesModel.subclasses():
+            references_by_key = {}
+
+            for field in get_reference_fields(model):
+                rows = model._default_manager.using(using).filter(
+                    **{field.name + '__isnull': False}
+                ).values_list('key', field.name + '__key')
+
+                for key, target_key in rows:
+                    references_by_key.setdefault(key, []).append((field.name, field.related_model, target_key))
+
+            if not references_by_key:
+                continue
+
+            if model.has_content:
+                content_formats = dict(model._default_manager.using(using).values_list('key', 'content_format'))
+            else:
+                content_formats = {}
+
+            for key, references in references_by_key.items():
+                content_format = content_formats.get(key, model.content_format)
+                self.set_references(model, key, model.get_dump_path(key, content_format), references)
+
+        self.built = True
+
+    @contextmanager
+    def atomic(self):
+        # Changes made in the block are undone if it raises an exception, to
+        # match the database transaction they are made alongside.
+        if self.undo_log is not None:
+            yield
+            return
+
+        self.undo_log = []
+
+        try:
+            yield
+        except BaseException:
+            undo_log = self.undo_log
+            self.undo_log = None
+
+            for args in reversed(undo_log):
+                self.set_references(*args)
+
+            raise
+        finally:
+            self.undo_log = None
+
+    def set_references(self, model, key, path, references):
+        # Records that the object (model, key), which was loaded from path,
+        # refers to each (field_name, target_model, target_key) in references.
+        source = (model, key)
+
+        if self.undo_log is not None:
+            self.undo_log.append((model, key, self.paths.get(source), self.references.get(source, ())))
+
+        for field_name, target_model, target_key in self.references.pop(source, ()):
+            referrers = self.referrers[(target_model, target_key)]
+            referrers.discard((model, key, field_name))
+            if not referrers:
+                del self.referrers[(target_model, target_key)]
+
+        self.paths.pop(source, None)
+
+        references = frozenset(references)
+
+        if references:
+            self.references[source] = references
+            self.paths[source] = path
+
+            for field_name, target_model, target_key in references:
+                self.referrers.setdefault((target_model, target_key), set()).add((model, key, field_name))
+
+    def remove(self, model, key):
+        self.set_references(model, key, None, ())
+
+    def get_referrers(self, model, key):
+        # Returns a set of (model, key, field_name) triples, one for each
+        # reference to the object (model, key).
+        return set(self.referrers.get((model, key), ()))
+
+    def get_path(self, model, key):
+        return self.paths[(model, key)]
+
+    def find_cascades(self, objects):
+        # Returns the objects that deleting every (model, key) in objects
+        # would also delete, because they refer to one of them (directly, or
+        # through other deleted objects) through a foreign key whose
+        # on_delete is CASCADE.
+        objects = set(objects)
+        cascaded = set()
+        todo = list(objects)
+
+        while todo:
+            model, key = todo.pop()
+
+            for referrer_model, referrer_key, field_name in self.get_referrers(model, key):
+                referrer = (referrer_model, referrer_key)
+
+                if referrer in objects or referrer in cascaded:
+                    continue
+
+                field = referrer_model._meta.get_field(field_name)
+
+                if field.many_to_one and field.remote_field.on_delete is models.CASCADE:
+                    cascaded.add(referrer)
+                    todo.append(referrer)
+
+        return sorted(cascaded, key=lambda obj: object_label(*obj))
+
+
+index = ReferenceIndex()
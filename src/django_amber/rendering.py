@@ -0,0 +1,190 @@
+from collections import OrderedDict
+import hashlib
+from importlib import import_module
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django.utils.safestring import mark_safe
+
+from .cache import get_cache_dir
+
+
+def render_markdown(content):
+    # Use markdown_deux if it is installed, so that content is rendered the same
+    # way as by its `markdown` template filter.
+    try:
+        import markdown_deux
+    except ImportError:
+        pass
+    else:
+        return markdown_deux.markdown(content)
+
+    try:
+        import markdown2
+    except ImportError:
+        pass
+    else:
+        return markdown2.markdown(content, safe_mode='escape', extras={'code-friendly': None})
+
+    import markdown
+    return markdown.markdown(content)
+
+
+def render_rst(content):
+    from docutils.core import publish_parts
+    return publish_parts(content, writer_name='html')['fragment']
+
+
+def render_html(content):
+    return content
+
+
+default_renderers = {
+    'md': 'django_amber.rendering.render_markdown',
+    'rst': 'django_amber.rendering.render_rst',
+    'html': 'django_amber.rendering.render_html',
+}
+
+
+def get_renderer_path(content_format):
+    renderers = dict(default_renderers, **getattr(settings, 'DJANGO_AMBER_CONTENT_RENDERERS', {}))
+
+    try:
+        return renderers[content_format]
+    except KeyError:
+        raise ValueError('No renderer for content format {!r}'.format(content_format))
+
+
+class RenderCache:
+    # Maps a hash of some content, its format and its renderer (see
+    # get_cache_key) to the rendered content.  The most recently used entries are also kept in memory.
+    max_size = 1000
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_path(self, cache_dir, key):
+        return os.path.join(cache_dir, key[:2], key[2:] + '.html')
+
+    def get(self, key, cache_dir):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if cache_dir is None:
+            return None
+
+        try:
+            with open(self.get_path(cache_dir, key), encoding='utf8') as f:
+                rendered = f.read()
+        except FileNotFoundError:
+            return None
+
+        self.remember(key, rendered)
+        return rendered
+
+    def set(self, key, cache_dir, rendered):
+        self.remember(key, rendered)
+
+        if cache_dir is None:
+            return
+
+        path = self.get_path(cache_dir, key)
+        dir_path = os.path.dirname(path)
+        os.makedirs(dir_path, exist_ok=True)
+
+        # Write to a temporary file first, so that concurrent builds never
+        # see a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path)
+        with open(fd, 'w', encoding='utf8') as f:
+            f.write(rendered)
+        os.replace(tmp_path, path)
+
+    def remember(self, key, rendered):
+        with self.lock:
+            self.entries[key] = rendered
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = RenderCache()
+
+
+# The libraries that each built-in renderer might use, and the settings that
+# configure them.  A change to any of these may change the rendered content,
+# so they are part of the cache key.
+renderer_libraries = {
+    'django_amber.rendering.render_markdown': ['markdown_deux', 'markdown2', 'markdown'],
+    'django_amber.rendering.render_rst': ['docutils'],
+}
+
+renderer_settings = {
+    'django_amber.rendering.render_markdown': ['MARKDOWN_DEUX_STYLES'],
+}
+
+library_versions = {}
+
+
+def get_library_version(name):
+    # Returns the version of the library name, or '' if it isn't installed.
+    # This is remembered, since failed imports aren't cached by Python.
+    if name not in library_versions:
+        try:
+            module = import_module(name)
+        except ImportError:
+            library_versions[name] = ''
+        else:
+            library_versions[name] = str(getattr(module, '__version__', getattr(module, 'version', '?')))
+
+    return library_versions[name]
+
+
+def get_renderer_fingerprint(renderer_path):
+    # Returns a string that identifies the versions of the libraries the
+    # renderer uses, and the settings that configure it.  Renderers given by
+    # DJANGO_AMBER_CONTENT_RENDERERS can be distinguished by changing the
+    # DJANGO_AMBER_RENDER_CACHE_VERSION setting.
+    parts = [str(getattr(settings, 'DJANGO_AMBER_RENDER_CACHE_VERSION', ''))]
+
+    for name in renderer_libraries.get(renderer_path, []):
+        parts.append('{}={}'.format(name, get_library_version(name)))
+
+    for name in renderer_settings.get(renderer_path, []):
+        parts.append('{}={!r}'.format(name, getattr(settings, name, None)))
+
+    return ' '.join(parts)
+
+
+def get_cache_key(renderer_path, content_format, content):
+    h = hashlib.sha256()
+    for part in [renderer_path, get_renderer_fingerprint(renderer_path), content_format, content]:
+        h.update(part.encode('utf8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def render_content(content, content_format):
+    # Renders content with the renderer for its format, unless content with
+    # the same hash has already been rendered.
+    renderer_path = get_renderer_path(content_format)
+    cache_dir = get_cache_dir('rendered')
+    key = get_cache_key(renderer_path, content_format, content)
+
+    rendered = cache.get(key, cache_dir)
+
+    if rendered is None:
+        rendered = import_string(renderer_path)(content)
+        cache.set(key, cache_dir, rendered)
+
+    return mark_safe(rendered)
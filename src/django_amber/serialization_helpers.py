@@ -1,7 +1,11 @@
+from collections import defaultdict
 import os
 
-from django.db import transaction
+from django.db import DEFAULT_DB_ALIAS, transaction
 
+from .models import chunk_keys, parse_dump_paths
+from .profiling import span
+from .references import index as reference_index
 from .serializer import Deserializer, Serializer
 
 
@@ -15,31 +19,65 @@ def dump_to_file(instance):
     dump_path = instance.dump_path()
     os.makedirs(os.path.dirname(dump_path), exist_ok=True)
 
-    serializer = Serializer()
-    serializer.serialize([instance], use_natural_foreign_keys=True)
-    data = serializer.getvalue()
+    with span('serialize'):
+        serializer = Serializer()
+        serializer.serialize([instance], use_natural_foreign_keys=True)
+        data = serializer.getvalue()
 
-    with open(dump_path, 'w') as f:
-        f.write(data)
+    with span('write'):
+        with open(dump_path, 'w') as f:
+            f.write(data)
 
 
-def load_from_file(paths):
+def load_from_file(paths, using=DEFAULT_DB_ALIAS):
     objs_with_deferred_fields = []
 
-    with transaction.atomic():
+    with transaction.atomic(using=using), reference_index.atomic():
         for path in paths:
             try:
                 with open(path, 'rb') as f:
-                    for obj in Deserializer(f, handle_forward_references=True):
-                        obj.save()
+                    objs = Deserializer(f, handle_forward_references=True, using=using)
+
+                    while True:
+                        # This includes looking up any related objects.
+                        with span('parse'):
+                            obj = next(objs, None)
+
+                        if obj is None:
+                            break
+
+                        with span('save'):
+                            obj.save(using=using)
+
+                        reference_index.set_references(type(obj.object), obj.object.key, path, obj.references)
 
                         if obj.deferred_fields:
-                            objs_with_deferred_fields.append(obj)
+                            objs_with_deferred_fields.append((obj, path))
             except Exception as e:
                 raise LoadFromFileError(e, path)
 
-        for obj in objs_with_deferred_fields:
-            obj.save_deferred_fields()
+        with span('save deferred fields'):
+            for obj, path in objs_with_deferred_fields:
+                # Eg a reference to an object that isn't in any file.
+                try:
+                    obj.save_deferred_fields(using=using)
+                except Exception as e:
+                    raise LoadFromFileError(e, path)
+
+
+def delete_for_paths(paths, using=DEFAULT_DB_ALIAS):
+    keys_by_model = defaultdict(list)
+
+    for model, key, _ in parse_dump_paths(paths):
+        keys_by_model[model].append(key)
+
+    with transaction.atomic(using=using), reference_index.atomic():
+        for model, keys in keys_by_model.items():
+            for chunk in chunk_keys(keys):
+                model.objects.using(using).filter(key__in=chunk).delete()
+
+            for key in keys:
+                reference_index.remove(model, key)
 
 
 def find_file_paths_in_dir(path):
@@ -100,14 +100,21 @@ def Deserializer(file, **options):
         except yaml.YAMLError as e:
             raise DeserializationError(e)
 
+    # The (field_name, model, key) of every object this object refers to, for
+    # django_amber.references.
+    references = []
+
     for field_name, field_value in fields.items():
         if is_fk_field(model, field_name):
             assert isinstance(field_value, str)
             fields[field_name] = [field_value]
+            references.append((field_name, model._meta.get_field(field_name).related_model, field_value))
 
         if is_m2m_field(model, field_name):
             assert isinstance(field_value, list) and all(isinstance(v, str) for v in field_value)
             fields[field_name] = [[v] for v in field_value]
+            related_model = model._meta.get_field(field_name).related_model
+            references.extend((field_name, related_model, v) for v in field_value)
 
         if is_time_field(model, field_name):
             if isinstance(fields[field_name], int):
@@ -123,7 +130,9 @@ def Deserializer(file, **options):
     }
 
     try:
-        yield from PythonDeserializer([record], **options)
+        for obj in PythonDeserializer([record], **options):
+            obj.references = references
+            yield obj
     except Exception as e:
         raise DeserializationError(e)
 
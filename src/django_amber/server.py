@@ -0,0 +1,125 @@
+from socketserver import ThreadingMixIn
+import threading
+
+from django.apps import apps
+from django.conf import settings
+from django.core.servers import basehttp
+
+
+DEFAULT_ADDR = '127.0.0.1'
+DEFAULT_PORT = '8000'
+
+
+class ServerHandler(basehttp.ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+
+        # The connection can only be kept alive if the client can tell where
+        # the response ends, and if there's no unread request body.
+        if 'Content-Length' not in self.headers or self.environ.get('CONTENT_LENGTH') not in (None, '', '0'):
+            self.request_handler.close_connection = True
+
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class WSGIRequestHandler(basehttp.WSGIRequestHandler):
+    # Like Django's WSGIRequestHandler, but speaks HTTP/1.1, so that the
+    # crawler can send many requests over each connection.
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body are written separately, so with Nagle's algorithm a
+    # kept-alive connection would stall on each response.
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        # This sets close_connection, based on the request's version and
+        # Connection header.
+        if not self.parse_request():
+            return
+
+        handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class ThreadedWSGIServer(ThreadingMixIn, basehttp.WSGIServer):
+    daemon_threads = True
+
+
+def get_handler():
+    # Returns the WSGI handler that runserver would use.
+    handler = basehttp.get_internal_wsgi_application()
+
+    if settings.DEBUG and apps.is_installed('django.contrib.staticfiles'):
+        from django.contrib.staticfiles.handlers import StaticFilesHandler
+        handler = StaticFilesHandler(handler)
+
+    return handler
+
+
+class Server:
+    # Serves the site from a thread in this process, handling each request in
+    # a new thread.  The server's socket is listening as soon as the server
+    # has been created, so there's no need to wait for it to be ready.
+    #
+    # port may be 0, in which case a free port is chosen, and wrap_handler, if
+    # given, is called with the WSGI handler that runserver would use, and
+    # should return a WSGI handler to use instead.
+    def __init__(self, port=DEFAULT_PORT, wrap_handler=None, addr=DEFAULT_ADDR):
+        handler = get_handler()
+
+        if wrap_handler is not None:
+            handler = wrap_handler(handler)
+
+        self.httpd = ThreadedWSGIServer((addr, int(port)), WSGIRequestHandler, ipv6=':' in addr)
+        self.httpd.set_app(handler)
+        self.addr, self.port = self.httpd.server_address[:2]
+        # serve_forever only notices that it has been shut down between polls.
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        return 'http://localhost:{}/'.format(self.port)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+def parse_addrport(addrport):
+    # Parses a port, or an address and port, as given to runserver.
+    addr, _, port = str(addrport).rpartition(':')
+    return (addr.strip('[]') or DEFAULT_ADDR), port
@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+import os
+import shutil
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def shadow_supported(alias=DEFAULT_DB_ALIAS):
+    # We can only swap databases that live in a single file.  For other
+    # backends, changes are applied in place (but still in a transaction).
+    connection = connections[alias]
+    name = connection.settings_dict['NAME']
+
+    if connection.vendor != 'sqlite':
+        return False
+
+    return bool(name) and name != ':memory:' and 'mode=memory' not in name
+
+
+@contextmanager
+def shadow_database(alias=DEFAULT_DB_ALIAS):
+    # Yields the alias of a copy of the database.  If the block completes
+    # without an exception, the copy atomically replaces the original, so that
+    # other processes reading from the database (eg the server started by
+    # serve) see either none of the changes made in the block, or all of them.
+    connection = connections[alias]
+    db_path = connection.settings_dict['NAME']
+    shadow_path = db_path + '.shadow'
+    shadow_alias = '{}-shadow'.format(alias)
+
+    # Make sure that nothing we have written is still waiting to be committed.
+    connection.close()
+    shutil.copy(db_path, shadow_path)
+
+    connections.databases[shadow_alias] = dict(connection.settings_dict, NAME=shadow_path)
+
+    try:
+        yield shadow_alias
+        connections[shadow_alias].close()
+        os.replace(shadow_path, db_path)
+    finally:
+        connections[shadow_alias].close()
+        del connections[shadow_alias]
+        del connections.databases[shadow_alias]
+
+        if os.path.exists(shadow_path):
+            os.remove(shadow_path)
+
+    # Our connection still points at the old file, so we need to reconnect.
+    # Connections in the server's process are closed at the end of each
+    # request, so they'll pick up the new file on their next request.
+    connection.close()
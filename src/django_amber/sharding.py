@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .output import OUTPUT_MARKER
+
+
+MANIFEST_VERSION = 1
+
+
+def parse_shard(value):
+    # Parses a shard given as "i/N", where 0 <= i < N.
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError('Shard must be given as INDEX/COUNT, eg 0/4, not {!r}'.format(value))
+
+    if not 0 <= index < count:
+        raise ValueError('Shard index must be at least 0 and less than {}, not {}'.format(count, index))
+
+    return index, count
+
+
+def get_shard(rel_path, count):
+    # Returns the index of the shard that the file at rel_path belongs to.
+    # This depends only on rel_path, so every shard agrees on it.
+    digest = hashlib.blake2b(rel_path.replace(os.sep, '/').encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def get_manifest_path(output_path):
+    return output_path.rstrip(os.sep) + '.manifest.json'
+
+
+class RecordingSink:
+    # Wraps a sink (see django_amber.output), and records the path of every
+    # file written to it.
+    def __init__(self, sink):
+        self.sink = sink
+        self.rel_paths = []
+
+    def __getattr__(self, attr):
+        return getattr(self.sink, attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.sink.close()
+
+    def write(self, rel_path, content):
+        self.rel_paths.append(rel_path)
+        self.sink.write(rel_path, content)
+
+    def reserve(self, rel_path):
+        self.rel_paths.append(rel_path)
+        return self.sink.reserve(rel_path)
+
+    def copy_file(self, rel_path, source_path):
+        self.rel_paths.append(rel_path)
+        self.sink.copy_file(rel_path, source_path)
+
+
+class Manifest:
+    # Records what a build wrote.  pages maps the output path of every page
+    # that the build found (including those belonging to other shards) to its
+    # URL path, and files lists every file that the build wrote.
+    def __init__(self, shard=None, shards=None, pages=None, files=None):
+        self.shard = shard
+        self.shards = shards
+        self.pages = pages or {}
+        self.files = files or []
+
+    def as_dict(self):
+        return {
+            'version': MANIFEST_VERSION,
+            'shard': self.shard,
+            'shards': self.shards,
+            'pages': dict(sorted(self.pages.items())),
+            'files': sorted(self.files),
+        }
+
+    def write(self, path):
+        dir_path = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dir_path, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-')
+        with open(fd, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError('{} is not a manifest that this version of django-amber can read'.format(path))
+
+        return cls(data['shard'], data['shards'], data['pages'], data['files'])
+
+
+def check_manifests(manifests):
+    # Returns a list of problems with the manifests of a sharded build: shards
+    # that are missing or given twice, pages that no shard wrote, and files
+    # that more than one shard wrote.
+    problems = []
+
+    counts = sorted({manifest.shards for manifest in manifests}, key=str)
+    if len(counts) != 1 or counts[0] is None:
+        return ['Manifests are not all from a build with the same number of shards (found {})'.format(
+            ', '.join(str(count) for count in counts)
+        )]
+
+    count = counts[0]
+    indexes = [manifest.shard for manifest in manifests]
+
+    for index in range(count):
+        if indexes.count(index) == 0:
+            problems.append('Shard {}/{} is missing'.format(index, count))
+        elif indexes.count(index) > 1:
+            problems.append('Shard {}/{} is given more than once'.format(index, count))
+
+    writers = {}
+    for manifest in manifests:
+        for rel_path in manifest.files:
+            writers.setdefault(rel_path, []).append(manifest.shard)
+
+    for rel_path, shards in sorted(writers.items()):
+        if len(shards) > 1:
+            problems.append('{} was written by shards {}'.format(rel_path, ', '.join(str(shard) for shard in shards)))
+
+    pages = {}
+    for manifest in manifests:
+        pages.update(manifest.pages)
+
+    for rel_path, url_path in sorted(pages.items()):
+        if rel_path not in writers:
+            problems.append('{} (for {}) was not written by any shard'.format(rel_path, url_path))
+
+    return problems
+
+
+class DirectoryShard:
+    # The output of one shard of a build, written to a directory.
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def list_files(self):
+        rel_paths = set()
+        for dir_path, dir_names, filenames in os.walk(self.path):
+            for filename in filenames:
+                rel_paths.add(os.path.relpath(os.path.join(dir_path, filename), self.path))
+        rel_paths.discard(OUTPUT_MARKER)
+        return rel_paths
+
+    def copy_file(self, rel_path, sink):
+        sink.copy_file(rel_path, os.path.join(self.path, rel_path))
+
+    def close(self):
+        pass
+
+
+class TarShard(DirectoryShard):
+    # The output of one shard of a build, written to a tar archive.  Archives
+    # compressed with zstd are decompressed to a temporary file first, since
+    # tarfile can't read them.
+    def __init__(self, path):
+        self.tmp_file = None
+
+        if path.endswith('.tar.zst'):
+            try:
+                import zstandard
+            except ImportError:
+                raise ImproperlyConfigured('Reading .tar.zst archives requires zstandard')
+
+            self.tmp_file = tempfile.TemporaryFile()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(zstandard.ZstdDecompressor().stream_reader(f), self.tmp_file)
+            self.tmp_file.seek(0)
+            self.tar = tarfile.open(fileobj=self.tmp_file, mode='r:')
+        else:
+            self.tar = tarfile.open(path, mode='r:*')
+
+        self.members = {
+            member.name.replace('/', os.sep): member
+            for member in self.tar.getmembers()
+            if member.isfile() or member.islnk()
+        }
+
+    def list_files(self):
+        return set(self.members)
+
+    def copy_file(self, rel_path, sink):
+        # extractfile() follows hard links.
+        sink.write(rel_path, self.tar.extractfile(self.members[rel_path]).read())
+
+    def close(self):
+        self.tar.close()
+        if self.tmp_file is not None:
+            self.tmp_file.close()
+
+
+class ZipShard(DirectoryShard):
+    # The output of one shard of a build, written to a zip archive.
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path)
+        self.names = {
+            name.replace('/', os.sep): name
+            for name in self.zip.namelist()
+            if not name.endswith('/')
+        }
+
+    def list_files(self):
+        return set(self.names)
+
+    def copy_file(self, rel_path, sink):
+        sink.write(rel_path, self.zip.read(self.names[rel_path]))
+
+    def close(self):
+        self.zip.close()
+
+
+def open_shard(path):
+    # Returns a reader for the output of a shard at path, based on its suffix,
+    # as with django_amber.output.open_sink.
+    if path.endswith('.zip'):
+        return ZipShard(path)
+    elif path.endswith(('.tar', '.tar.gz', '.tgz', '.tar.zst')):
+        return TarShard(path)
+    else:
+        return DirectoryShard(path)
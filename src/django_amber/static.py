@@ -0,0 +1,63 @@
+import mimetypes
+import os
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+
+
+IGNORE_PATTERNS = ['CVS', '.*', '*~']
+
+
+def get_static_url_path():
+    return urlparse(settings.STATIC_URL).path
+
+
+def get_static_files():
+    # Returns a sorted list of (path, source_path) pairs for every static
+    # file, where path is relative to STATIC_URL.  If collectstatic has been
+    # run, the files are taken from STATIC_ROOT.  Otherwise, they are found in
+    # the same way that collectstatic would find them.
+    static_root = getattr(settings, 'STATIC_ROOT', None)
+    files = {}
+
+    if static_root and os.path.isdir(static_root):
+        for dir_path, dir_names, filenames in os.walk(static_root):
+            dir_names[:] = [name for name in dir_names if not name.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                source_path = os.path.join(dir_path, filename)
+                files[os.path.relpath(source_path, static_root)] = source_path
+    else:
+        for finder in get_finders():
+            for path, storage in finder.list(IGNORE_PATTERNS):
+                prefix = getattr(storage, 'prefix', None)
+                prefixed_path = os.path.join(prefix, path) if prefix else path
+
+                # As with collectstatic, the first finder to find a file wins.
+                if prefixed_path not in files:
+                    files[prefixed_path] = storage.path(path)
+
+    return sorted(files.items())
+
+
+def export_static_files(sink, compressor=None, select=None):
+    # Adds every static file to the output, at the path it would be served at.
+    # If select is given, a file is only added if select returns True for its
+    # path in the output.
+    static_rel_path = get_static_url_path().strip('/')
+
+    for path, source_path in get_static_files():
+        rel_path = os.path.join(static_rel_path, path)
+
+        if select is not None and not select(rel_path):
+            continue
+
+        sink.copy_file(rel_path, source_path)
+
+        if compressor is not None:
+            content_type, _ = mimetypes.guess_type(path)
+            if content_type in compressor.content_types:
+                with open(source_path, 'rb') as f:
+                    compressor.compress(rel_path, f.read(), content_type)
@@ -0,0 +1,13 @@
+from django import template
+
+from ..rendering import render_content as _render_content
+
+
+register = template.Library()
+
+
+@register.filter
+def render_content(content, content_format='md'):
+    # Renders content that isn't the body of a ModelWithContent, eg
+    # {{ author.bio|render_content:"rst" }}.
+    return _render_content(content, content_format)
@@ -1,28 +1,7 @@
-from multiprocessing import Process
 from time import sleep
 from socket import socket
 
-import requests
-
-from django.core.management import call_command
-from django.core.management.commands.runserver import Command as RunserverCommand
-
-
-default_port = RunserverCommand.default_port
-
-
-def run_runserver_in_process(port=default_port):
-    p = Process(
-        target=call_command,
-        args=('runserver', port),
-        kwargs={'use_reloader': False},
-    )
-
-    p.start()
-
-    wait_for_server(port)
-
-    return p
+from .server import DEFAULT_PORT as default_port
 
 
 def wait_for_server(port=default_port):
@@ -30,6 +9,9 @@ def wait_for_server(port=default_port):
 
 
 def get_with_retries(url, num_retries=5):
+    # requests is slow to import, and only needed here.
+    import requests
+
     for i in range(num_retries):
         try:
             return requests.get(url)
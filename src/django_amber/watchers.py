@@ -0,0 +1,392 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+from time import sleep, time
+
+from django.conf import settings
+
+from .models import DjangoPagesModel
+
+
+def get_dump_dir_paths():
+    return [model.get_dump_dir_path() for model in DjangoPagesModel.subclasses()]
+
+
+def get_mtimes(dir_paths=None):
+    return DirectoryScanner(dir_paths).scan()
+
+
+def compare_mtimes(old_mtimes, new_mtimes):
+    changed_paths = []
+    missing_paths = []
+
+    for path, old_mtime in old_mtimes.items():
+        new_mtime = new_mtimes.get(path)
+        if new_mtime is None:
+            missing_paths.append(path)
+        elif new_mtime != old_mtime:
+            changed_paths.append(path)
+
+    for path in new_mtimes:
+        if path not in old_mtimes:
+            changed_paths.append(path)
+
+    return changed_paths, missing_paths
+
+
+class DirectoryScanner:
+    # Directory listings are cached, and a directory is only listed again if
+    # its mtime has changed.  Every file still needs to be stat-ed on each
+    # scan, since modifying a file in place doesn't change the mtime of its
+    # directory.
+
+    # A directory modified within this many seconds of being listed might be
+    # modified again without its mtime changing, so its listing isn't trusted.
+    racy_window = 1.0
+
+    def __init__(self, dir_paths=None):
+        if dir_paths is None:
+            dir_paths = get_dump_dir_paths()
+
+        self.dir_paths = dir_paths
+        self.listings = {}
+
+    def scan(self):
+        mtimes = {}
+        listings = {}
+        todo = list(self.dir_paths)
+
+        while todo:
+            dir_path = todo.pop()
+            listing = self.list_dir(dir_path)
+            if listing is None:
+                continue
+
+            listings[dir_path] = listing
+            _, _, file_paths, subdir_paths = listing
+            todo.extend(subdir_paths)
+
+            for path in file_paths:
+                try:
+                    mtimes[path] = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    # Race condition: the file has disappeared in the time
+                    # between the listing and the stat.
+                    pass
+
+        # This also drops listings of directories that have disappeared.
+        self.listings = listings
+
+        return mtimes
+
+    def list_dir(self, dir_path):
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+        listing = self.listings.get(dir_path)
+        if listing is not None:
+            cached_mtime, listed_at, _, _ = listing
+            if cached_mtime == dir_mtime and listed_at - dir_mtime > self.racy_window:
+                return listing
+
+        listed_at = time()
+        file_paths = []
+        subdir_paths = []
+
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdir_paths.append(entry.path)
+                    elif entry.name[0] != '.':
+                        file_paths.append(entry.path)
+        except FileNotFoundError:
+            return None
+
+        return dir_mtime, listed_at, file_paths, subdir_paths
+
+
+class ChangeBatch:
+    # Collects changes until they are applied.  Only the latest change to each
+    # path matters: a file that is changed and then removed is just removed.
+    def __init__(self):
+        self.paths = {}
+
+    def add(self, changed_paths, missing_paths):
+        for path in changed_paths:
+            self.paths[path] = True
+
+        for path in missing_paths:
+            self.paths[path] = False
+
+    @property
+    def changed_paths(self):
+        return [path for path, exists in self.paths.items() if exists]
+
+    @property
+    def missing_paths(self):
+        return [path for path, exists in self.paths.items() if not exists]
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def wait_for_batch(watcher, batch, quiet_period=0.05, max_wait=2.0):
+    # Blocks until there is at least one change, and then keeps adding changes
+    # to the batch until none have arrived for quiet_period seconds, so that eg
+    # a `git checkout` is applied in one go.
+    batch.add(*watcher.wait())
+    deadline = time() + max_wait
+
+    while True:
+        timeout = min(quiet_period, deadline - time())
+        if timeout <= 0:
+            break
+
+        changed_paths, missing_paths = watcher.wait(timeout=timeout)
+        if not (changed_paths or missing_paths):
+            break
+
+        batch.add(changed_paths, missing_paths)
+
+
+class PollingWatcher:
+    def __init__(self, dir_paths=None, interval=0.1):
+        self.scanner = DirectoryScanner(dir_paths)
+        self.interval = interval
+        self.mtimes = self.scanner.scan()
+
+    def wait(self, timeout=None):
+        # Returns (changed_paths, missing_paths), blocking until there is at
+        # least one change, or until timeout seconds have passed.
+        deadline = None if timeout is None else time() + timeout
+
+        while True:
+            new_mtimes = self.scanner.scan()
+            changed_paths, missing_paths = compare_mtimes(self.mtimes, new_mtimes)
+            self.mtimes = new_mtimes
+
+            if changed_paths or missing_paths:
+                return changed_paths, missing_paths
+
+            if deadline is not None and time() >= deadline:
+                return [], []
+
+            sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+# Constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class InotifyWatcher:
+    def __init__(self, dir_paths=None):
+        if dir_paths is None:
+            dir_paths = get_dump_dir_paths()
+
+        self.libc = load_libc()
+        if self.libc is None:
+            raise OSError('inotify is not available on this platform')
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+        self.dir_paths = dir_paths
+        self.wds = {}
+        self.parent_wds = {}
+        self.paths = set()
+
+        try:
+            for dir_path in dir_paths:
+                # We also watch the parent of each dump directory, so that we
+                # notice if a dump directory is removed and then recreated (as
+                # happens when running dumppages).
+                parent_path = os.path.dirname(dir_path)
+                self.parent_wds[self.add_watch(parent_path)] = parent_path
+                self.add_tree(dir_path)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, dir_path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dir_path)
+        return wd
+
+    def add_tree(self, dir_path):
+        # Returns the paths of any files found in the tree.
+        found_paths = []
+
+        for root, dir_names, file_names in os.walk(dir_path):
+            self.wds[self.add_watch(root)] = root
+            for file_name in file_names:
+                if file_name[0] != '.':
+                    path = os.path.join(root, file_name)
+                    found_paths.append(path)
+                    self.paths.add(path)
+
+        return found_paths
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, name
+
+    def wait(self, timeout=None):
+        # Returns (changed_paths, missing_paths), blocking until there is at
+        # least one change, or until timeout seconds have passed.
+        deadline = None if timeout is None else time() + timeout
+
+        touched_paths = set()
+
+        while not touched_paths:
+            if deadline is None:
+                timeout_ms = None
+            else:
+                timeout_ms = max(0, int((deadline - time()) * 1000))
+
+            if not self.poller.poll(timeout_ms):
+                return [], []
+
+            # Drain everything that has queued up, so that eg a `git checkout`
+            # is reported as a single batch.
+            while self.poller.poll(0):
+                touched_paths.update(self.handle_events())
+
+        changed_paths = []
+        missing_paths = []
+
+        for path in touched_paths:
+            if os.path.isfile(path):
+                changed_paths.append(path)
+                self.paths.add(path)
+            elif path in self.paths:
+                missing_paths.append(path)
+                self.paths.remove(path)
+
+        return changed_paths, missing_paths
+
+    def handle_events(self):
+        touched_paths = set()
+
+        for wd, mask, name in self.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # We have missed some events, so treat every file as touched.
+                touched_paths.update(self.paths)
+                for dir_path in self.dir_paths:
+                    if os.path.isdir(dir_path):
+                        touched_paths.update(self.add_tree(dir_path))
+                continue
+
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+                self.parent_wds.pop(wd, None)
+                continue
+
+            if wd in self.parent_wds and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                path = os.path.join(self.parent_wds[wd], name)
+                if path in self.dir_paths:
+                    try:
+                        touched_paths.update(self.add_tree(path))
+                    except OSError:
+                        pass
+
+            dir_path = self.wds.get(wd)
+            if dir_path is None or not name:
+                continue
+
+            path = os.path.join(dir_path, name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        touched_paths.update(self.add_tree(path))
+                    except OSError:
+                        # The directory has already gone away again.
+                        pass
+                elif mask & IN_MOVED_FROM:
+                    prefix = path + os.sep
+                    touched_paths.update(p for p in self.paths if p.startswith(prefix))
+            elif name[0] != '.':
+                touched_paths.add(path)
+
+        return touched_paths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def get_watcher(dir_paths=None):
+    backend = getattr(settings, 'DJANGO_AMBER_WATCHER', None)
+
+    if backend == 'polling':
+        return PollingWatcher(dir_paths)
+
+    try:
+        return InotifyWatcher(dir_paths)
+    except OSError:
+        if backend == 'inotify':
+            raise
+
+    return PollingWatcher(dir_paths)
@@ -1,5 +1,5 @@
 from django.db import models
-from django_amber.models import ModelWithContent, ModelWithoutContent
+from django_amber.models import ModelWithContent, ModelWithoutContent, key_structure_index
 
 
 class Article(ModelWithContent):
@@ -12,6 +12,9 @@ class Article(ModelWithContent):
     dump_dir_path = 'tests/data/articles'
     key_structure = '[language]/[slug]'
 
+    class Meta:
+        indexes = [key_structure_index('[language]/[slug]')]
+
 
 class Author(ModelWithoutContent):
     name = models.CharField(max_length=255)
@@ -29,6 +32,9 @@ class Comment(ModelWithContent):
 
     key_structure = '[article]/[date]'
 
+    class Meta:
+        indexes = [key_structure_index('[article]/[date]')]
+
 
 class DateTimeModel(ModelWithoutContent):
     date = models.DateField(null=True)
@@ -0,0 +1,15 @@
+# Settings for running the tests against SQLite, which is the only backend
+# that supports the shadow databases used by serve (see django_amber.shadow).
+import os
+
+from .settings import *  # noqa
+
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'django-amber-test.sqlite3'),  # noqa
+        # The test database must also be a file, rather than in memory.
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'django-amber-test-test.sqlite3')},  # noqa
+    },
+}
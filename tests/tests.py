@@ -1,22 +1,43 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import datetime
 from filecmp import dircmp
+from functools import partial
 import glob
+import gzip
+import http.client
+from http.server import BaseHTTPRequestHandler
+from io import StringIO
+import json
 from multiprocessing import Process
 import os
+import pstats
 import signal
 import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
 from time import sleep
 import unittest
+from unittest import mock
+import zipfile
+
+import requests
 
 from django.conf import settings
 from django.core import management, serializers
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.db import IntegrityError, connection
 from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
+from benchmarks.corpus import generate_corpus
+from django_amber import compression, crawler, frontier, layouts, links, livereload, output, profiling, query_cache, references, rendering, server, shadow, sharding, watchers
 from django_amber.management.commands import serve
 from django.core.management.base import CommandError
-from django_amber.models import parse_dump_path
-from django_amber.serialization_helpers import dump_to_file, load_from_file
+from django_amber.models import DjangoPagesModel, parse_dump_path
+from django_amber.serialization_helpers import dump_to_file, load_from_file, LoadFromFileError
 from django_amber.serializer import Deserializer, Serializer
 from django_amber.utils import get_free_port, get_with_retries, wait_for_server
 
@@ -61,6 +82,16 @@ def set_up_dumped_data(valid_only=False):
             os.remove(path)
 
 
+def init_git_repo(path):
+    # Commits everything in path to a new git repository, and returns the
+    # commit's hash.
+    git = ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com']
+    subprocess.check_call(git + ['init', '-q'], cwd=path)
+    subprocess.check_call(git + ['add', '.'], cwd=path)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'Initial commit'], cwd=path)
+    return subprocess.check_output(git + ['rev-parse', 'HEAD'], cwd=path, universal_newlines=True).strip()
+
+
 def clear_dumped_data():
     shutil.rmtree(os.path.join('tests', 'data'), ignore_errors=True)
 
@@ -81,6 +112,10 @@ valid_data_paths = [os.path.abspath(rel_path) for rel_path in [
 
 
 class DjangoPagesTestCase(TestCase):
+    def setUp(self):
+        # The index outlives the transaction that each test is rolled back in.
+        references.index.clear()
+
     @classmethod
     def create_model_instances(cls):
         cls.tag1 = Tag.objects.create(key='django', name='Django')
@@ -159,11 +194,79 @@ class TestModel(DjangoPagesTestCase):
         self.article1.set_key()
         self.assertEqual(self.article1.key, 'en/django')
 
+    def test_key_is_unique(self):
+        self.assertTrue(Tag._meta.get_field('key').unique)
+        self.assertTrue(Article._meta.get_field('key').unique)
+
+    def test_key_structure_index(self):
+        self.assertEqual([index.fields for index in Article._meta.indexes], [['language', 'slug']])
+        self.assertEqual([index.fields for index in Comment._meta.indexes], [['article', 'date']])
+        self.assertEqual(Tag._meta.indexes, [])
+
     def test_parse_dump_path(self):
         path = os.path.join(settings.BASE_DIR, 'tests', 'data', 'articles', 'en', 'django.md')
         self.assertEqual(parse_dump_path(path), (Article, 'en/django', 'md'))
 
 
+@contextmanager
+def dump_layout(model, layout):
+    model.dump_layout = layout
+    try:
+        yield
+    finally:
+        model.dump_layout = None
+
+
+class TestLayouts(unittest.TestCase):
+    def test_hashed_layout(self):
+        layout = layouts.HashedLayout()
+        rel_path = layout.key_to_rel_path('en/django')
+
+        self.assertRegex(rel_path, r'^[0-9a-f]{2}/[0-9a-f]{2}/en/django$')
+        self.assertEqual(layout.rel_path_to_key(rel_path), 'en/django')
+        self.assertEqual(layouts.HashedLayout(levels=1).key_to_rel_path('en/django'), rel_path[:2] + '/en/django')
+
+        with self.assertRaises(ValueError):
+            layout.rel_path_to_key('00/00/en/django' if not rel_path.startswith('00/00/') else '11/11/en/django')
+
+        with self.assertRaises(ValueError):
+            layout.rel_path_to_key('django')
+
+    def test_date_layout(self):
+        layout = layouts.DateLayout()
+        rel_path = layout.key_to_rel_path('en/django/2016-12-31')
+
+        self.assertEqual(rel_path, '2016/12/en/django/2016-12-31')
+        self.assertEqual(layout.rel_path_to_key(rel_path), 'en/django/2016-12-31')
+
+        with self.assertRaises(ValueError):
+            layout.key_to_rel_path('en/django')
+
+        with self.assertRaises(ValueError):
+            layout.rel_path_to_key('2017/01/en/django/2016-12-31')
+
+    def test_get_layout(self):
+        self.assertIsInstance(layouts.get_layout(None), layouts.FlatLayout)
+        self.assertIsInstance(layouts.get_layout('hashed'), layouts.HashedLayout)
+
+        layout = layouts.HashedLayout(levels=1)
+        self.assertIs(layouts.get_layout(layout), layout)
+
+        with self.assertRaises(ValueError):
+            layouts.get_layout('nested')
+
+    def test_dump_path_with_layout(self):
+        comment = Comment(key='en/django/2016-12-31', content_format='md')
+
+        with dump_layout(Comment, 'date'):
+            path = comment.dump_path()
+            self.assertEqual(path, os.path.join(
+                Comment.get_dump_dir_path(), '2016', '12', 'en', 'django', '2016-12-31.md'
+            ))
+            self.assertEqual(parse_dump_path(path), (Comment, 'en/django/2016-12-31', 'md'))
+            self.assertEqual(Comment.fields_from_key('en/django/2016-12-31'), {'article': 'en/django', 'date': '2016-12-31'})
+
+
 class TestDeserialization(DjangoPagesTestCase):
     @classmethod
     def setUpClass(cls):
@@ -187,7 +290,7 @@ class TestDeserialization(DjangoPagesTestCase):
         self.assertEqual(obj.key, 'john')
         self.assertEqual(obj.name, 'John Jones')
         self.assertEqual(obj.editor.key, 'jane')
-        self.assertEqual([tag.key for tag in obj.tags.all()], ['django', 'python'])
+        self.assertEqual([tag.key for tag in obj.tags.order_by('key')], ['django', 'python'])
 
     def test_deserialization_with_content(self):
         Author.objects.create(key='jane', name='Jane Smith')
@@ -205,7 +308,7 @@ class TestDeserialization(DjangoPagesTestCase):
         self.assertEqual(obj.slug, 'django')
         self.assertEqual(obj.language, 'en')
         self.assertEqual(obj.author.key, 'jane')
-        self.assertEqual([tag.key for tag in obj.tags.all()], ['django'])
+        self.assertEqual([tag.key for tag in obj.tags.order_by('key')], ['django'])
 
     def test_deserialization_where_all_fields_in_key(self):
         Article.objects.create(
@@ -336,7 +439,7 @@ class TestLoadFromFile(DjangoPagesTestCase):
         self.assertEqual(obj.key, 'john')
         self.assertEqual(obj.name, 'John Jones')
         self.assertEqual(obj.editor.key, 'jane')
-        self.assertEqual([tag.key for tag in obj.tags.all()], ['django', 'python'])
+        self.assertEqual([tag.key for tag in obj.tags.order_by('key')], ['django', 'python'])
 
     def test_load_from_file_with_content(self):
         Author.objects.create(key='jane', name='Jane Smith')
@@ -354,7 +457,7 @@ class TestLoadFromFile(DjangoPagesTestCase):
         self.assertEqual(obj.slug, 'django')
         self.assertEqual(obj.language, 'en')
         self.assertEqual(obj.author.key, 'jane')
-        self.assertEqual([tag.key for tag in obj.tags.all()], ['django'])
+        self.assertEqual([tag.key for tag in obj.tags.order_by('key')], ['django'])
 
     def test_fk_forward_references(self):
         Tag.objects.create(key='django', name='Django')
@@ -378,7 +481,7 @@ class TestLoadFromFile(DjangoPagesTestCase):
         load_from_file(paths)
 
         obj = Author.objects.get(key='jane')
-        self.assertEqual([tag.key for tag in obj.tags.all()], ['django', 'python'])
+        self.assertEqual([tag.key for tag in obj.tags.order_by('key')], ['django', 'python'])
 
 
 class TestDumpToFile(DjangoPagesTestCase):
@@ -453,7 +556,7 @@ class TestLoadPages(DjangoPagesTestCase):
         self.assertEqual(obj.key, 'john')
         self.assertEqual(obj.name, 'John Jones')
         self.assertEqual(obj.editor.key, 'jane')
-        self.assertEqual([tag.key for tag in obj.tags.all()], ['django', 'python'])
+        self.assertEqual([tag.key for tag in obj.tags.order_by('key')], ['django', 'python'])
 
         obj = Article.objects.get(key='en/django')
         self.assertEqual(obj.key, 'en/django')
@@ -463,7 +566,7 @@ class TestLoadPages(DjangoPagesTestCase):
         self.assertEqual(obj.slug, 'django')
         self.assertEqual(obj.language, 'en')
         self.assertEqual(obj.author.key, 'jane')
-        self.assertEqual([tag.key for tag in obj.tags.all()], ['django'])
+        self.assertEqual([tag.key for tag in obj.tags.order_by('key')], ['django'])
 
         obj = Comment.objects.get(key= 'en/django/2016-12-31')
         self.assertEqual(obj.key, 'en/django/2016-12-31')
@@ -491,6 +594,810 @@ class TestLoadPages(DjangoPagesTestCase):
 
         management.call_command('loadpages', verbosity=0)
 
+    def test_loadpages_since(self):
+        set_up_dumped_data(valid_only=True)
+        rev = init_git_repo(os.path.join('tests', 'data'))
+        management.call_command('loadpages', verbosity=0)
+
+        # If every file were loaded again, this would be overwritten.
+        Author.objects.filter(key='john').update(name='Not John')
+
+        with open(get_path('author', 'jane'), 'a') as f:
+            f.write('editor: john\n')
+        with open(get_path('tag', 'ruby'), 'w') as f:
+            f.write('name: Ruby\n')
+        with open(get_path('tag', '.ruby') + '.swp', 'w') as f:
+            f.write('not yaml: [\n')
+        os.remove(get_path('tag', 'python'))
+        subprocess.check_call(
+            ['git', 'mv', 'comment/en/django/2016-12-31.md', 'comment/en/django/2017-01-01.md'],
+            cwd=os.path.join('tests', 'data'),
+        )
+
+        management.call_command('loadpages', verbosity=0, since=rev)
+
+        self.assertEqual(Author.objects.get(key='jane').editor.key, 'john')
+        self.assertEqual(Author.objects.get(key='john').name, 'Not John')
+        self.assertEqual(sorted(Tag.objects.values_list('key', flat=True)), ['django', 'ruby'])
+        self.assertEqual(list(Comment.objects.values_list('key', flat=True)), ['en/django/2017-01-01'])
+
+    def test_loadpages_since_unknown_rev(self):
+        set_up_dumped_data(valid_only=True)
+        init_git_repo(os.path.join('tests', 'data'))
+
+        with self.assertRaises(CommandError):
+            management.call_command('loadpages', verbosity=0, since='no-such-rev')
+
+
+class TestMigrateLayout(DjangoPagesTestCase):
+    def test_migratelayout(self):
+        set_up_dumped_data(valid_only=True)
+        old_path = get_path('tag', 'django')
+
+        with dump_layout(Tag, 'hashed'):
+            new_path = Tag.get_dump_path('django', 'yml')
+            self.assertNotEqual(new_path, old_path)
+
+            management.call_command('migratelayout', 'tests.tag', verbosity=0)
+
+            self.assertFalse(os.path.exists(old_path))
+            self.assertTrue(os.path.exists(new_path))
+            self.assertTrue(os.path.exists(get_path('author', 'jane')))
+
+            # Running the migration again does nothing.
+            management.call_command('migratelayout', 'tests.tag', verbosity=0)
+            self.assertTrue(os.path.exists(new_path))
+
+            management.call_command('loadpages', verbosity=0)
+            self.assertEqual(sorted(Tag.objects.values_list('key', flat=True)), ['django', 'python'])
+            self.assertEqual([tag.key for tag in Author.objects.get(key='jane').tags.order_by('key')], ['django', 'python'])
+
+        management.call_command('migratelayout', 'tests.tag', verbosity=0, from_layout='hashed')
+
+        self.assertTrue(os.path.exists(old_path))
+        self.assertEqual(sorted(os.listdir(Tag.get_dump_dir_path())), ['django.yml', 'python.yml'])
+
+    def test_migratelayout_with_key_that_does_not_fit_layout(self):
+        set_up_dumped_data(valid_only=True)
+
+        with dump_layout(Comment, 'date'), dump_layout(Tag, 'date'):
+            with self.assertRaises(CommandError):
+                management.call_command('migratelayout', verbosity=0)
+
+        # Nothing was moved.
+        self.assertTrue(os.path.exists(get_path('comment', 'en/django/2016-12-31')))
+
+
+class TestProfiling(DjangoPagesTestCase):
+    def setUp(self):
+        set_up_dumped_data(valid_only=True)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_loadpages_profile(self):
+        report_path = os.path.join(self.tmp_dir, 'report.json')
+        management.call_command('loadpages', verbosity=0, profile=report_path)
+
+        with open(report_path) as f:
+            report = json.load(f)
+
+        self.assertEqual(report['command'], 'loadpages')
+        spans = {span['name']: span for span in report['spans']}
+        self.assertEqual(spans['loadpages/migrate']['count'], 1)
+        self.assertEqual(spans['loadpages/load/save']['count'], len(valid_data_paths))
+        self.assertIn('loadpages/load/parse', spans)
+        self.assertIn('loadpages/load/save deferred fields', spans)
+
+    def test_profile_stats(self):
+        stats_dir = os.path.join(self.tmp_dir, 'stats')
+        management.call_command('loadpages', verbosity=0, profile_stats=stats_dir)
+
+        self.assertIn('loadpages.pstats', os.listdir(stats_dir))
+        self.assertIn('loadpages.load.parse.pstats', os.listdir(stats_dir))
+        stats = pstats.Stats(os.path.join(stats_dir, 'loadpages.load.parse.pstats'))
+        self.assertTrue(stats.total_calls > 0)
+
+    def test_custom_spans(self):
+        with profiling.profile('custom') as profiler:
+            with profiling.span('outer'):
+                with profiling.span('inner'):
+                    pass
+                with profiling.span('inner'):
+                    pass
+
+        spans = {span['name']: span for span in profiler.report()['spans']}
+        self.assertEqual(spans['custom/outer']['count'], 1)
+        self.assertEqual(spans['custom/outer/inner']['count'], 2)
+
+    def test_span_without_profiler(self):
+        with profiling.span('nothing'):
+            pass
+
+
+class TestBenchmarkCorpus(TestCase):
+    def tearDown(self):
+        clear_dumped_data()
+
+    def test_generate_corpus(self):
+        counts = generate_corpus(200)
+        self.assertEqual(sum(counts.values()), 200)
+
+        management.call_command('loadpages', verbosity=0)
+
+        for model, count in counts.items():
+            self.assertEqual(model.objects.count(), count)
+
+        self.assertTrue(Author.objects.filter(editor__isnull=False).exists())
+        self.assertTrue(Article.objects.filter(tags__isnull=False).exists())
+
+
+class TestQueryCache(TestCase):
+    def setUp(self):
+        query_cache.enable()
+        self.addCleanup(query_cache.disable)
+
+    def test_repeated_queries_are_cached(self):
+        Tag.objects.create(key='django', name='Django')
+
+        with CaptureQueriesContext(connection) as ctx:
+            for _ in range(2):
+                self.assertEqual([tag.name for tag in Tag.objects.all()], ['Django'])
+                self.assertEqual(Tag.objects.filter(key='django').count(), 1)
+                self.assertEqual(Tag.objects.filter(key='python').count(), 0)
+
+        self.assertEqual(len(ctx.captured_queries), 3)
+
+    def test_cache_is_bounded(self):
+        Tag.objects.create(key='django', name='Django')
+        query_cache.cache.max_size = 2
+
+        with CaptureQueriesContext(connection) as ctx:
+            for key in ['django', 'python', 'django', 'flask', 'django', 'python']:
+                Tag.objects.filter(key=key).count()
+
+        # The query for python was dropped when flask's was cached, but the
+        # one for django was used more recently, so was kept.
+        self.assertEqual(len(ctx.captured_queries), 4)
+        self.assertEqual(len(query_cache.cache.results), 2)
+
+    def test_writes_invalidate_cache(self):
+        Tag.objects.create(key='django', name='Django')
+        self.assertEqual(Tag.objects.count(), 1)
+
+        Tag.objects.create(key='python', name='Python')
+        self.assertEqual(Tag.objects.count(), 2)
+
+        Tag.objects.filter(key='python').update(name='Python 3')
+        self.assertEqual(Tag.objects.get(key='python').name, 'Python 3')
+
+
+render_calls = []
+
+
+def render_upper(content):
+    render_calls.append(content)
+    return content.upper()
+
+
+class TestRendering(TestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        overrides = override_settings(
+            DJANGO_AMBER_CACHE_DIR=cache_dir,
+            DJANGO_AMBER_CONTENT_RENDERERS={'txt': 'tests.tests.render_upper'},
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        rendering.cache.clear()
+        render_calls.clear()
+
+    def test_rendered_content(self):
+        article = Article(content='This is *important*', content_format='md')
+        self.assertEqual(article.rendered_content, '<p>This is <em>important</em></p>\n')
+
+    def test_render_content_is_cached(self):
+        self.assertEqual(rendering.render_content('abc', 'txt'), 'ABC')
+        self.assertEqual(rendering.render_content('abc', 'txt'), 'ABC')
+        self.assertEqual(render_calls, ['abc'])
+
+        # The rendered content is still cached on disk.
+        rendering.cache.clear()
+        self.assertEqual(rendering.render_content('abc', 'txt'), 'ABC')
+        self.assertEqual(render_calls, ['abc'])
+
+        self.assertEqual(rendering.render_content('abcd', 'txt'), 'ABCD')
+        self.assertEqual(render_calls, ['abc', 'abcd'])
+
+    def test_cache_key_depends_on_renderer(self):
+        md_path = 'django_amber.rendering.render_markdown'
+        key = rendering.get_cache_key(md_path, 'md', 'abc')
+
+        with override_settings(MARKDOWN_DEUX_STYLES={'default': {'safe_mode': False}}):
+            self.assertNotEqual(rendering.get_cache_key(md_path, 'md', 'abc'), key)
+
+        with mock.patch.dict(rendering.library_versions, {'markdown2': '0.0.1'}):
+            self.assertNotEqual(rendering.get_cache_key(md_path, 'md', 'abc'), key)
+
+        self.assertEqual(rendering.get_cache_key(md_path, 'md', 'abc'), key)
+
+        # Other renderers are distinguished by DJANGO_AMBER_RENDER_CACHE_VERSION.
+        self.assertEqual(rendering.render_content('abc', 'txt'), 'ABC')
+        with override_settings(DJANGO_AMBER_RENDER_CACHE_VERSION=2):
+            self.assertEqual(rendering.render_content('abc', 'txt'), 'ABC')
+        self.assertEqual(render_calls, ['abc', 'abc'])
+
+    def test_clearcache(self):
+        self.assertEqual(rendering.render_content('abc', 'txt'), 'ABC')
+
+        management.call_command('clearcache', verbosity=0)
+        rendering.cache.clear()
+
+        self.assertEqual(rendering.render_content('abc', 'txt'), 'ABC')
+        self.assertEqual(render_calls, ['abc', 'abc'])
+
+        with self.assertRaises(CommandError):
+            management.call_command('clearcache', 'queries', verbosity=0)
+
+    def test_render_content_with_unknown_format(self):
+        with self.assertRaises(ValueError):
+            rendering.render_content('abc', 'xyz')
+
+
+class TestOutputWriter(unittest.TestCase):
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_path)
+
+    def test_get_output_path(self):
+        self.assertEqual(output.get_output_path('/'), 'index.html')
+        self.assertEqual(output.get_output_path('/articles/'), os.path.join('articles', 'index.html'))
+        self.assertEqual(output.get_output_path('/articles/en/django'), os.path.join('articles', 'en', 'django', 'index.html'))
+        self.assertEqual(output.get_output_path('/static/main.css'), os.path.join('static', 'main.css'))
+
+    def test_write(self):
+        with output.OutputWriter(self.output_path, max_workers=2, max_pending=2) as writer:
+            for ix in range(20):
+                writer.write(os.path.join('pages', str(ix % 3), '{}.html'.format(ix)), str(ix).encode('utf8'))
+
+        for ix in range(20):
+            with open(os.path.join(self.output_path, 'pages', str(ix % 3), '{}.html'.format(ix))) as f:
+                self.assertEqual(f.read(), str(ix))
+
+        # No temporary files are left behind.
+        self.assertEqual(len(glob.glob(os.path.join(self.output_path, 'pages', '*', '*'))), 20)
+        self.assertEqual(glob.glob(os.path.join(self.output_path, 'pages', '*', '.tmp-*')), [])
+
+    def test_write_same_path(self):
+        # Eg /articles/?page=2 and /articles/ are both written to
+        # articles/index.html, and the last one written wins.
+        with output.OutputWriter(self.output_path, max_workers=4) as writer:
+            for ix in range(50):
+                writer.write('index.html', str(ix).encode('utf8') * (1000 if ix % 2 else 1))
+            writer.write('index.html', b'last')
+
+            slots = [writer.reserve('index.html.gz') for _ in range(10)]
+            for ix, slot in reversed(list(enumerate(slots))):
+                slot.set_result(str(ix).encode('utf8'))
+
+        with open(os.path.join(self.output_path, 'index.html')) as f:
+            self.assertEqual(f.read(), 'last')
+
+        with open(os.path.join(self.output_path, 'index.html.gz')) as f:
+            self.assertEqual(f.read(), '9')
+
+        self.assertEqual(writer.pending, {})
+        self.assertEqual(writer.reservations, {})
+
+    def test_dedupe(self):
+        with output.OutputWriter(self.output_path, dedupe=True) as writer:
+            for ix in range(10):
+                writer.write(os.path.join(str(ix), 'index.html'), b'same')
+            writer.write('other.html', b'other')
+
+        inodes = {os.stat(os.path.join(self.output_path, str(ix), 'index.html')).st_ino for ix in range(10)}
+        self.assertEqual(len(inodes), 1)
+        self.assertNotIn(os.stat(os.path.join(self.output_path, 'other.html')).st_ino, inodes)
+        self.assertEqual(writer.dedupe_stats, {'linked_files': 9, 'linked_bytes': 36})
+
+    def test_copy_file(self):
+        source_path = os.path.join(self.output_path, 'source.css')
+        with open(source_path, 'w') as f:
+            f.write('body {}')
+
+        # Files are copied, unless links are asked for.
+        for link_files, expected in [(False, False), (True, True)]:
+            with output.OutputWriter(self.output_path, link_files=link_files) as writer:
+                writer.copy_file(os.path.join(str(link_files), 'main.css'), source_path)
+
+            path = os.path.join(self.output_path, str(link_files), 'main.css')
+            with open(path) as f:
+                self.assertEqual(f.read(), 'body {}')
+            self.assertEqual(os.path.samefile(path, source_path), expected)
+
+    def test_write_error_is_raised(self):
+        # A file where a directory needs to be.
+        with open(os.path.join(self.output_path, 'pages'), 'w'):
+            pass
+
+        with self.assertRaises(OSError):
+            with output.OutputWriter(self.output_path) as writer:
+                writer.write(os.path.join('pages', 'index.html'), b'')
+
+    def test_prepare_output_dir(self):
+        path = os.path.join(self.output_path, 'site')
+        base_dir = os.path.join(self.output_path, 'project')
+
+        # A directory that doesn't exist yet, or is empty, is created and
+        # marked.
+        output.prepare_output_dir(path, base_dir)
+        self.assertEqual(os.listdir(path), [output.OUTPUT_MARKER])
+
+        # A marked directory is cleared.
+        with open(os.path.join(path, 'index.html'), 'w'):
+            pass
+        output.prepare_output_dir(path, base_dir)
+        self.assertEqual(os.listdir(path), [output.OUTPUT_MARKER])
+
+        # Archives are left alone.
+        output.prepare_output_dir(path + '.zip', base_dir)
+        self.assertFalse(os.path.exists(path + '.zip'))
+
+    def test_prepare_output_dir_refuses_unmarked_dir(self):
+        path = os.path.join(self.output_path, 'site')
+        os.makedirs(path)
+        with open(os.path.join(path, 'notes.txt'), 'w'):
+            pass
+
+        with self.assertRaises(output.OutputPathError):
+            output.prepare_output_dir(path, os.path.join(self.output_path, 'project'))
+
+        self.assertEqual(os.listdir(path), ['notes.txt'])
+
+    def test_prepare_output_dir_refuses_project_dir(self):
+        base_dir = os.path.join(self.output_path, 'project')
+        os.makedirs(base_dir)
+        with open(os.path.join(self.output_path, output.OUTPUT_MARKER), 'w'):
+            pass
+
+        for path in [base_dir, self.output_path]:
+            with self.assertRaises(output.OutputPathError):
+                output.prepare_output_dir(path, base_dir)
+
+        self.assertTrue(os.path.isdir(base_dir))
+
+
+class TestCrawler(unittest.TestCase):
+    pages = {
+        '/': '<a href="/a/">A</a> <a href="/b/">B</a> <a href="mailto:x@example.com">x</a>',
+        '/a/': '<a href="/c/">C</a> <a href="/">Home</a> <a href="/b/#top">B</a>',
+        '/b/': '<a href="/old/">Old</a>',
+        '/c/': '<link rel="stylesheet" href="/main.css">',
+        '/new/': 'New',
+    }
+
+    def start_server(self, protocol_version):
+        pages = self.pages
+        connections = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def setup(self):
+                super().setup()
+                connections.append(self)
+
+            def do_GET(self):
+                if self.path == '/old/':
+                    self.send_response(301)
+                    self.send_header('Location', '/new/')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                if self.path == '/main.css':
+                    content_type = 'text/css'
+                    content = b'body { color: red }'
+                elif self.path in pages:
+                    content_type = 'text/html; charset=utf-8'
+                    content = pages[self.path].encode('utf8')
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        Handler.protocol_version = protocol_version
+
+        httpd = livereload.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            httpd.shutdown()
+            httpd.server_close()
+
+        self.addCleanup(stop)
+        return 'http://127.0.0.1:{}/'.format(httpd.server_port), connections
+
+    def crawl(self, protocol_version, **kwargs):
+        base_url, connections = self.start_server(protocol_version)
+        rsps = list(crawler.crawl(base_url, **kwargs))
+        urls = [rsp.url[len(base_url) - 1:] for rsp in rsps]
+        return urls, rsps, connections
+
+    def test_crawl_with_keep_alive(self):
+        urls, rsps, connections = self.crawl('HTTP/1.1', connections=2, pipeline_depth=4)
+        self.assertEqual(urls, ['/', '/a/', '/b/', '/c/', '/main.css', '/new/'])
+        self.assertEqual(rsps[0].headers['content-type'], 'text/html; charset=utf-8')
+        self.assertEqual(rsps[4].content, b'body { color: red }')
+        self.assertTrue(len(connections) <= 2)
+
+    def test_crawl_with_many_shallow_connections(self):
+        # Connections often run out of requests and are then sent new ones,
+        # which must not be left unread.
+        self.pages = {'/': ' '.join('<a href="/{}/">{}</a>'.format(ix, ix) for ix in range(200))}
+        for ix in range(200):
+            self.pages['/{}/'.format(ix)] = '<a href="/{}/">Next</a>'.format((ix + 1) % 200)
+
+        def crawl():
+            results.append(self.crawl('HTTP/1.1', concurrency=64, connections=32, pipeline_depth=2))
+
+        for _ in range(3):
+            results = []
+            thread = threading.Thread(target=crawl, daemon=True)
+            thread.start()
+            thread.join(30)
+            self.assertFalse(thread.is_alive(), 'Crawl hung')
+            self.assertEqual(len(results[0][0]), 201)
+
+    def test_crawl_without_keep_alive(self):
+        urls, _, connections = self.crawl('HTTP/1.0', connections=2, pipeline_depth=4)
+        self.assertEqual(urls, ['/', '/a/', '/b/', '/c/', '/main.css', '/new/'])
+
+    def test_crawl_order_does_not_depend_on_concurrency(self):
+        urls, _, _ = self.crawl('HTTP/1.1', concurrency=1, connections=1, pipeline_depth=1)
+        self.assertEqual(urls, ['/', '/a/', '/b/', '/c/', '/main.css', '/new/'])
+
+    def test_crawl_with_priority(self):
+        urls, _, _ = self.crawl('HTTP/1.1', priority=lambda url: 0 if url.endswith('/b/') else 1)
+        self.assertEqual(urls, ['/', '/b/', '/a/', '/c/', '/new/', '/main.css'])
+
+    def test_crawl_with_skip_paths(self):
+        urls, _, _ = self.crawl('HTTP/1.1', skip_paths=['/a/', '/b/'])
+        self.assertEqual(urls, ['/'])
+
+    def test_redirect_target_is_fetched_once(self):
+        pages = dict(self.pages)
+        pages['/'] += ' <a href="/new/">New</a>'
+        self.pages = pages
+        urls, _, _ = self.crawl('HTTP/1.1')
+        self.assertEqual(urls, ['/', '/a/', '/b/', '/new/', '/c/', '/main.css'])
+
+    def test_raise_for_status(self):
+        rsp = crawler.Response('http://localhost/x/', 404, 'Not Found', crawler.Headers(), b'')
+        with self.assertRaises(crawler.HTTPError) as ctx:
+            rsp.raise_for_status()
+        self.assertEqual(str(ctx.exception), '404 Client Error: Not Found for url: http://localhost/x/')
+
+
+class TestFrontier(unittest.TestCase):
+    def test_normalize_url(self):
+        normalize_url = frontier.normalize_url
+        self.assertEqual(normalize_url('HTTP://Example.COM:80'), 'http://example.com/')
+        self.assertEqual(normalize_url('https://example.com:8443/a/#top'), 'https://example.com:8443/a/')
+        self.assertEqual(normalize_url('http://example.com/a/#top', ignore_fragments=False), 'http://example.com/a/#top')
+        self.assertEqual(normalize_url('http://example.com/a', trailing_slash='add'), 'http://example.com/a/')
+        self.assertEqual(normalize_url('http://example.com/a.css', trailing_slash='add'), 'http://example.com/a.css')
+        self.assertEqual(normalize_url('http://example.com/a/', trailing_slash='remove'), 'http://example.com/a')
+        self.assertEqual(normalize_url('http://example.com/', trailing_slash='remove'), 'http://example.com/')
+        self.assertEqual(
+            normalize_url('http://example.com/?page=2&utm_source=x&b=1', ignore_query_params=['utm_*'], sort_query_params=True),
+            'http://example.com/?b=1&page=2'
+        )
+        self.assertEqual(normalize_url('http://example.com/?b=1&a=2'), 'http://example.com/?b=1&a=2')
+
+    def test_add(self):
+        f = frontier.Frontier(partial(frontier.normalize_url, ignore_query_params=['ref']))
+        self.assertTrue(f.add('http://example.com/a/'))
+        self.assertFalse(f.add('http://example.com/a/#top'))
+        self.assertFalse(f.add('http://example.com/a/?ref=x'))
+        self.assertTrue(f.add('http://example.com/b/'))
+        self.assertIn('http://example.com/b/?ref=y', f)
+        self.assertNotIn('http://example.com/c/', f)
+
+        self.assertEqual(len(f), 2)
+        self.assertEqual(f.pop(), 'http://example.com/a/')
+        self.assertEqual(f.pop(), 'http://example.com/b/')
+        self.assertEqual(len(f), 0)
+
+        # URLs that have been crawled are still seen.
+        self.assertFalse(f.add('http://example.com/a/'))
+
+    def test_priority(self):
+        f = frontier.Frontier(priority=lambda url: url.count('/'))
+        for url in ['http://example.com/a/b/', 'http://example.com/c/', 'http://example.com/a/', 'http://example.com/']:
+            f.add(url)
+
+        self.assertEqual(
+            [f.pop() for _ in range(len(f))],
+            ['http://example.com/', 'http://example.com/c/', 'http://example.com/a/', 'http://example.com/a/b/']
+        )
+
+
+class TestLinks(unittest.TestCase):
+    def test_extract_links_from_html(self):
+        content = b"""
+            <html>
+            <head>
+            <link rel="stylesheet" href="/main.css">
+            <script src='/main.js'></script>
+            <script>var s = '<img src="/not-a-link.jpg">';</script>
+            <style>body { background: url(/bg.png) }</style>
+            </head>
+            <body>
+            <!-- <a href="/commented-out/">Old</a> -->
+            <A HREF=/a/?x=1&amp;y=2>A</A>
+            <img data-src="/lazy.jpg" src = "/img.jpg" srcset="/img-1x.jpg 1x, /img-2x.jpg 2x">
+            <a href="/caf\xc3\xa9/">Caf\xc3\xa9</a>
+            <a href=" /b/ ">B</a>
+            <a href="">Nowhere</a>
+            </body>
+            </html>
+        """
+
+        self.assertEqual(links.extract_links(content, 'text/html; charset=utf-8'), [
+            '/main.css',
+            '/main.js',
+            '/bg.png',
+            '/a/?x=1&y=2',
+            '/img.jpg',
+            '/img-1x.jpg',
+            '/img-2x.jpg',
+            '/caf\xe9/',
+            '/b/',
+        ])
+
+    def test_extract_links_from_css(self):
+        content = b"""
+            @import "/reset.css";
+            @import url(/print.css) print;
+            /* background: url(/commented-out.png); */
+            body { background: url("/pale-thistle.jpg"); }
+            h1 { background: url( '/dark-thistle.jpg' ); }
+        """
+
+        self.assertEqual(links.extract_links(content, 'text/css'), [
+            '/reset.css',
+            '/print.css',
+            '/pale-thistle.jpg',
+            '/dark-thistle.jpg',
+        ])
+
+    def test_extract_links_with_other_encodings(self):
+        content = '<a href="/caf\xe9/">Caf\xe9</a>'
+        self.assertEqual(links.extract_links(content.encode('latin-1'), 'text/html; charset=ISO-8859-1'), ['/caf\xe9/'])
+        self.assertEqual(links.extract_links(content.encode('utf-16'), 'text/html; charset=utf-16'), ['/caf\xe9/'])
+
+    def test_content_types_without_links_are_skipped(self):
+        content = b'{"href": "/a/"}'
+        self.assertEqual(links.extract_links(content, 'application/json'), [])
+        self.assertEqual(links.extract_links(b'\xff\xd8 href="/a/"', 'image/jpeg'), [])
+        self.assertEqual(links.extract_links(content, ''), [])
+
+
+class TestSharding(unittest.TestCase):
+    def test_parse_shard(self):
+        self.assertEqual(sharding.parse_shard('0/4'), (0, 4))
+        self.assertEqual(sharding.parse_shard('3/4'), (3, 4))
+
+        for value in ['4/4', '-1/4', '1', '1/x', '0/0']:
+            with self.assertRaises(ValueError):
+                sharding.parse_shard(value)
+
+    def test_get_shard(self):
+        rel_paths = ['articles/{}/index.html'.format(ix) for ix in range(100)]
+        shards = [sharding.get_shard(rel_path, 4) for rel_path in rel_paths]
+        self.assertEqual(shards, [sharding.get_shard(rel_path, 4) for rel_path in rel_paths])
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+
+    def test_check_manifests(self):
+        pages = {'index.html': '/', 'a/index.html': '/a/', 'b/index.html': '/b/'}
+        manifests = [
+            sharding.Manifest(0, 3, pages, ['index.html', 'CNAME']),
+            sharding.Manifest(1, 3, pages, ['a/index.html']),
+            sharding.Manifest(2, 3, pages, ['b/index.html', 'b/index.html.gz']),
+        ]
+        self.assertEqual(sharding.check_manifests(manifests), [])
+
+        manifests[2] = sharding.Manifest(1, 3, pages, ['a/index.html'])
+        self.assertEqual(sharding.check_manifests(manifests), [
+            'Shard 1/3 is given more than once',
+            'Shard 2/3 is missing',
+            'a/index.html was written by shards 1, 1',
+            'b/index.html (for /b/) was not written by any shard',
+        ])
+
+        manifests[2] = sharding.Manifest(2, 2, pages, ['b/index.html'])
+        self.assertEqual(sharding.check_manifests(manifests), [
+            'Manifests are not all from a build with the same number of shards (found 2, 3)',
+        ])
+
+    def test_manifest_round_trip(self):
+        dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        path = sharding.get_manifest_path(os.path.join(dir_path, 'output') + os.sep)
+        self.assertEqual(path, os.path.join(dir_path, 'output.manifest.json'))
+
+        sharding.Manifest(1, 2, {'index.html': '/'}, ['index.html']).write(path)
+        manifest = sharding.Manifest.read(path)
+        self.assertEqual((manifest.shard, manifest.shards), (1, 2))
+        self.assertEqual(manifest.pages, {'index.html': '/'})
+        self.assertEqual(manifest.files, ['index.html'])
+
+
+class TestArchiveSinks(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+
+    def write_archive(self, filename):
+        path = os.path.join(self.dir_path, filename)
+
+        with output.open_sink(path) as sink:
+            sink.write(os.path.join('a', 'index.html'), b'a')
+            slot = sink.reserve(os.path.join('a', 'index.html.gz'))
+            sink.write(os.path.join('b', 'c', 'index.html'), b'bc')
+            slot.set_result(b'a.gz')
+
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_tar(self):
+        for filename in ['site.tar', 'site.tar.gz']:
+            content = self.write_archive(filename)
+            sleep(1)
+            self.assertEqual(self.write_archive(filename), content)
+
+            with tarfile.open(os.path.join(self.dir_path, filename)) as tar:
+                self.assertEqual(tar.getnames(), ['a', 'a/index.html', 'a/index.html.gz', 'b', 'b/c', 'b/c/index.html'])
+                self.assertEqual(tar.extractfile('a/index.html.gz').read(), b'a.gz')
+                self.assertEqual(tar.getmember('b/c/index.html').mtime, output.ARCHIVE_MTIME)
+
+    def test_tar_dedupe(self):
+        path = os.path.join(self.dir_path, 'site.tar')
+
+        with output.open_sink(path, dedupe=True) as sink:
+            sink.write('a.html', b'same')
+            sink.write(os.path.join('b', 'index.html'), b'same')
+
+        with tarfile.open(path) as tar:
+            member = tar.getmember('b/index.html')
+            self.assertTrue(member.islnk())
+            self.assertEqual(member.linkname, 'a.html')
+            self.assertEqual(tar.extractfile('b/index.html').read(), b'same')
+
+        self.assertEqual(sink.dedupe_stats, {'linked_files': 1, 'linked_bytes': 4})
+
+    def test_zip(self):
+        content = self.write_archive('site.zip')
+        sleep(1)
+        self.assertEqual(self.write_archive('site.zip'), content)
+
+        with zipfile.ZipFile(os.path.join(self.dir_path, 'site.zip')) as zf:
+            self.assertEqual(zf.namelist(), ['a/', 'a/index.html', 'a/index.html.gz', 'b/', 'b/c/', 'b/c/index.html'])
+            self.assertEqual(zf.read('b/c/index.html'), b'bc')
+
+    def test_failed_reservation(self):
+        path = os.path.join(self.dir_path, 'site.tar')
+
+        with self.assertRaises(ValueError):
+            with output.open_sink(path) as sink:
+                slot = sink.reserve('index.html')
+                slot.set_exception(ValueError())
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_path)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_compress_gzip_is_reproducible(self):
+        content = b'<p>Hello</p>' * 100
+        compressed = compression.compress(content, 'gzip')
+        self.assertEqual(gzip.decompress(compressed), content)
+        sleep(1)
+        self.assertEqual(compression.compress(content, 'gzip'), compressed)
+
+    def test_compress_uses_cache(self):
+        content = b'<p>Hello</p>' * 100
+        compressed = compression.compress(content, 'gzip', self.cache_dir)
+
+        [path] = glob.glob(os.path.join(self.cache_dir, '*', '*.gz'))
+        with open(path, 'wb') as f:
+            f.write(b'cached')
+
+        self.assertEqual(compression.compress(content, 'gzip', self.cache_dir), b'cached')
+        self.assertNotEqual(compressed, b'cached')
+
+    def test_compressor(self):
+        big_html = b'<p>Hello</p>' * 100
+
+        with output.OutputWriter(self.output_path) as writer:
+            with compression.Compressor(writer, ['gzip'], min_size=100, cache_dir=self.cache_dir) as compressor:
+                compressor.compress('big.html', big_html, 'text/html; charset=utf-8')
+                compressor.compress('small.html', b'<p>Hello</p>', 'text/html; charset=utf-8')
+                compressor.compress('big.jpg', big_html, 'image/jpeg')
+
+        self.assertEqual(os.listdir(self.output_path), ['big.html.gz'])
+
+        with open(os.path.join(self.output_path, 'big.html.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), big_html)
+
+    def test_unknown_encoding(self):
+        with output.OutputWriter(self.output_path) as writer:
+            with self.assertRaises(ImproperlyConfigured):
+                compression.Compressor(writer, ['lzma'])
+
+
+@override_settings(DEBUG=True)
+class TestServer(TransactionTestCase):
+    def setUp(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+    def test_server_keeps_connections_alive(self):
+        with server.Server(0) as s:
+            # The server is listening as soon as it has been created.
+            conn = http.client.HTTPConnection('127.0.0.1', s.port)
+            self.addCleanup(conn.close)
+
+            for path in ['/articles/en/django/', '/static/main.css', '/articles/en/python/']:
+                conn.request('GET', path)
+                rsp = conn.getresponse()
+                rsp.read()
+
+                self.assertEqual(rsp.status, 200)
+                self.assertEqual(rsp.version, 11)
+                self.assertNotEqual(rsp.getheader('Connection'), 'close')
+
+            # Every request was made over the same socket.
+            self.assertIsNotNone(conn.sock)
+
+            conn.request('GET', '/', headers={'Connection': 'close'})
+            rsp = conn.getresponse()
+            rsp.read()
+            self.assertEqual(rsp.getheader('Connection'), 'close')
+
+    def test_wrap_handler(self):
+        def wrap_handler(handler):
+            def wrapped(environ, start_response):
+                return handler(environ, lambda status, headers, exc_info=None: start_response(
+                    status, headers + [('X-Wrapped', 'yes')], exc_info
+                ))
+            return wrapped
+
+        with server.Server(0, wrap_handler) as s:
+            rsp = requests.get(s.url)
+
+        self.assertEqual(rsp.headers['X-Wrapped'], 'yes')
+
+    def test_parse_addrport(self):
+        self.assertEqual(server.parse_addrport('8001'), ('127.0.0.1', '8001'))
+        self.assertEqual(server.parse_addrport('0.0.0.0:8001'), ('0.0.0.0', '8001'))
+        self.assertEqual(server.parse_addrport('[::1]:8001'), ('::1', '8001'))
+
 
 # This needs to subclass TransactionTestCase instead of TestCase, because
 # TestCase executes all database statements inside a transaction, meaning that
@@ -527,6 +1434,234 @@ class TestBuildSite(TransactionTestCase):
         management.call_command('buildsite', verbosity=0)
         self.assertDirectoriesEqual('output', os.path.join('tests', 'expected-output'))
 
+    def test_buildsite_with_report(self):
+        report_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, report_path)
+
+        management.call_command('buildsite', verbosity=0, report=report_path)
+
+        with open(os.path.join(report_path, 'build-report.json')) as f:
+            report = json.load(f)
+
+        pages = {page['url']: page for page in report['pages']}
+        page = pages['/articles/en/django/']
+        self.assertEqual(page['output_path'], os.path.join('articles', 'en', 'django', 'index.html'))
+        self.assertEqual(page['status'], 200)
+        self.assertTrue(page['query_count'] > 0)
+        self.assertTrue(page['render_seconds'] > 0)
+        self.assertEqual(pages['/static/main.css']['query_count'], 0)
+
+        self.assertEqual(report['summary']['num_pages'], len(pages))
+        self.assertGreater(report['summary']['time_to_first_page_seconds'], 0)
+        self.assertIn('/articles/en/django/', report['slowest_pages'])
+        self.assertIn('/articles/en/django/', report['most_queries_pages'])
+
+        with open(os.path.join(report_path, 'build-report.csv')) as f:
+            self.assertEqual(len(f.readlines()), len(pages) + 1)
+
+    def test_buildsite_with_dedupe(self):
+        report_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, report_path)
+
+        # A copy of a static file that the site links to, which the crawler is
+        # told to fetch too, so that two files in the output are identical.
+        copy_path = os.path.join('tests', 'static', 'copy-of-main.css')
+        shutil.copyfile(os.path.join('tests', 'static', 'main.css'), copy_path)
+        self.addCleanup(os.remove, copy_path)
+
+        crawl_options = dict(getattr(settings, 'DJANGO_AMBER_CRAWL_OPTIONS', {}), paths=['/', '/static/copy-of-main.css'])
+
+        with override_settings(DJANGO_AMBER_CRAWL_OPTIONS=crawl_options):
+            management.call_command('buildsite', verbosity=0, report=report_path, dedupe=True)
+
+        with open(os.path.join(report_path, 'build-report.json')) as f:
+            report = json.load(f)
+
+        self.assertEqual(set(report['dedupe']), {'linked_files', 'linked_bytes'})
+        self.assertGreater(report['dedupe']['linked_files'], 0)
+        self.assertGreater(report['dedupe']['linked_bytes'], 0)
+        self.assertTrue(os.path.samefile(
+            os.path.join('output', 'static', 'main.css'),
+            os.path.join('output', 'static', 'copy-of-main.css'),
+        ))
+
+    def test_buildsite_with_export_static(self):
+        report_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, report_path)
+
+        management.call_command('buildsite', verbosity=0, report=report_path, export_static=True)
+
+        for filename in ['dark-thistle.jpg', 'main.css', 'main.js', 'pale-thistle.jpg']:
+            with open(os.path.join('tests', 'static', filename), 'rb') as f1:
+                with open(os.path.join('output', 'static', filename), 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+        # Static files from other apps are exported too, even if no page links
+        # to them.
+        self.assertTrue(os.path.exists(os.path.join('output', 'static', 'admin', 'css', 'base.css')))
+
+        with open(os.path.join(report_path, 'build-report.json')) as f:
+            report = json.load(f)
+
+        urls = [page['url'] for page in report['pages']]
+        self.assertIn('/articles/en/django/', urls)
+        self.assertFalse([url for url in urls if url.startswith('/static/')])
+
+    def test_buildsite_with_query_cache(self):
+        report_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, report_path)
+        expected_output_path = os.path.join(report_path, 'expected-output')
+
+        management.call_command('buildsite', verbosity=0, report=report_path)
+        with open(os.path.join(report_path, 'build-report.json')) as f:
+            num_queries = json.load(f)['summary']['total_query_count']
+        shutil.move('output', expected_output_path)
+
+        management.call_command('buildsite', verbosity=0, report=report_path, cache_queries=True)
+        with open(os.path.join(report_path, 'build-report.json')) as f:
+            num_cached_queries = json.load(f)['summary']['total_query_count']
+
+        self.assertDirectoriesEqual('output', expected_output_path)
+        self.assertTrue(num_cached_queries < num_queries)
+
+    @override_settings(DJANGO_AMBER_COMPRESS_MIN_SIZE=0)
+    def test_buildsite_with_compression(self):
+        management.call_command('buildsite', verbosity=0, compress='gzip')
+
+        for path in ['index.html', os.path.join('articles', 'en', 'django', 'index.html'), os.path.join('static', 'main.css')]:
+            with open(os.path.join('output', path), 'rb') as f:
+                content = f.read()
+            with gzip.open(os.path.join('output', path + '.gz')) as f:
+                self.assertEqual(f.read(), content)
+
+        self.assertFalse(os.path.exists(os.path.join('output', 'static', 'dark-thistle.jpg.gz')))
+
+    def test_buildsite_refuses_to_remove_other_dir(self):
+        dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        with open(os.path.join(dir_path, 'notes.txt'), 'w'):
+            pass
+
+        with self.assertRaises(CommandError):
+            management.call_command('buildsite', verbosity=0, output=dir_path)
+
+        self.assertEqual(os.listdir(dir_path), ['notes.txt'])
+
+        with self.assertRaises(CommandError):
+            management.call_command('buildsite', verbosity=0, output=settings.BASE_DIR)
+
+    def test_buildsite_to_archive(self):
+        dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        path = os.path.join(dir_path, 'site.tar.gz')
+
+        management.call_command('buildsite', verbosity=0, output=path)
+
+        with tarfile.open(path) as tar:
+            names = tar.getnames()
+            self.assertIn('index.html', names)
+            self.assertIn('articles/en/django/index.html', names)
+            with open(os.path.join('tests', 'expected-output', 'static', 'main.css'), 'rb') as f:
+                self.assertEqual(tar.extractfile('static/main.css').read(), f.read())
+
+    @override_settings(DJANGO_AMBER_CNAME='amber.example.com')
+    def test_sharded_buildsite(self):
+        dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+
+        management.call_command('buildsite', verbosity=0)
+
+        # Shards may be written to directories or archives.
+        shard_paths = [os.path.join(dir_path, 'shard-0'), os.path.join(dir_path, 'shard-1.tar.gz')]
+        for ix, shard_path in enumerate(shard_paths):
+            management.call_command('buildsite', verbosity=0, shard='{}/2'.format(ix), output=shard_path)
+
+        manifests = [sharding.Manifest.read(sharding.get_manifest_path(path)) for path in shard_paths]
+        self.assertEqual(manifests[0].pages, manifests[1].pages)
+        self.assertIn('index.html', manifests[0].pages)
+        self.assertFalse(set(manifests[0].files) & set(manifests[1].files))
+        self.assertTrue(manifests[0].files)
+        self.assertTrue(manifests[1].files)
+
+        merged_path = os.path.join(dir_path, 'merged')
+        management.call_command('mergebuild', *shard_paths, verbosity=0, output=merged_path)
+        self.assertDirectoriesEqual(merged_path, 'output')
+
+        # The merged manifest lists every page, so the next build can fetch
+        # just the pages belonging to each shard, without crawling.
+        merged_manifest_path = sharding.get_manifest_path(merged_path)
+        shard_paths = [os.path.join(dir_path, 'from-manifest-{}'.format(ix)) for ix in range(2)]
+        for ix, shard_path in enumerate(shard_paths):
+            management.call_command(
+                'buildsite',
+                verbosity=0,
+                shard='{}/2'.format(ix),
+                output=shard_path,
+                from_manifest=merged_manifest_path,
+            )
+
+        merged_path = os.path.join(dir_path, 'merged-from-manifest')
+        management.call_command('mergebuild', *shard_paths, verbosity=0, output=merged_path)
+        self.assertDirectoriesEqual(merged_path, 'output')
+
+    def test_mergebuild_with_missing_shard(self):
+        dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        shard_path = os.path.join(dir_path, 'shard-0')
+
+        management.call_command('buildsite', verbosity=0, shard='0/2', output=shard_path)
+
+        with self.assertRaises(CommandError) as ctx:
+            management.call_command('mergebuild', shard_path, verbosity=0, output=os.path.join(dir_path, 'merged'))
+
+        self.assertIn('Shard 1/2 is missing', str(ctx.exception))
+        self.assertIn('was not written by any shard', str(ctx.exception))
+
+        # A file that has gone missing from a shard's output is also noticed.
+        management.call_command('buildsite', verbosity=0, shard='1/2', output=os.path.join(dir_path, 'shard-1'))
+        manifest = sharding.Manifest.read(sharding.get_manifest_path(shard_path))
+        os.remove(os.path.join(shard_path, manifest.files[0]))
+
+        with self.assertRaises(CommandError) as ctx:
+            management.call_command(
+                'mergebuild',
+                shard_path,
+                os.path.join(dir_path, 'shard-1'),
+                verbosity=0,
+                output=os.path.join(dir_path, 'merged'),
+            )
+
+        self.assertIn('{} is missing from {}'.format(manifest.files[0], shard_path), str(ctx.exception))
+
+    def test_mergebuild_checks_shards_before_writing(self):
+        dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path)
+        shard_paths = [os.path.join(dir_path, 'shard-{}'.format(ix)) for ix in range(2)]
+        merged_path = os.path.join(dir_path, 'merged')
+
+        for ix, shard_path in enumerate(shard_paths):
+            management.call_command('buildsite', verbosity=0, shard='{}/2'.format(ix), output=shard_path)
+
+        management.call_command('mergebuild', *shard_paths, verbosity=0, output=merged_path)
+        merged_files = sharding.DirectoryShard(merged_path).list_files()
+
+        # A problem with the last shard leaves the earlier output alone.
+        manifest = sharding.Manifest.read(sharding.get_manifest_path(shard_paths[1]))
+        os.remove(os.path.join(shard_paths[1], manifest.files[0]))
+
+        with self.assertRaises(CommandError):
+            management.call_command('mergebuild', *shard_paths, verbosity=0, output=merged_path)
+
+        self.assertEqual(sharding.DirectoryShard(merged_path).list_files(), merged_files)
+
+        # The output may not be, or contain, one of the shards.
+        for output_path in [shard_paths[0], dir_path]:
+            with self.assertRaises(CommandError) as ctx:
+                management.call_command('mergebuild', *shard_paths, verbosity=0, output=output_path)
+            self.assertIn('overlaps with the shard', str(ctx.exception))
+
+        self.assertTrue(os.path.isdir(shard_paths[0]))
+
     @override_settings(DJANGO_AMBER_CNAME='amber.example.com')
     def test_buildsite_with_cname(self):
         management.call_command('buildsite', verbosity=0)
@@ -545,11 +1680,75 @@ class TestBuildSite(TransactionTestCase):
         with self.assertRaises(TypeError) as ctx:
             # We expect a TypeError to be raised because of the invalid option.
             # This seems the simplest way of checking that the option gets
-            # passed to `http_crawler.crawl()`.
+            # passed to `django_amber.crawler.crawl()`.
             management.call_command('buildsite', verbosity=0)
         self.assertEqual(str(ctx.exception), "crawl() got an unexpected keyword argument 'k'")
 
 
+class TestReferenceIndex(DjangoPagesTestCase):
+    def test_build_from_database(self):
+        self.create_model_instances()
+        references.index.build()
+
+        self.assertEqual(references.index.get_referrers(Tag, 'django'), {
+            (Author, 'jane', 'tags'),
+            (Author, 'john', 'tags'),
+            (Article, 'en/django', 'tags'),
+        })
+        self.assertEqual(references.index.get_referrers(Author, 'jane'), {
+            (Author, 'john', 'editor'),
+            (Article, 'en/django', 'author'),
+        })
+        self.assertEqual(references.index.get_path(Article, 'en/django'), get_path('article', 'en/django'))
+        self.assertEqual(references.index.get_path(Author, 'john'), get_path('author', 'john'))
+
+    def test_loadpages_fills_index(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+        self.assertTrue(references.index.built)
+        self.assertEqual(references.index.get_referrers(Article, 'en/django'), {
+            (Comment, 'en/django/2016-12-31', 'article'),
+        })
+        self.assertEqual(
+            references.index.get_path(Comment, 'en/django/2016-12-31'),
+            get_path('comment', 'en/django/2016-12-31'),
+        )
+
+    def test_find_cascades(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+        self.assertEqual(references.index.find_cascades([(Author, 'john')]), [(Article, 'en/python')])
+        self.assertEqual(references.index.find_cascades([(Author, 'jane')]), [
+            (Article, 'en/django'),
+            (Article, 'en/python'),
+            (Author, 'john'),
+            (Comment, 'en/django/2016-12-31'),
+        ])
+        self.assertEqual(references.index.find_cascades([(Tag, 'django')]), [])
+
+    def test_changes_are_undone_on_error(self):
+        set_up_dumped_data()
+        self.create_model_instances()
+        references.index.build()
+
+        with open(get_path('author', 'jane'), 'w') as f:
+            f.write('name: Jane Smith\n')
+
+        with self.assertRaises(LoadFromFileError):
+            serve.apply_changes(
+                [get_path('author', 'jane'), get_path('author', 'invalid_yaml')],
+                [get_path('article', 'en/django')],
+            )
+
+        self.assertEqual(references.index.get_referrers(Tag, 'python'), {
+            (Author, 'jane', 'tags'),
+            (Author, 'john', 'tags'),
+            (Article, 'en/python', 'tags'),
+        })
+
+
 class TestServeDynamic(DjangoPagesTestCase):
     def test_get_mtimes(self):
         set_up_dumped_data(valid_only=True)
@@ -594,6 +1793,399 @@ class TestServeDynamic(DjangoPagesTestCase):
         with self.assertRaises(ObjectDoesNotExist):
             Article.objects.get(pk=article_id)
 
+    def test_remove_missing_with_several_models(self):
+        self.create_model_instances()
+
+        serve.remove_missing([
+            get_path('article', 'en/django'),
+            get_path('article', 'en/python'),
+            get_path('tag', 'django'),
+        ])
+        self.assertEqual(Article.objects.count(), 0)
+        self.assertEqual([tag.key for tag in Tag.objects.all()], ['python'])
+
+    def test_apply_changes_is_atomic(self):
+        set_up_dumped_data()
+        self.create_model_instances()
+
+        with self.assertRaises(LoadFromFileError):
+            serve.apply_changes(
+                [get_path('tag', 'django'), get_path('author', 'invalid_yaml')],
+                [get_path('article', 'en/django')],
+            )
+        self.assertEqual(Article.objects.count(), 2)
+
+    def test_remove_missing_returns_cascaded_objects(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+        cascaded = serve.remove_missing([get_path('article', 'en/django')])
+        self.assertEqual(cascaded, [(Comment, 'en/django/2016-12-31')])
+        self.assertEqual(Comment.objects.count(), 0)
+
+    @override_settings(DJANGO_AMBER_ALLOW_CASCADING_DELETES=False)
+    def test_remove_missing_with_cascading_deletes_disallowed(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+        with self.assertRaises(references.CascadingDeleteError) as ctx:
+            serve.apply_changes([], [get_path('article', 'en/django')])
+
+        self.assertEqual(
+            str(ctx.exception),
+            'Removing these files would also delete tests.comment:en/django/2016-12-31, whose files still exist'
+        )
+        self.assertEqual(Article.objects.count(), 2)
+
+        # Once the comment is removed too, the article can be removed.
+        serve.apply_changes([], [get_path('article', 'en/django'), get_path('comment', 'en/django/2016-12-31')])
+        self.assertEqual(Article.objects.count(), 1)
+
+    def test_apply_changes_reloads_referrers_of_added_objects(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+        path = get_path('tag', 'python')
+        os.rename(path, path + '.bak')
+        serve.apply_changes([], [path])
+        self.assertEqual([tag.key for tag in Author.objects.get(key='jane').tags.order_by('key')], ['django'])
+
+        # jane.yml still refers to python, so it is loaded again once python
+        # is added back.
+        os.rename(path + '.bak', path)
+        serve.apply_changes([path], [])
+        self.assertEqual([tag.key for tag in Author.objects.get(key='jane').tags.order_by('key')], ['django', 'python'])
+        self.assertEqual([article.key for article in Tag.objects.get(key='python').articles.all()], ['en/python'])
+
+    def test_apply_changes_with_misplaced_file(self):
+        set_up_dumped_data(valid_only=True)
+
+        with dump_layout(Tag, 'hashed'):
+            management.call_command('migratelayout', 'tests.tag', verbosity=0)
+            management.call_command('loadpages', verbosity=0)
+
+            # This isn't where the hashed layout would put any key.
+            path = os.path.join(Tag.get_dump_dir_path(), 'en', 'stray.yml')
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('name: Stray\n')
+
+            event = livereload.get_reload_event([path], [])
+            self.assertEqual(event, {'objects': [], 'models': []})
+
+            with self.assertRaises(LoadFromFileError) as ctx:
+                serve.apply_changes([path], [])
+            self.assertEqual(ctx.exception.path, path)
+
+            os.remove(path)
+            serve.apply_changes([], [path])
+            self.assertEqual(Tag.objects.count(), 2)
+
+    def test_apply_changes_with_missing_reference(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+        # The editor doesn't exist, which is only noticed once every file has
+        # been loaded.
+        path = get_path('author', 'zed')
+        with open(path, 'w') as f:
+            f.write('editor: nobody\nname: Zed\n')
+
+        with self.assertRaises(LoadFromFileError) as ctx:
+            serve.apply_changes([path], [])
+        self.assertEqual(ctx.exception.path, path)
+        self.assertFalse(Author.objects.filter(key='zed').exists())
+
+    def test_apply_changes_with_many_keys(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+        paths = []
+        for ix in range(25):
+            path = get_path('tag', 'tag-{}'.format(ix))
+            with open(path, 'w') as f:
+                f.write('name: Tag {}\n'.format(ix))
+            paths.append(path)
+
+        # Keys are looked up and deleted a few at a time.
+        with mock.patch('django_amber.models.MAX_KEYS_PER_QUERY', 10):
+            event = livereload.get_reload_event(paths, [])
+            self.assertEqual(event['models'], ['tests.tag'])
+
+            serve.apply_changes(paths, [])
+            self.assertEqual(Tag.objects.count(), 27)
+
+            for path in paths:
+                os.remove(path)
+
+            with CaptureQueriesContext(connection) as ctx:
+                serve.apply_changes([], paths)
+
+            self.assertEqual(Tag.objects.count(), 2)
+
+        key_counts = [query['sql'].count("'tag-") for query in ctx.captured_queries]
+        self.assertEqual(max(key_counts), 10)
+
+    def test_try_apply_changes(self):
+        set_up_dumped_data()
+        self.create_model_instances()
+
+        batch = serve.ChangeBatch()
+        batch.add([get_path('tag', 'django'), get_path('author', 'invalid_yaml')], [get_path('article', 'en/django')])
+
+        cascaded, error = serve.try_apply_changes(batch)
+        self.assertEqual(cascaded, [])
+        self.assertIn(get_path('author', 'invalid_yaml'), error)
+        self.assertEqual(Article.objects.count(), 2)
+
+        batch = serve.ChangeBatch()
+        batch.add([get_path('tag', 'django')], [get_path('article', 'en/django')])
+        self.assertEqual(serve.try_apply_changes(batch), ([], None))
+        self.assertEqual(Article.objects.count(), 1)
+
+    def test_apply_batch_with_database_error(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+        stderr = StringIO()
+        command = serve.Command(stdout=StringIO(), stderr=stderr)
+        command.verbosity = 1
+        command.livereload_server = None
+        command.shadow_threshold = None
+
+        batch = serve.ChangeBatch()
+        batch.add([], [get_path('tag', 'django')])
+
+        with mock.patch.object(serve, 'delete_for_paths', side_effect=IntegrityError('protected')):
+            self.assertFalse(command.apply_batch(batch))
+
+        self.assertIn('protected', stderr.getvalue())
+        self.assertTrue(Tag.objects.filter(key='django').exists())
+
+        self.assertTrue(command.apply_batch(batch))
+        self.assertFalse(Tag.objects.filter(key='django').exists())
+
+    def test_change_batch(self):
+        batch = serve.ChangeBatch()
+        batch.add(['changed', 'changed-then-removed'], ['removed-then-added'])
+        batch.add(['removed-then-added'], ['changed-then-removed', 'removed'])
+
+        self.assertEqual(set(batch.changed_paths), {'changed', 'removed-then-added'})
+        self.assertEqual(set(batch.missing_paths), {'changed-then-removed', 'removed'})
+
+
+# This needs to subclass TransactionTestCase, since the database file is copied
+# and swapped, which wouldn't include changes in an uncommitted transaction.
+@unittest.skipUnless(shadow.shadow_supported(), 'shadow databases need a file-based SQLite database')
+class TestShadowDatabase(TransactionTestCase):
+    def setUp(self):
+        set_up_dumped_data(valid_only=True)
+        management.call_command('loadpages', verbosity=0)
+
+    def test_changes_visible_after_swap(self):
+        path = get_path('tag', 'django')
+        with open(path, 'w') as f:
+            f.write('name: Django!\n')
+
+        with shadow.shadow_database() as using:
+            serve.apply_changes([path], [get_path('article', 'en/python')], using=using)
+            self.assertEqual(Tag.objects.get(key='django').name, 'Django')
+            self.assertEqual(Article.objects.count(), 2)
+
+        self.assertEqual(Tag.objects.get(key='django').name, 'Django!')
+        self.assertEqual(Article.objects.count(), 1)
+
+    def test_changes_discarded_on_error(self):
+        set_up_dumped_data()
+
+        with self.assertRaises(LoadFromFileError):
+            with shadow.shadow_database() as using:
+                serve.apply_changes(
+                    [get_path('author', 'invalid_yaml')],
+                    [get_path('article', 'en/python')],
+                    using=using,
+                )
+
+        self.assertEqual(Article.objects.count(), 2)
+        self.assertFalse(os.path.exists(settings.DATABASES['default']['NAME'] + '.shadow'))
+
+
+class TestDirectoryScanner(unittest.TestCase):
+    def setUp(self):
+        set_up_dumped_data(valid_only=True)
+
+    def test_scan_matches_walk(self):
+        expected = {}
+        for model in DjangoPagesModel.subclasses():
+            for dir_path, dir_names, filenames in os.walk(model.get_dump_dir_path()):
+                for filename in filenames:
+                    if filename[0] != '.':
+                        path = os.path.join(dir_path, filename)
+                        expected[path] = os.stat(path).st_mtime
+
+        self.assertTrue(expected)
+
+        # The second scan uses the cached listings.
+        scanner = watchers.DirectoryScanner()
+        scanner.racy_window = -1
+        self.assertEqual(scanner.scan(), expected)
+        self.assertEqual(scanner.scan(), expected)
+
+    def test_only_changed_directories_are_relisted(self):
+        scanner = watchers.DirectoryScanner()
+        scanner.racy_window = -1
+        scanner.scan()
+
+        # Add a file without changing the mtime of its directory, so that the
+        # scanner uses its cached listing.
+        dir_path = Tag.get_dump_dir_path()
+        dir_stat = os.stat(dir_path)
+        path = get_path('tag', 'flask')
+        with open(path, 'w') as f:
+            f.write('name: Flask\n')
+        os.utime(dir_path, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+        self.assertNotIn(path, scanner.scan())
+
+        os.utime(dir_path, (1400000000, 1400000000))
+        self.assertIn(path, scanner.scan())
+
+    def test_modified_file_in_unchanged_directory(self):
+        scanner = watchers.DirectoryScanner()
+        scanner.racy_window = -1
+        scanner.scan()
+
+        path = get_path('tag', 'django')
+        os.utime(path, (1400000000, 1400000000))
+        self.assertEqual(scanner.scan()[path], 1400000000)
+
+
+class TestLiveReload(DjangoPagesTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_model_instances()
+
+    def test_get_reload_event(self):
+        set_up_dumped_data(valid_only=True)
+
+        event = livereload.get_reload_event(
+            [get_path('article', 'en/django'), get_path('tag', 'flask')],
+            [get_path('author', 'john')],
+        )
+
+        # Removing john also deletes en/python, whose author he is.
+        self.assertEqual(event, {
+            'objects': ['tests.article:en/django', 'tests.article:en/python', 'tests.author:john', 'tests.tag:flask'],
+            'models': ['tests.article', 'tests.author', 'tests.tag'],
+        })
+
+    def test_server_sends_events(self):
+        server = livereload.LiveReloadServer(0)
+        server.start()
+
+        try:
+            # Like serve, the stream only listens on 127.0.0.1 by default.
+            self.assertEqual(server.httpd.server_address[0], '127.0.0.1')
+            self.assertEqual(server.url, 'http://127.0.0.1:{}/events'.format(server.httpd.server_port))
+
+            rsp = requests.get(server.url, stream=True, timeout=5)
+            self.assertEqual(rsp.headers['Content-Type'], 'text/event-stream')
+
+            server.publish({'objects': ['tests.tag:django'], 'models': []})
+            lines = rsp.iter_lines(chunk_size=1, decode_unicode=True)
+            self.assertEqual(next(lines), 'id: 1')
+            self.assertEqual(next(lines), 'event: reload')
+            self.assertEqual(next(lines), 'data: {"objects": ["tests.tag:django"], "models": []}')
+            rsp.close()
+        finally:
+            server.stop()
+
+    @override_settings(MIDDLEWARE=['django_amber.livereload.LiveReloadMiddleware'])
+    def test_middleware_injects_script(self):
+        os.environ[livereload.URL_ENV_VAR] = 'http://localhost:1234/events'
+
+        try:
+            rsp = self.client.get('/articles/en/django/')
+        finally:
+            del os.environ[livereload.URL_ENV_VAR]
+
+        content = rsp.content.decode('utf8')
+        self.assertIn('new EventSource("http://localhost:1234/events")', content)
+        self.assertIn('"tests.article:en/django"', content)
+        self.assertIn('"tests.author:jane"', content)
+        self.assertIn('</script>\n</body>', content)
+
+    @override_settings(MIDDLEWARE=['django_amber.livereload.LiveReloadMiddleware'])
+    def test_middleware_does_nothing_without_serve(self):
+        rsp = self.client.get('/articles/en/django/')
+        self.assertNotIn('EventSource', rsp.content.decode('utf8'))
+
+
+class WatcherTests(ABC):
+    @abstractmethod
+    def make_watcher(self):
+        pass
+
+    def setUp(self):
+        set_up_dumped_data(valid_only=True)
+        self.watcher = self.make_watcher()
+
+    def tearDown(self):
+        self.watcher.close()
+
+    def test_no_changes(self):
+        self.assertEqual(self.watcher.wait(timeout=0.2), ([], []))
+
+    def test_changed_file(self):
+        path = get_path('article', 'en/django')
+        with open(path, 'a') as f:
+            f.write('More content.\n')
+        os.utime(path, (1400000000, 1400000000))
+
+        self.assertEqual(self.watcher.wait(timeout=1), ([path], []))
+
+    def test_added_file_in_new_directory(self):
+        path = get_path('article', 'fr/django')
+        os.makedirs(os.path.dirname(path))
+        shutil.copy(get_path('article', 'en/django'), path)
+
+        self.assertEqual(self.watcher.wait(timeout=1), ([path], []))
+
+    def test_removed_file(self):
+        path = get_path('author', 'john')
+        os.remove(path)
+
+        self.assertEqual(self.watcher.wait(timeout=1), ([], [path]))
+
+    def test_dotfile_ignored(self):
+        path = get_path('article', 'en/.django') + '.swp'
+        with open(path, 'w'):
+            pass
+
+        self.assertEqual(self.watcher.wait(timeout=0.2), ([], []))
+
+
+class TestPollingWatcher(WatcherTests, unittest.TestCase):
+    def make_watcher(self):
+        return watchers.PollingWatcher(interval=0.01)
+
+
+@unittest.skipUnless(watchers.load_libc(), 'inotify is not available')
+class TestInotifyWatcher(WatcherTests, unittest.TestCase):
+    def make_watcher(self):
+        return watchers.InotifyWatcher()
+
+    def test_recreated_dump_dir(self):
+        dir_path = Tag.get_dump_dir_path()
+        shutil.rmtree(dir_path)
+        self.watcher.wait(timeout=1)
+
+        os.makedirs(dir_path)
+        path = get_path('tag', 'flask')
+        with open(path, 'w') as f:
+            f.write('name: Flask\n')
+
+        self.assertEqual(self.watcher.wait(timeout=1), ([path], []))
+
 
 # This needs to subclass TransactionTestCase for same reason as TestBuildSite.
 class TestServeDynamic2(TransactionTestCase):
@@ -642,3 +2234,72 @@ class TestServeDynamic2(TransactionTestCase):
 
         rsp = get_with_retries('http://localhost:{}/articles/en/django/'.format(port))
         self.assertEqual(rsp.status_code, 404)
+
+
+@override_settings(DEBUG=True)
+class TestBuildSiteWatch(TransactionTestCase):
+    @unittest.removeHandler  # This allows us send SIGINT to the buildsite process
+    def test_buildsite_with_watch(self):
+        set_up_dumped_data(valid_only=True)
+
+        output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_path)
+
+        p = Process(
+            target=management.call_command,
+            args=('buildsite',),
+            kwargs={'watch': True, 'output': output_path, 'verbosity': 0},
+        )
+
+        p.start()
+
+        try:
+            self._test_buildsite_with_watch(output_path)
+        finally:
+            os.kill(p.pid, signal.SIGINT)
+            p.join(5)
+
+    def wait_for(self, condition):
+        for _ in range(50):
+            if condition():
+                return
+            sleep(0.1)
+        self.fail('Timed out')
+
+    def read(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _test_buildsite_with_watch(self, output_path):
+        page_path = os.path.join(output_path, 'articles', 'en', 'django', 'index.html')
+        index_path = os.path.join(output_path, 'articles', 'index.html')
+        other_page_path = os.path.join(output_path, 'articles', 'en', 'python', 'index.html')
+
+        self.wait_for(lambda: self.read(page_path) is not None)
+        self.assertIn('This is an article about <em>Django</em>.', self.read(page_path))
+
+        # Wait for the initial build to finish.
+        sleep(1)
+        other_page_mtime = os.stat(other_page_path).st_mtime
+
+        path = get_path('article', 'en/django')
+
+        with open(path) as f:
+            contents = f.read()
+
+        with open(path, 'w') as f:
+            f.write(contents.replace('*Django*', '**Django**'))
+
+        self.wait_for(lambda: 'This is an article about <strong>Django</strong>.' in self.read(page_path))
+
+        # Pages that don't show the article are not rewritten.
+        self.assertEqual(os.stat(other_page_path).st_mtime, other_page_mtime)
+
+        os.remove(path)
+
+        self.wait_for(lambda: not os.path.exists(page_path))
+        self.assertFalse(os.path.exists(os.path.dirname(page_path)))
+        self.wait_for(lambda: 'articles/en/django/' not in self.read(index_path))
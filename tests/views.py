@@ -8,7 +8,7 @@ class HomeView(TemplateView):
 
 
 class ArticleList(ListView):
-    model = Article
+    queryset = Article.objects.order_by('key')
 
 
 class ArticleDetail(DetailView):
@@ -17,7 +17,7 @@ class ArticleDetail(DetailView):
 
 
 class AuthorList(ListView):
-    model = Author
+    queryset = Author.objects.order_by('key')
 
 
 class AuthorDetail(DetailView):